@@ -0,0 +1,200 @@
+# bench/fixture_server.py
+# ベンチマーク用のローカル HTTP サーバ（標準ライブラリの asyncio だけで動く）。
+# /p/<番号> に商品ページを返す。番号ごとに種類が決まっていて、何千件でも同じ結果になる:
+#
+#   in_stock      在庫ありのページ（「カートに追加する」ボタン）
+#   sold_out      売り切れのページ
+#   not_modified  ETag 付き。If-None-Match が一致すれば 304
+#   slow          FIXTURE_SLOW_MS 待ってから返す
+#   huge          数MBのおすすめ枠のあとに在庫表示がある巨大ページ
+#
+# 実サイトで保存したページがあれば --pages DIR に in_stock.html / sold_out.html を置くとそれを使う。
+#
+#   python -m bench.fixture_server --port 8765
+#   curl -s localhost:8765/p/0 | head
+import argparse, asyncio, os, random
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+KINDS = ("in_stock", "sold_out", "not_modified", "slow", "huge")
+DEFAULT_MIX = "in_stock:30,sold_out:50,not_modified:15,slow:4,huge:1"
+SLOW_MS = int(os.getenv("FIXTURE_SLOW_MS", "800"))
+HUGE_KB = int(os.getenv("FIXTURE_HUGE_KB", "3072"))
+
+IN_STOCK_CSS = ".index_black__RgEgP, .index_red__kx6Ql"
+OUT_OF_STOCK_CSS = "body"
+IN_WORDS = ["カートに追加する", "今すぐ購入"]
+OUT_WORDS = ["在庫切れ", "売り切れ", "SOLD OUT", "在庫なし", "販売開始を通知"]
+
+
+def parse_mix(spec: str) -> List[Tuple[str, int]]:
+    mix = []
+    for part in spec.split(","):
+        kind, _, weight = part.partition(":")
+        if kind.strip() not in KINDS:
+            raise ValueError(f"unknown fixture kind: {kind}")
+        mix.append((kind.strip(), int(weight or 1)))
+    return mix
+
+
+def kind_of(i: int, mix: List[Tuple[str, int]]) -> str:
+    # 番号から決定的に種類を決める（同じ番号は常に同じ種類）
+    total = sum(w for _, w in mix)
+    r = (i * 2654435761) % total
+    for kind, w in mix:
+        if r < w:
+            return kind
+        r -= w
+    return mix[-1][0]
+
+
+def _noise(rng: random.Random, kb: int) -> str:
+    # おすすめ枠・トラッキング用スクリプトなど、判定に関係ない部分
+    cards, size = [], 0
+    while size < kb * 1024:
+        n = rng.randrange(100000)
+        card = (f'<div class="index_productCard__{n:05d}"><a href="/jp/products/{n}">'
+                f'<img src="/img/{n}.webp" alt="THE MONSTERS {n}"></a>'
+                f'<p class="index_title__x1">THE MONSTERS シリーズ フィギュア {n}</p>'
+                f'<span class="index_price__y2">¥{rng.randrange(1000, 20000):,}</span></div>\n')
+        cards.append(card)
+        size += len(card.encode("utf-8"))
+    return "".join(cards)
+
+
+def product_page(i: int, in_stock: bool, noise_kb: int = 24, pages_dir: Optional[Path] = None) -> bytes:
+    recorded = pages_dir / ("in_stock.html" if in_stock else "sold_out.html") if pages_dir else None
+    if recorded is not None and recorded.exists():
+        return recorded.read_bytes()
+    rng = random.Random(i)
+    button = ('<button class="index_black__RgEgP">カートに追加する</button>'
+              '<button class="index_red__kx6Ql">今すぐ購入</button>') if in_stock else \
+             '<button class="index_disabled__Zz1" disabled>在庫切れ</button><div class="notify">販売開始を通知</div>'
+    html = f"""<!DOCTYPE html>
+<html lang="ja"><head><meta charset="utf-8">
+<title>THE MONSTERS PIN FOR LOVE シリーズ {i} | POP MART</title>
+<script>window.dataLayer=window.dataLayer||[];window.__csrf="{rng.getrandbits(64):016x}";</script>
+<script src="https://www.googletagmanager.com/gtm.js?id=GTM-{rng.randrange(10**6)}" async></script>
+</head><body>
+<header class="index_header__h1"><nav>{"".join(f'<a href="/jp/c/{k}">カテゴリ{k}</a>' for k in range(30))}</nav></header>
+<main>
+<div class="index_recommend__r1">{_noise(rng, noise_kb)}</div>
+<section class="index_product__p1" data-ts="{rng.getrandbits(32)}">
+<h1 class="index_title__t1">ぬいぐるみペンダント No.{i}</h1>
+<div class="index_price__p2">¥3,960</div>
+<div class="index_actions__a1">{button}</div>
+</section>
+</main>
+<footer>{"".join(f'<a href="/jp/info/{k}">info{k}</a>' for k in range(40))}</footer>
+</body></html>
+"""
+    return html.encode("utf-8")
+
+
+class FixtureServer:
+    def __init__(self, mix: str = DEFAULT_MIX, pages_dir: Optional[str] = None,
+                 slow_ms: int = SLOW_MS, huge_kb: int = HUGE_KB):
+        self.mix = parse_mix(mix)
+        self.pages_dir = Path(pages_dir) if pages_dir else None
+        self.slow_ms = slow_ms
+        self.huge_kb = huge_kb
+        self._cache: Dict[Tuple[bool, int], bytes] = {}
+        self.server = None
+        self.requests = 0
+
+    def body_for(self, i: int, kind: str) -> bytes:
+        in_stock = kind == "in_stock" or (kind in ("slow", "not_modified") and i % 2 == 0)
+        noise = self.huge_kb if kind == "huge" else 24
+        # ページ生成はそこそこ重いので、同じ形のものは番号違いでも使い回す
+        key = (in_stock, noise)
+        if key not in self._cache:
+            self._cache[key] = product_page(i, in_stock, noise, self.pages_dir)
+        return self._cache[key]
+
+    async def respond(self, path: str, headers: Dict[str, str]) -> Tuple[int, Dict[str, str], bytes]:
+        parts = path.split("?")[0].strip("/").split("/")
+        if len(parts) != 2 or parts[0] != "p" or not parts[1].isdigit():
+            return 404, {}, b"not found"
+        i = int(parts[1])
+        kind = kind_of(i, self.mix)
+        extra = {}
+        if kind == "slow":
+            await asyncio.sleep(self.slow_ms / 1000)
+        if kind == "not_modified":
+            etag = f'"p{i}"'
+            extra["ETag"] = etag
+            if headers.get("if-none-match") == etag:
+                return 304, extra, b""
+        return 200, {"Content-Type": "text/html; charset=utf-8", **extra}, self.body_for(i, kind)
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                try:
+                    head = await reader.readuntil(b"\r\n\r\n")
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    return
+                lines = head.decode("latin-1").split("\r\n")
+                method, path, _ = (lines[0].split(" ") + ["", ""])[:3]
+                headers = {}
+                for line in lines[1:]:
+                    k, _, v = line.partition(":")
+                    if k:
+                        headers[k.strip().lower()] = v.strip()
+                self.requests += 1
+                status, hdrs, body = await self.respond(path, headers)
+                reason = {200: "OK", 304: "Not Modified", 404: "Not Found"}.get(status, "OK")
+                out = [f"HTTP/1.1 {status} {reason}", f"Content-Length: {len(body)}"]
+                out += [f"{k}: {v}" for k, v in hdrs.items()]
+                close = headers.get("connection", "").lower() == "close"
+                if close:
+                    out.append("Connection: close")
+                writer.write(("\r\n".join(out) + "\r\n\r\n").encode("latin-1"))
+                if method != "HEAD":
+                    writer.write(body)
+                await writer.drain()
+                if close:
+                    return
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0):
+        self.server = await asyncio.start_server(self._handle, host, port, backlog=1024)
+        return self.server.sockets[0].getsockname()[1]
+
+    async def close(self):
+        if self.server:
+            self.server.close()
+            await self.server.wait_closed()
+
+
+def make_targets(n: int, base_url: str) -> List[dict]:
+    return [{
+        "name": f"fixture {i}",
+        "url": f"{base_url}/p/{i}",
+        "in_stock_css": IN_STOCK_CSS,
+        "in_stock_text_contains": IN_WORDS,
+        "out_of_stock_css": OUT_OF_STOCK_CSS,
+        "out_of_stock_text_contains": OUT_WORDS,
+    } for i in range(n)]
+
+
+async def _serve(args):
+    srv = FixtureServer(args.mix, args.pages)
+    port = await srv.start(args.host, args.port)
+    print(f"[fixture] http://{args.host}:{port}/p/<n>  mix={args.mix}")
+    await asyncio.Event().wait()
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=8765)
+    ap.add_argument("--mix", default=DEFAULT_MIX)
+    ap.add_argument("--pages", default=None, help="in_stock.html / sold_out.html を置いたディレクトリ")
+    try:
+        asyncio.run(_serve(ap.parse_args()))
+    except KeyboardInterrupt:
+        pass
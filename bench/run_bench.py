@@ -0,0 +1,262 @@
+# bench/run_bench.py
+# ローカルの fixture サーバに対して各チェッカーを回し、性能を測る（実サイトには一切アクセスしない）。
+#
+#   python -m bench.run_bench                          # 既定: aio と、light / decide × 使えるパーサ全部
+#   python -m bench.run_bench --targets 5000 --checkers aio --backends selectolax
+#   python -m bench.run_bench --json bench_result.json
+#   python -m bench.run_bench --checkers aio --proxies 4 --proxy-limit 50   # 出口4つ（各 50 件/秒で 429）経由
+#
+# 測る項目（1ケース = チェッカー × パーサを別プロセスで実行。aio は文言マッチだけでパーサを使わないので1回だけ。
+# 入っていないパーサのケースは走らせずに skipped と表示する）:
+#   throughput   1周あたりのターゲット数/秒（decide は判定回数/秒）
+#   p50 / p99    周の開始から各ターゲットの判定が出るまでの時間（= 直前に再入荷していた場合の検知時間）。
+#                decide は1回の判定時間
+#   cpu          ユーザ+システム CPU 秒
+#   rss          最大常駐メモリ (MB)
+#
+# aio / light は1周目でヘッダキャッシュを作り、2周目（304 が効く状態）を計測する。
+import argparse, asyncio, contextlib, json, os, resource, subprocess, sys, tempfile, threading, time
+from pathlib import Path
+from typing import Dict, List
+
+ROOT = Path(__file__).resolve().parent.parent
+if str(ROOT) not in sys.path:
+    sys.path.insert(0, str(ROOT))
+
+from bench.fixture_server import (DEFAULT_MIX, IN_STOCK_CSS, IN_WORDS, OUT_OF_STOCK_CSS, OUT_WORDS,
+                                  FixtureServer, make_targets, product_page)
+from bench.stub_proxy import start_proxies
+
+CHECKERS = ("aio", "light", "decide")
+BACKENDS = ("selectolax", "lxml", "bs4")
+PARSER_CHECKERS = ("light", "decide")  # HTML パーサで判定するチェッカー
+
+
+def percentile(values: List[float], p: float) -> float:
+    if not values:
+        return 0.0
+    s = sorted(values)
+    return s[min(len(s) - 1, int(round(p / 100 * (len(s) - 1))))]
+
+
+def _usage():
+    ru = resource.getrusage(resource.RUSAGE_SELF)
+    return ru.ru_utime + ru.ru_stime, ru.ru_maxrss / 1024  # Linux の ru_maxrss は KB
+
+
+def _summary(name: str, n: int, wall: float, lat: List[float], cpu0: float) -> Dict:
+    cpu, rss = _usage()
+    return {
+        "checker": name, "n": n, "wall_s": round(wall, 3),
+        "throughput": round(n / wall, 1) if wall else 0.0,
+        "p50_ms": round(percentile(lat, 50) * 1000, 2), "p99_ms": round(percentile(lat, 99) * 1000, 2),
+        "cpu_s": round(cpu - cpu0, 3), "rss_mb": round(rss, 1),
+    }
+
+
+# ---- ワーカー（別プロセスで1ケースだけ実行する） --------------------------------
+
+def work_aio(args, tmp: Path) -> Dict:
+    import check_stock_aio as aio
+    aio.F_TARGETS, aio.F_STATE = tmp / "targets.json", tmp / "state.json"
+    aio.F_HDRS, aio.F_NEED = tmp / "headers_cache.json", tmp / "needs_confirm.json"
+    lat: List[float] = []
+    t0 = [0.0]
+    orig = aio.fetch_one
+
+    async def timed(*a, **kw):
+        res = await orig(*a, **kw)
+        lat.append(time.perf_counter() - t0[0])
+        return res
+    aio.fetch_one = timed
+
+    asyncio.run(aio.main())  # 1周目（ヘッダキャッシュ作成）
+    lat.clear()
+    cpu0, _ = _usage()
+    t0[0] = time.perf_counter()
+    asyncio.run(aio.main())
+    return _summary("aio", args.targets, time.perf_counter() - t0[0], lat, cpu0)
+
+
+def work_light(args, tmp: Path) -> Dict:
+    import check_stock_light as light
+    lat: List[float] = []
+    t0 = [0.0]
+    orig = light.conditional_get
+
+    def timed(*a, **kw):
+        res = orig(*a, **kw)
+        lat.append(time.perf_counter() - t0[0])
+        return res
+    light.conditional_get = timed
+
+    light.main()
+    lat.clear()
+    cpu0, _ = _usage()
+    t0[0] = time.perf_counter()
+    light.main()
+    return _summary("light", args.light_targets, time.perf_counter() - t0[0], lat, cpu0)
+
+
+def work_decide(args, tmp: Path) -> Dict:
+    from fingerprint import compute_fingerprint
+    from stock_rules import Target, compile_target, get_backend, keyword_matcher
+    get_backend()  # 使えないパーサならここで ImportError
+    t = Target(name="bench", url="http://bench/", in_stock_css=IN_STOCK_CSS, in_stock_text_contains=IN_WORDS,
+               out_of_stock_css=OUT_OF_STOCK_CSS, out_of_stock_text_contains=OUT_WORDS)
+    pages = [product_page(0, True).decode(), product_page(1, False).decode(),
+             product_page(2, False, noise_kb=512).decode()]
+    rule = compile_target(t)
+    matcher = keyword_matcher(IN_WORDS, OUT_WORDS)
+    fp = {"css": ".index_actions__a1", "strip_digits": True}
+    calls = [lambda h: rule.decide(h), lambda h: matcher.decide(h), lambda h: compute_fingerprint(h, fp)]
+
+    lat: List[float] = []
+    cpu0, _ = _usage()
+    start = time.perf_counter()
+    for _ in range(args.decide_rounds):
+        for html in pages:
+            for fn in calls:
+                s = time.perf_counter()
+                fn(html)
+                lat.append(time.perf_counter() - s)
+    return _summary("decide", len(lat), time.perf_counter() - start, lat, cpu0)
+
+
+WORKERS = {"aio": work_aio, "light": work_light, "decide": work_decide}
+
+
+def run_worker(args):
+    tmp = Path(args.tmp)
+    n = args.light_targets if args.worker == "light" else args.targets
+    (tmp / "targets.json").write_text(json.dumps(make_targets(n, args.base)), encoding="utf-8")
+    out = sys.stdout
+    try:
+        # チェッカーのログは捨てて、結果の JSON だけを出す
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            res = WORKERS[args.worker](args, tmp)
+    except ImportError as e:
+        res = {"checker": args.worker, "skipped": str(e)}
+    res["backend"] = os.getenv("PARSER_BACKEND", "auto")
+    out.write(json.dumps(res) + "\n")
+
+
+# ---- 親プロセス -----------------------------------------------------------------
+
+class _ServerThread(threading.Thread):
+    def __init__(self, mix: str, pages: str, proxies: int = 0, proxy_limit: float = 0):
+        super().__init__(daemon=True)
+        self.srv = FixtureServer(mix, pages)
+        self.port = None
+        self.n_proxies = proxies
+        self.proxy_limit = proxy_limit
+        self.proxies = []
+        self.egress = ""
+        self._ready = threading.Event()
+        self.loop = asyncio.new_event_loop()
+
+    def run(self):
+        asyncio.set_event_loop(self.loop)
+        self.port = self.loop.run_until_complete(self.srv.start())
+        if self.n_proxies:
+            self.proxies, self.egress = self.loop.run_until_complete(
+                start_proxies(self.n_proxies, self.proxy_limit))
+        self._ready.set()
+        self.loop.run_forever()
+
+    def start_and_wait(self) -> int:
+        self.start()
+        self._ready.wait()
+        return self.port
+
+
+def missing_backend(backend: str) -> str:
+    # 入っていなければ理由を返す（別のパーサに落ちたまま、そのパーサの名前で結果を出さないため）
+    from stock_rules import get_backend
+    try:
+        get_backend(backend)
+    except (ImportError, KeyError) as e:
+        return str(e) or f"unknown parser {backend}"
+    return ""
+
+
+def run_case(args, checker: str, backend: str, base: str, egress: str = "") -> Dict:
+    with tempfile.TemporaryDirectory() as tmp:
+        env = dict(os.environ)
+        env.update({
+            "PARSER_BACKEND": backend if checker in PARSER_CHECKERS else "auto",
+            "TARGETS_PATH": f"{tmp}/targets.json", "STATE_PATH": f"{tmp}/state.json",
+            "HEADERS_PATH": f"{tmp}/headers_cache.json", "TRIGGER_PATH": f"{tmp}/needs_confirm.json",
+            "HISTORY_PATH": f"{tmp}/history.bin",
+            "START_JITTER_SEC": "0",
+            # 全ターゲットが同じホストなので、ホスト単位の制限は外して並列度だけで比べる
+            "HOST_RATE_PER_SEC": "0",
+            "MAX_CONCURRENCY": str(args.concurrency), "MAX_PER_HOST": str(args.concurrency),
+            "EGRESS": egress,
+        })
+        cmd = [sys.executable, "-m", "bench.run_bench", "--worker", checker, "--tmp", tmp, "--base", base,
+               "--targets", str(args.targets), "--light-targets", str(args.light_targets),
+               "--decide-rounds", str(args.decide_rounds)]
+        proc = subprocess.run(cmd, cwd=str(ROOT), env=env, capture_output=True, text=True)
+    lines = [l for l in proc.stdout.splitlines() if l.startswith("{")]
+    if proc.returncode != 0 or not lines:
+        return {"checker": checker, "backend": backend, "skipped": (proc.stderr.strip().splitlines() or ["failed"])[-1]}
+    return {**json.loads(lines[-1]), "backend": backend}
+
+
+def print_table(results: List[Dict]):
+    cols = ("checker", "backend", "n", "throughput", "p50_ms", "p99_ms", "cpu_s", "rss_mb")
+    print(" ".join(f"{c:>11}" for c in cols))
+    for r in results:
+        if "skipped" in r:
+            print(f"{r['checker']:>11} {r['backend']:>11}  skipped: {r['skipped']}")
+            continue
+        print(" ".join(f"{str(r.get(c, '')):>11}" for c in cols))
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--targets", type=int, default=2000, help="aio のターゲット数")
+    ap.add_argument("--light-targets", type=int, default=200, help="light は逐次なので少なめ")
+    ap.add_argument("--decide-rounds", type=int, default=50)
+    ap.add_argument("--checkers", default=",".join(CHECKERS))
+    ap.add_argument("--backends", default=",".join(BACKENDS))
+    ap.add_argument("--concurrency", type=int, default=32)
+    ap.add_argument("--mix", default=DEFAULT_MIX)
+    ap.add_argument("--pages", default=None)
+    ap.add_argument("--json", default=None, help="結果を JSON で保存するパス")
+    ap.add_argument("--proxies", type=int, default=0, help="ローカルの中継プロキシをこの数だけ立てて出口にする")
+    ap.add_argument("--proxy-limit", type=float, default=0, help="プロキシ1つあたりの上限（件/秒、超えたら 429）")
+    ap.add_argument("--worker", choices=CHECKERS, help=argparse.SUPPRESS)
+    ap.add_argument("--tmp", help=argparse.SUPPRESS)
+    ap.add_argument("--base", help=argparse.SUPPRESS)
+    args = ap.parse_args()
+
+    if args.worker:
+        run_worker(args)
+        return
+
+    server = _ServerThread(args.mix, args.pages, args.proxies, args.proxy_limit)
+    base = f"http://127.0.0.1:{server.start_and_wait()}"
+    print(f"[bench] fixture server {base}  mix={args.mix}")
+    if server.egress:
+        print(f"[bench] EGRESS={server.egress}  limit={args.proxy_limit or '-'}/s")
+    results = []
+    for checker in args.checkers.split(","):
+        for backend in args.backends.split(",") if checker in PARSER_CHECKERS else ["-"]:
+            if backend != "-" and (why := missing_backend(backend)):
+                res = {"checker": checker, "backend": backend, "skipped": why}
+            else:
+                res = run_case(args, checker, backend, base, server.egress)
+            print(f"[bench] {checker}/{backend}: {res}")
+            results.append(res)
+    print()
+    print_table(results)
+    for i, p in enumerate(server.proxies):
+        print(f"[bench] proxy {i}: requests={p.requests} blocked={p.blocked}")
+    if args.json:
+        Path(args.json).write_text(json.dumps(results, indent=2), encoding="utf-8")
+
+
+if __name__ == "__main__":
+    main()
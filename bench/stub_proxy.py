@@ -0,0 +1,180 @@
+# bench/stub_proxy.py
+# ベンチマーク・動作確認用のローカル HTTP プロキシ（標準ライブラリの asyncio だけで動く）。
+# egress.py の出口の代わりに使う。実サイトには向けないこと。
+#
+#   GET http://host/path HTTP/1.1   （絶対 URI）→ 転送して応答をそのまま返す（keep-alive 可）
+#   CONNECT host:443                → トンネルを張って中身は素通し
+#
+# 絞られる IP の代わりに、--limit N を付けると1秒あたり N 件を超えた分に 429（Retry-After 付き）を返す。
+# --delay-ms で応答を遅らせる（出口ごとの応答時間の差を作る）。
+#
+#   python -m bench.stub_proxy --port 8801 --limit 5
+#   EGRESS=http://127.0.0.1:8801,http://127.0.0.1:8802 python check_stock_aio.py
+import argparse, asyncio, time
+from typing import Optional
+from urllib.parse import urlsplit
+
+
+class StubProxy:
+    def __init__(self, limit: float = 0, delay_ms: int = 0, retry_after: int = 5):
+        self.limit = limit
+        self.delay_ms = delay_ms
+        self.retry_after = retry_after
+        self.server = None
+        self.requests = 0
+        self.blocked = 0
+        self._window = (0, 0)  # (秒, その秒の件数)
+
+    def _over_limit(self) -> bool:
+        if not self.limit:
+            return False
+        sec = int(time.monotonic())
+        start, n = self._window
+        n = n + 1 if start == sec else 1
+        self._window = (sec, n)
+        return n > self.limit
+
+    async def _tunnel(self, reader, writer, target: str):
+        host, _, port = target.rpartition(":")
+        up_r, up_w = await asyncio.open_connection(host, int(port))
+        writer.write(b"HTTP/1.1 200 Connection Established\r\n\r\n")
+        await writer.drain()
+
+        async def pipe(r, w):
+            try:
+                while data := await r.read(65536):
+                    w.write(data)
+                    await w.drain()
+            except ConnectionError:
+                pass
+            finally:
+                w.close()
+        await asyncio.gather(pipe(reader, up_w), pipe(up_r, writer))
+
+    async def _forward(self, method: str, url: str, headers: list, body: bytes, upstream: dict):
+        # 上流への接続はクライアント接続ごとに1本保持する
+        p = urlsplit(url)
+        key = (p.hostname, p.port or 80)
+        if upstream.get("key") != key:
+            if upstream.get("w"):
+                upstream["w"].close()
+            upstream["r"], upstream["w"] = await asyncio.open_connection(*key)
+            upstream["key"] = key
+        r, w = upstream["r"], upstream["w"]
+        path = (p.path or "/") + (f"?{p.query}" if p.query else "")
+        keep = [(k, v) for k, v in headers if k.lower() not in ("proxy-connection", "proxy-authorization", "connection")]
+        w.write((f"{method} {path} HTTP/1.1\r\n" + "".join(f"{k}: {v}\r\n" for k, v in keep) + "\r\n")
+                .encode("latin-1") + body)
+        await w.drain()
+        head = await r.readuntil(b"\r\n\r\n")
+        length = 0
+        chunked = False
+        for line in head.decode("latin-1").split("\r\n")[1:]:
+            k, _, v = line.partition(":")
+            if k.strip().lower() == "content-length":
+                length = int(v.strip())
+            elif k.strip().lower() == "transfer-encoding" and "chunked" in v.lower():
+                chunked = True
+        status = int(head.split(b" ", 2)[1])
+        if method == "HEAD" or status in (204, 304):
+            return head
+        if chunked:
+            data = bytearray()
+            while True:
+                size_line = await r.readuntil(b"\r\n")
+                size = int(size_line.strip().split(b";")[0], 16)
+                chunk = await r.readexactly(size + 2)
+                data += size_line + chunk
+                if size == 0:
+                    break
+            return head + bytes(data)
+        return head + await r.readexactly(length)
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        upstream = {}
+        try:
+            while True:
+                try:
+                    head = await reader.readuntil(b"\r\n\r\n")
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    return
+                lines = head.decode("latin-1").split("\r\n")
+                method, target, _ = (lines[0].split(" ") + ["", ""])[:3]
+                headers = []
+                length = 0
+                for line in lines[1:]:
+                    k, _, v = line.partition(":")
+                    if k:
+                        headers.append((k.strip(), v.strip()))
+                        if k.strip().lower() == "content-length":
+                            length = int(v.strip())
+                body = await reader.readexactly(length) if length else b""
+                self.requests += 1
+                if self.delay_ms:
+                    await asyncio.sleep(self.delay_ms / 1000)
+                if self._over_limit():
+                    self.blocked += 1
+                    writer.write(f"HTTP/1.1 429 Too Many Requests\r\nRetry-After: {self.retry_after}\r\n"
+                                 f"Content-Length: 0\r\n\r\n".encode("latin-1"))
+                    await writer.drain()
+                    continue
+                if method == "CONNECT":
+                    await self._tunnel(reader, writer, target)
+                    return
+                try:
+                    resp = await self._forward(method, target, headers, body, upstream)
+                except (OSError, asyncio.IncompleteReadError, ValueError):
+                    upstream.clear()
+                    resp = b"HTTP/1.1 502 Bad Gateway\r\nContent-Length: 0\r\n\r\n"
+                writer.write(resp)
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            if upstream.get("w"):
+                upstream["w"].close()
+            writer.close()
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> int:
+        self.server = await asyncio.start_server(self._handle, host, port, backlog=1024)
+        return self.server.sockets[0].getsockname()[1]
+
+    async def close(self):
+        if self.server:
+            self.server.close()
+            await self.server.wait_closed()
+
+
+async def start_proxies(n: int, limit: float = 0, delay_ms: int = 0, host: str = "127.0.0.1",
+                        port: Optional[int] = None):
+    # n 個起動して (プロキシのリスト, EGRESS に渡す文字列) を返す
+    proxies, specs = [], []
+    for i in range(n):
+        p = StubProxy(limit, delay_ms)
+        bound = await p.start(host, (port + i) if port else 0)
+        proxies.append(p)
+        specs.append(f"http://{host}:{bound}")
+    return proxies, ",".join(specs)
+
+
+async def _serve(args):
+    proxies, spec = await start_proxies(args.count, args.limit, args.delay_ms, args.host, args.port)
+    print(f"[stub_proxy] EGRESS={spec}  limit={args.limit or '-'}/s delay={args.delay_ms}ms")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        for p in proxies:
+            print(f"[stub_proxy] requests={p.requests} blocked={p.blocked}")
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=8801, help="--count 個なら連番で使う")
+    ap.add_argument("--count", type=int, default=1)
+    ap.add_argument("--limit", type=float, default=0, help="1秒あたりの上限（超えたら 429）")
+    ap.add_argument("--delay-ms", type=int, default=0)
+    try:
+        asyncio.run(_serve(ap.parse_args()))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,186 @@
+# browser_pool.py
+# 確定ステージ用の「温めておく」Playwright ブラウザプール。
+# Chromium は1回だけ起動し、BrowserContext / Page を使い回して複数URLを並列に描画する。
+# 1ページを PW_RECYCLE_AFTER 回使ったら作り直してメモリ肥大を防ぐ。
+#
+# lean=True のときは画像・メディア・フォントと既知のサードパーティ（解析・広告）への通信を遮断し、
+# render_lean() で在庫あり/なしのセレクタが「決め手になる状態」になった時点で打ち切って
+# 該当ノードのテキストだけをブラウザ内で取り出す（DOM全体はシリアライズしない）。
+import asyncio, os
+from typing import Dict, List, Optional, Union
+from urllib.parse import urlsplit
+
+PW_MAX_PAGES = int(os.getenv("PW_MAX_PAGES", "4"))  # 同時に開くページ数の上限
+PW_CONTEXTS = int(os.getenv("PW_CONTEXTS", "2"))  # ページを振り分ける BrowserContext 数
+PW_RECYCLE_AFTER = int(os.getenv("PW_RECYCLE_AFTER", "20"))  # この回数使ったページは作り直す
+PW_WAIT_UNTIL = os.getenv("PW_WAIT_UNTIL", "networkidle")
+PW_LEAN = os.getenv("PW_LEAN", "1") == "1"
+PW_PROBE_POLL_MS = int(os.getenv("PW_PROBE_POLL_MS", "100"))
+PW_BLOCK_TYPES = {x.strip() for x in os.getenv("PW_BLOCK_TYPES", "image,media,font").split(",") if x.strip()}
+PW_BLOCK_HOSTS = [x.strip().lower() for x in os.getenv(
+    "PW_BLOCK_HOSTS",
+    "googletagmanager.com,google-analytics.com,doubleclick.net,googlesyndication.com,"
+    "facebook.net,facebook.com,analytics.tiktok.com,criteo.com,criteo.net,hotjar.com,"
+    "clarity.ms,bat.bing.com,scorecardresearch.com,yahoo.co.jp,line-scdn.net,sentry.io",
+).split(",") if x.strip()]
+
+# 在庫あり/なしノードのテキストを集め、決め手になる状態かどうかを判定する（ブラウザ内で実行）
+_PROBE_JS = """
+(spec) => {
+  const norm = (s) => (s || "").replace(/\\s+/g, " ").trim();
+  const collect = (css) => {
+    if (!css) return [];
+    try { return Array.from(document.querySelectorAll(css), (n) => norm(n.textContent)); }
+    catch (e) { return []; }
+  };
+  const hit = (texts, words) => texts.some((t) => words === null || words.some((w) => w && t.includes(w)));
+  const res = {in_texts: collect(spec.in_css), out_texts: collect(spec.out_css)};
+  // 在庫ありは見えた時点で確定。売り切れ表示は描画途中の可能性があるので load 完了後のみ確定
+  res.decisive = hit(res.in_texts, spec.in_words) ||
+    (document.readyState === "complete" && hit(res.out_texts, spec.out_words));
+  return (spec.final || res.decisive) ? res : null;
+}
+"""
+
+
+def _blocked_host(url: str) -> bool:
+    host = (urlsplit(url).hostname or "").lower()
+    return any(host == h or host.endswith("." + h) for h in PW_BLOCK_HOSTS)
+
+
+async def _route_filter(route):
+    req = route.request
+    if req.resource_type in PW_BLOCK_TYPES or _blocked_host(req.url):
+        await route.abort()
+    else:
+        await route.continue_()
+
+
+class _Slot:
+    __slots__ = ("context", "page", "uses")
+
+    def __init__(self, context, page):
+        self.context = context
+        self.page = page
+        self.uses = 0
+
+
+class BrowserPool:
+    def __init__(self, user_agent: str, timeout_ms: int, max_pages: int = PW_MAX_PAGES,
+                 contexts: int = PW_CONTEXTS, recycle_after: int = PW_RECYCLE_AFTER, lean: bool = PW_LEAN):
+        self.user_agent = user_agent
+        self.lean = lean
+        self.timeout_ms = timeout_ms
+        self.max_pages = max(1, max_pages)
+        self.n_contexts = max(1, min(contexts, self.max_pages))
+        self.recycle_after = max(1, recycle_after)
+        self._pw = None
+        self.browser = None
+        self.contexts: List = []
+        self._slots: Optional[asyncio.Queue] = None
+
+    async def start(self):
+        from playwright.async_api import async_playwright
+        try:
+            self._pw = await async_playwright().start()
+            self.browser = await self._pw.chromium.launch(headless=True)
+            for _ in range(self.n_contexts):
+                ctx = await self.browser.new_context(user_agent=self.user_agent, java_script_enabled=True)
+                if self.lean:
+                    await ctx.route("**/*", _route_filter)
+                self.contexts.append(ctx)
+            self._slots = asyncio.Queue()
+            for i in range(self.max_pages):
+                ctx = self.contexts[i % self.n_contexts]
+                self._slots.put_nowait(_Slot(ctx, await self._new_page(ctx)))
+        except BaseException:
+            # 起動途中で失敗したら（async with の __aexit__ は呼ばれないので）ここで片付ける
+            await self.close()
+            raise
+        return self
+
+    async def _new_page(self, ctx):
+        page = await ctx.new_page()
+        page.set_default_timeout(self.timeout_ms)
+        return page
+
+    async def _recycle(self, slot: _Slot):
+        if slot.page is not None:
+            try:
+                await slot.page.close()
+            except Exception:
+                pass
+        slot.page = None
+        slot.page = await self._new_page(slot.context)
+        slot.uses = 0
+
+    async def _with_page(self, fn):
+        slot = await self._slots.get()
+        try:
+            if slot.page is None:
+                # 前回の作り直しに失敗したスロット → 使う前にもう一度作る（失敗すればこの呼び出しのエラー）
+                await self._recycle(slot)
+            slot.uses += 1
+            try:
+                return await fn(slot.page)
+            except Exception:
+                # 失敗したページは状態が怪しいので次回使う前に作り直す
+                slot.uses = self.recycle_after
+                raise
+        finally:
+            try:
+                if slot.page is not None and slot.uses >= self.recycle_after:
+                    await self._recycle(slot)
+            except Exception as e:
+                # 作り直せなくてもスロットは必ず戻す（戻さないとプールが縮んで get() が永久に待つ）
+                print(f"[browser_pool] cannot recreate page: {e}")
+            finally:
+                self._slots.put_nowait(slot)
+
+    async def render(self, url: str) -> str:
+        async def go(page):
+            await page.goto(url, wait_until=PW_WAIT_UNTIL)
+            return await page.content()
+        return await self._with_page(go)
+
+    async def render_lean(self, url: str, in_css: Optional[str], in_words: Optional[List[str]],
+                          out_css: Optional[str], out_words: Optional[List[str]]) -> Dict[str, List[str]]:
+        # words が None のときは「セレクタに一致するノードがあるだけで決め手」扱い（decide_stock と同じ）
+        spec = {"in_css": in_css or "", "in_words": in_words, "out_css": out_css or "",
+                "out_words": out_words, "final": False}
+
+        async def go(page):
+            await page.goto(url, wait_until="commit")
+            try:
+                handle = await page.wait_for_function(_PROBE_JS, arg=spec, polling=PW_PROBE_POLL_MS)
+                return await handle.json_value()
+            except Exception as e:
+                if "Timeout" not in type(e).__name__:
+                    raise
+                # 時間内に決め手が出なかった → その時点のテキストで判定（多くは不明）
+                return await page.evaluate(_PROBE_JS, {**spec, "final": True})
+        return await self._with_page(go)
+
+    async def render_many(self, urls: List[str]) -> Dict[str, Union[str, Exception]]:
+        results = await asyncio.gather(*(self.render(u) for u in urls), return_exceptions=True)
+        return dict(zip(urls, results))
+
+    async def close(self):
+        for ctx in self.contexts:
+            try:
+                await ctx.close()
+            except Exception:
+                pass
+        self.contexts = []
+        if self.browser:
+            await self.browser.close()
+            self.browser = None
+        if self._pw:
+            await self._pw.stop()
+            self._pw = None
+
+    async def __aenter__(self):
+        return await self.start()
+
+    async def __aexit__(self, *exc):
+        await self.close()
@@ -1,19 +1,45 @@
 # check_stock_aio.py
-import asyncio, aiohttp, json, os, hashlib, random, time
+import asyncio, codecs, json, os, hashlib, random, re, time
 from pathlib import Path
 
-DEFAULT_IN_WORDS = ["カートに追加する", "今すぐ購入", "Add to cart", "Buy now"]
-DEFAULT_OUT_WORDS = ["在庫切れ", "売り切れ", "SOLD OUT", "在庫なし", "再入荷を通知"]
+from collection import extract_items, is_collection, items_digest
+from confirm_queue import ConfirmQueue
+import egress
+import metrics
+from fingerprint import compute_fingerprint
+import history_log
+from http_transport import ACCEPT_ENCODING, build_session as _build_session
+from json_probe import is_probe, probe_document, values_digest
+from scheduler import HostBudgets
+from sharding import shard_path, shard_targets
+from state_store import open_store, without_owned
+from stock_rules import DEFAULT_IN_WORDS, DEFAULT_OUT_WORDS, keyword_matcher
+from subscriptions import dedupe_targets
+import validators
+import worker_pool
 
 ROOT = Path(__file__).resolve().parent
-F_STATE = ROOT / "state.json"
-F_HDRS  = ROOT / "headers_cache.json"
+F_STATE = shard_path(ROOT / "state.json")
+F_HDRS  = shard_path(ROOT / "headers_cache.json")
 F_NEED  = ROOT / "needs_confirm.json"
 F_TARGETS = ROOT / "targets.json"
 
 MAX_CONC = int(os.getenv("MAX_CONCURRENCY", "8"))
+MAX_PER_HOST = int(os.getenv("MAX_PER_HOST", str(min(MAX_CONC, 4))))  # 同一ホストへの同時接続上限
 REQUEST_TIMEOUT = int(os.getenv("REQUEST_TIMEOUT_SEC", "12"))
 TRIGGER_ON_BOTH = os.getenv("TRIGGER_ON_BOTH", "0") == "1"  # Trueなら在庫あり/なし両方を確定へ
+KEEPALIVE_SEC = int(os.getenv("KEEPALIVE_SEC", "60"))
+# Cache-Control: no-cache は CDN に古いページを返されるサイトだけで十分（ターゲットの no_cache でも指定可）
+FORCE_NO_CACHE = os.getenv("FORCE_NO_CACHE", "0") == "1"
+
+# ストリーミング取得: チャンクごとにデコード・文言走査・ハッシュ更新し、決め手が出たら接続を切る
+STREAM_FETCH = os.getenv("STREAM_FETCH", "1") == "1"
+STREAM_CHUNK = int(os.getenv("STREAM_CHUNK", "16384"))
+STREAM_MAX_BYTES = int(os.getenv("STREAM_MAX_BYTES", "0"))  # 0: 上限なし（ターゲットの max_bytes で個別指定可）
+STREAM_STOP_ON_OUT = os.getenv("STREAM_STOP_ON_OUT", "0") == "1"  # 売切ワードでも打ち切る（ターゲットの stream_stop_on_out）
+HASH_CHARS = 200000  # 先頭20万文字で十分
+
+_META_CHARSET = re.compile(rb"""<meta[^>]+charset=["']?([A-Za-z0-9_\-]+)""", re.IGNORECASE)
 
 def load_json(p: Path, default):
     try:
@@ -29,20 +55,122 @@ def save_json(p: Path, data):
 def blake2s(text: str) -> str:
     return hashlib.blake2s(text.encode("utf-8", errors="ignore")).hexdigest()
 
-def decide_in_stock(html: str, target: dict) -> bool:
+def target_matcher(target: dict):
+    # target_registry の CompiledTarget はコンパイル済みのマッチャを持っている
+    if (m := getattr(target, "matcher", None)) is not None:
+        return m
     words_in = target.get("in_stock_text_contains") or DEFAULT_IN_WORDS
     words_out = target.get("out_of_stock_text_contains") or DEFAULT_OUT_WORDS
-    html_lower = html.lower()
-    # 優先：在庫ありワードを1つでも含む
-    if any(w.lower() in html_lower for w in words_in):
-        return True
-    # 明確な売切ワードがあればオフ
-    if any(w.lower() in html_lower for w in words_out):
-        return False
+    return keyword_matcher(words_in, words_out)
+
+def decide_in_stock(html: str, target: dict) -> bool:
+    # 優先：在庫ありワードを1つでも含む / 明確な売切ワードがあればオフ（大文字小文字無視・1パス）
     # 不明は「前回のまま」に任せるのでここでは False（変化検知はハッシュで拾う）
-    return False
+    return target_matcher(target).decide(html) is True
+
+def _incremental_decoder(r, first_chunk: bytes):
+    # Content-Type の charset → <meta charset> → utf-8 の順で決める
+    enc = r.charset
+    if not enc:
+        m = _META_CHARSET.search(first_chunk[:4096])
+        enc = m.group(1).decode("ascii") if m else "utf-8"
+    try:
+        return codecs.getincrementaldecoder(enc)(errors="ignore")
+    except LookupError:
+        return codecs.getincrementaldecoder("utf-8")(errors="ignore")
+
+def analyze_body(raw: bytes, charset, target: dict):
+    # バッファ済みの本文から (在庫あり?, ハッシュ) を出す。DECIDE_WORKERS>0 ならワーカープロセスで動く
+    enc = charset
+    if not enc:
+        m = _META_CHARSET.search(raw[:4096])
+        enc = m.group(1).decode("ascii") if m else "utf-8"
+    try:
+        text = raw.decode(enc, errors="ignore")
+    except LookupError:
+        text = raw.decode("utf-8", errors="ignore")
+    in_stock = decide_in_stock(text, target)
+    h = blake2s(text[:HASH_CHARS])
+    if fp_spec := target.get("fingerprint"):
+        try:
+            h = compute_fingerprint(text, fp_spec)
+        except Exception as e:
+            print(f"[fingerprint] {target.get('name', target['url'])}: {e}")
+    return in_stock, h
+
+async def read_streaming(r, target: dict, keep_text: bool = False, timings: dict = None):
+    # 本文をチャンク単位で読み、文言マッチとハッシュを逐次進める。
+    # 在庫ありワード（または stream_stop_on_out 時の売切ワード）が見えて、かつ先頭 HASH_CHARS 文字の
+    # ハッシュが済んだか、max_bytes に達した時点で読むのをやめて接続を閉じる。
+    # ハッシュはチャンクの切れ目によらず先頭 HASH_CHARS 文字（全文を読んだときと同じ）。
+    # max_bytes で先に打ち切った場合は途中までのハッシュになるので hash=None を返す（在庫だけで比べる）。
+    # keep_text=True（指紋に本文が要る）のときは文言では打ち切らず、本文も返す。
+    matcher = target_matcher(target)
+    stop_on_out = target.get("stream_stop_on_out", STREAM_STOP_ON_OUT)
+    max_bytes = int(target.get("max_bytes", STREAM_MAX_BYTES))
+    overlap = max(0, matcher.max_len - 1)
+
+    hasher = hashlib.blake2s()
+    hashed = 0
+    tail = ""
+    found_in = found_out = False
+    nbytes = 0
+    decoder = None
+    early = False
+    texts = []
+
+    tm = {"decode": 0.0, "hash": 0.0, "decide": 0.0}
+    perf = time.perf_counter
 
-async def fetch_one(session: aiohttp.ClientSession, target: dict, hdrs_cache: dict, prev_state: dict):
+    def feed(text: str):
+        nonlocal hashed, tail, found_in, found_out
+        if keep_text:
+            texts.append(text)
+        t0 = perf()
+        if hashed < HASH_CHARS:
+            part = text[:HASH_CHARS - hashed]
+            hasher.update(part.encode("utf-8", errors="ignore"))
+            hashed += len(part)
+        t1 = perf()
+        window = tail + text
+        fi, fo = matcher.scan(window)
+        found_in = found_in or fi
+        found_out = found_out or fo
+        tail = window[-overlap:] if overlap else ""
+        tm["hash"] += t1 - t0
+        tm["decide"] += perf() - t1
+
+    started = perf()
+    async for chunk in r.content.iter_chunked(STREAM_CHUNK):
+        if decoder is None:
+            decoder = _incremental_decoder(r, chunk)
+        nbytes += len(chunk)
+        t0 = perf()
+        text = decoder.decode(chunk)
+        tm["decode"] += perf() - t0
+        feed(text)
+        decisive = (found_in or (found_out and stop_on_out)) and hashed >= HASH_CHARS
+        if (decisive and not keep_text) or (max_bytes and nbytes >= max_bytes):
+            early = not r.content.at_eof()
+            break
+    if decoder is not None and not early:
+        feed(decoder.decode(b"", final=True))
+    if early:
+        # 残りは読まずに接続ごと捨てる
+        r.close()
+    if timings is not None:
+        # transfer は受信待ちの時間（デコード・判定・ハッシュを除いた分）
+        timings["transfer"] = perf() - started - sum(tm.values())
+        timings.update(tm)
+
+    complete = not early or hashed >= HASH_CHARS
+    body = {"in_stock": found_in, "hash": hasher.hexdigest() if complete else None, "bytes": nbytes, "early": early}
+    if keep_text:
+        body["text"] = "".join(texts)
+    return body
+
+async def fetch_one(session, target: dict, hdrs_cache: dict, prev_state: dict):
+    # session: http_transport.build_session() の戻り値（aiohttp.ClientSession か HttpxSession）
     url = target["url"]
     name = target.get("name", url)
     cached = hdrs_cache.get(url, {})
@@ -51,108 +179,252 @@ async def fetch_one(session: aiohttp.ClientSession, target: dict, hdrs_cache: di
                       "(KHTML, like Gecko) Chrome/124.0.0.0 Safari/537.36",
         "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8",
         "Accept-Language": "ja-JP,ja;q=0.9,en;q=0.8",
-        "Cache-Control": "no-cache",
+        "Accept-Encoding": ACCEPT_ENCODING,
     }
-    if et := cached.get("etag"):
-        headers["If-None-Match"] = et
-    if lm := cached.get("last_modified"):
-        headers["If-Modified-Since"] = lm
+    if target.get("no_cache", FORCE_NO_CACHE):
+        headers["Cache-Control"] = "no-cache"
+    if is_probe(target) and target.get("type") == "json":
+        headers["Accept"] = "application/json, text/plain, */*"
+    # 検証子は 304 が返ってくる URL にだけ付ける（プロファイルは validators.py）
+    cond = validators.conditional_headers(cached)
+    headers.update(cond)
+    obs = {"sent": bool(cond)}
 
+    tm = {}
+    t_start = time.perf_counter()
     try:
+        if kind := validators.probe_kind(cached):
+            # 304 は効かないが検証子は当てになる → HEAD / 1バイトの Range で検証子だけ見る
+            with metrics.timer("probe", url, tm):
+                obs.update(await probe_validators(session, url, headers, kind, cached))
+            metrics.inc("probe_total", result=obs["probe_result"])
+            if obs["probe_result"] == "same":
+                return {"url": url, "name": name, "status": "not_modified", "timings": tm, "validator": obs}
+            t_start = time.perf_counter()
         async with session.get(url, headers=headers, timeout=REQUEST_TIMEOUT) as r:
             status = r.status
+            tm["ttfb"] = time.perf_counter() - t_start
+            metrics.stage("ttfb", tm["ttfb"], url)
             # 304: 変更なし → 現状維持
             if status == 304:
-                return {"url": url, "name": name, "status": "not_modified"}
+                return {"url": url, "name": name, "status": "not_modified", "timings": tm, "validator": obs}
+            if status >= 400:
+                # 429 / 403 / 5xx はエラー扱い（本文を判定して「在庫なし」にしない。出口の冷却は egress.py）
+                return {"url": url, "name": name, "status": "error", "http": status, "error": f"HTTP {status}",
+                        "timings": tm, "validator": obs}
 
-            text = await r.text(errors="ignore")
-            # ヘッダキャッシュ更新
-            new_cache = {}
-            etag = r.headers.get("ETag") or r.headers.get("etag")
-            lastm = r.headers.get("Last-Modified") or r.headers.get("last-modified")
-            if etag: new_cache["etag"] = etag
-            if lastm: new_cache["last_modified"] = lastm
+            # 検証子・キャッシュ関連ヘッダ（プロファイル更新用）
+            obs["meta"] = validators.response_meta(r.headers)
 
-            in_stock = decide_in_stock(text, target)
-            h = blake2s(text[:200000])  # 先頭20万文字で十分
+            fp_spec = target.get("fingerprint")
+            items = None
+            if is_collection(target):
+                # 一覧ページ1枚から商品ごとの在庫を取り出す
+                with metrics.timer("transfer", url, tm):
+                    raw = await r.read() if target.get("extractor") == "json" else await r.text(errors="ignore")
+                with metrics.timer("decide", url, tm):
+                    items = [{**it, "in_stock": it["in_stock"] is True}
+                             for it in await worker_pool.offload(extract_items, raw, target)]
+                in_stock, h, fp_spec = any(it["in_stock"] for it in items), items_digest(items), None
+            elif is_probe(target):
+                # JSON API / 埋め込みデータから直接在庫を読む（ブラウザ不要）
+                with metrics.timer("transfer", url, tm):
+                    raw = await r.read()
+                with metrics.timer("decide", url, tm):
+                    decision, values = await worker_pool.offload(probe_document, raw, target)
+                in_stock, h, fp_spec = decision is True, values_digest(values), None
+            elif worker_pool.enabled():
+                # 判定・ハッシュ・指紋はワーカープロセスで（パースでイベントループを止めない）。
+                # 本文は丸ごと渡すので、ストリーミングの途中打ち切りはしない
+                with metrics.timer("transfer", url, tm):
+                    raw = await r.read()
+                with metrics.timer("decide", url, tm):
+                    in_stock, h = await worker_pool.offload(analyze_body, raw, r.charset, target)
+                fp_spec = None
+            elif STREAM_FETCH:
+                body = await read_streaming(r, target, keep_text=bool(fp_spec), timings=tm)
+                in_stock, h, text = body["in_stock"], body["hash"], body.get("text")
+                for k in ("transfer", "decode", "decide", "hash"):
+                    metrics.stage(k, tm[k], url)
+            else:
+                with metrics.timer("transfer", url, tm):
+                    text = await r.text(errors="ignore")
+                with metrics.timer("decide", url, tm):
+                    in_stock = decide_in_stock(text, target)
+                with metrics.timer("hash", url, tm):
+                    h = blake2s(text[:HASH_CHARS])
+            if fp_spec:
+                # 在庫表示の領域だけをハッシュする（揺らぐトークン等で changed にしない）
+                try:
+                    with metrics.timer("fingerprint", url, tm):
+                        h = compute_fingerprint(text, fp_spec)
+                except Exception as e:
+                    print(f"[fingerprint] {name}: {e}")
 
             # 前回状態
             prev = prev_state.get(url, {})
             prev_stock = prev.get("in_stock")
             prev_hash  = prev.get("hash")
 
+            if h is None:
+                # ハッシュを取りきれなかった（max_bytes で打ち切り）→ 前回のハッシュのまま、在庫だけで比べる
+                h = prev_hash
+
             # 差分判断
             changed = (h != prev_hash) or (in_stock != prev_stock)
 
             # 次回用に保存
             # （プレーンな在庫判定に加えて、軽量段階ではhashも保存）
             result_state = {"in_stock": in_stock, "hash": h, "name": name, "ts": int(time.time())}
-            return {
+            res = {
                 "url": url, "name": name, "status": "ok", "http": status,
-                "in_stock": in_stock, "hash": h, "changed": changed, "cache_hdrs": new_cache,
+                "in_stock": in_stock, "hash": h, "changed": changed, "validator": obs,
+                "timings": tm,
             }
+            if items is not None:
+                res["items"] = items
+            return res
     except Exception as e:
-        return {"url": url, "name": name, "status": "error", "error": str(e)}
+        return {"url": url, "name": name, "status": "error", "error": str(e), "timings": tm, "validator": obs}
+
+async def probe_validators(session, url: str, headers: dict, kind: str, cached: dict) -> dict:
+    # 本文を取らずに検証子だけ取得して前回と比べる。HEAD / Range を受け付けないサイトは failed
+    try:
+        if kind == "head":
+            req = session.head(url, headers=headers, timeout=REQUEST_TIMEOUT, allow_redirects=True)
+        else:
+            req = session.get(url, headers={**headers, "Range": "bytes=0-0"}, timeout=REQUEST_TIMEOUT)
+        async with req as r:
+            ok = r.status == (200 if kind == "head" else 206)
+            meta = validators.response_meta(r.headers)
+    except Exception:
+        ok = False
+    if not ok:
+        return {"probe": kind, "probe_result": "failed"}
+    return {"probe": kind, "probe_result": "same" if validators.same_validators(cached, meta) else "changed"}
+
+def build_session():
+    # HTTP_TRANSPORT=httpx なら HTTP/2（同一ホストは1接続に多重化）、既定は aiohttp
+    # EGRESS を設定していれば、出口ごとのセッションを持ってリクエストごとに出口を選ぶ
+    if egress.configured():
+        return egress.EgressSession(egress.get_pool(), lambda proxy, source: _build_session(
+            MAX_CONC, MAX_PER_HOST, REQUEST_TIMEOUT + 2, KEEPALIVE_SEC, proxy=proxy, local_addr=source))
+    return _build_session(MAX_CONC, MAX_PER_HOST, REQUEST_TIMEOUT + 2, KEEPALIVE_SEC)
+
+def _apply_row(url: str, name: str, in_stock, h: str, prev_state: dict, new_state: dict, extra=None):
+    # 1行分の state 更新。戻り値: (行が変わったか, 確定チェックへ回すべきか)
+    prev = prev_state.get(url, {})
+    prev_stock = prev.get("in_stock")
+    changed = (h != prev.get("hash")) or (in_stock != prev_stock)
+    dirty = changed or (prev.get("name") != name)
+    if "in_stock" in prev:
+        history_log.transition(url, prev_stock, in_stock)
+    new_state[url] = {**prev, "in_stock": in_stock, "hash": h, "name": name, "ts": int(time.time()), **(extra or {})}
+    # 既定：在庫あり化のみトリガ。両方トリガしたい場合は env TRIGGER_ON_BOTH=1
+    return dirty, changed and ((in_stock and not prev_stock) or TRIGGER_ON_BOTH)
+
+def observe_result(res: dict):
+    # カウンタと（LOG_FORMAT=json のとき）1件ごとの構造化ログ
+    metrics.inc("fetch_total", status=res["status"], **metrics.target_label(res["url"]))
+    history_log.poll(res["url"], res["status"])
+    if metrics.LOG_FORMAT == "json":
+        metrics.log("fetch", url=res["url"], name=res["name"], status=res["status"], http=res.get("http"),
+                    in_stock=res.get("in_stock"), changed=res.get("changed"),
+                    ms={k: round(v * 1000, 2) for k, v in res.get("timings", {}).items()})
+
+def apply_result(res: dict, prev_state: dict, new_state: dict, new_hdrs: dict):
+    # 1件の取得結果を state / headers に反映する
+    # 戻り値: (永続化が必要なURLのリスト, 確定チェック用 needs エントリのリスト)
+    observe_result(res)
+    url = res["url"]
+    prev_hash = prev_state.get(url, {}).get("hash")
+    hash_changed = res["hash"] != prev_hash if res["status"] == "ok" and prev_hash is not None else None
+    # 検証子プロファイルはメモリ上では毎回更新し、書き出しは意味のある変化か一定間隔ごと
+    new_hdrs[url], hdrs_dirty = validators.observe(new_hdrs.get(url, {}), res, hash_changed)
+    if res["status"] == "ok":
+        dirty_urls, needs = [], []
+        # 確定ステージは検知前の在庫状態と比べて通知を決めるので、state を書き換える前の値を持たせる
+        prev_stock = prev_state.get(url, {}).get("in_stock")
+        dirty, trigger = _apply_row(url, res["name"], res["in_stock"], res["hash"], prev_state, new_state)
+        if dirty or hdrs_dirty:
+            dirty_urls.append(url)
+        if "items" in res:
+            # 一覧ページは商品ごとに在庫遷移を見る（一覧ページ自体は確定へ回さない）
+            for it in res["items"]:
+                item_prev = prev_state.get(it["url"], {}).get("in_stock")
+                item_dirty, item_trigger = _apply_row(it["url"], it["name"], it["in_stock"], it["hash"],
+                                                      prev_state, new_state, {"collection": url})
+                if item_dirty:
+                    dirty_urls.append(it["url"])
+                if item_trigger:
+                    needs.append({"url": it["url"], "name": it["name"], "collection": url, "prev": item_prev})
+        elif trigger:
+            needs.append({"url": url, "name": res["name"], "prev": prev_stock})
+        if needs:
+            metrics.inc("escalations_total", len(needs))
+        return dirty_urls, needs
+    elif res["status"] == "not_modified":
+        # 変化無し → state はそのまま
+        return [url] if hdrs_dirty else [], []
+    # errorはログだけ（必要なら後で通知）
+    metrics.inc("errors_total", stage="fetch")
+    metrics.log("error", name=res["name"], url=url, error=res.get("error"))
+    return [url] if hdrs_dirty else [], []
+
+def persist(store, urls, state: dict, hdrs: dict):
+    # 変化のあったURLの行だけを書き込む（通知時刻は確定ステージの持ち物なので書かない）
+    if not urls:
+        return
+    with metrics.timer("state_write"):
+        store.update({u: without_owned(state[u]) for u in urls if u in state})
+        store.update_headers({u: hdrs[u] for u in urls if u in hdrs})
+
+def queue_needs(needs: list):
+    # 確定待ちキューに追記（URLで重複排除、消化は確定ステージが ack する）
+    added = ConfirmQueue(F_NEED).enqueue(needs)
+    print(f"[needs_confirm] {len(needs)} target(s) queued ({added} new).")
 
 async def main():
-    targets = load_json(F_TARGETS, [])
+    targets = shard_targets(dedupe_targets(load_json(F_TARGETS, [])))
     if not targets:
         print("no targets.json entries")
         return
 
-    hdrs_cache = load_json(F_HDRS, {})
-    prev_state = load_json(F_STATE, {})
+    metrics.serve()
+    store = open_store(F_STATE, F_HDRS)
+    hdrs_cache = store.load_headers()
+    prev_state = store.load()
     needs = []
 
-    conn = aiohttp.TCPConnector(limit_per_host=MAX_CONC, limit=MAX_CONC, ttl_dns_cache=300)
-    timeout = aiohttp.ClientTimeout(total=REQUEST_TIMEOUT+2)
-    async with aiohttp.ClientSession(connector=conn, timeout=timeout) as session:
+    budgets = HostBudgets(scale=egress.exit_count())
+
+    async def budgeted(session, t):
+        await budgets.acquire(t["url"])
+        return await fetch_one(session, t, hdrs_cache, prev_state)
+
+    async with build_session() as session:
         # 軽いジッター（順番分散）
         random.shuffle(targets)
-        tasks = [fetch_one(session, t, hdrs_cache, prev_state) for t in targets]
+        tasks = [budgeted(session, t) for t in targets]
         results = await asyncio.gather(*tasks)
 
     # 収集＆保存
     new_state = dict(prev_state)
     new_hdrs  = dict(hdrs_cache)
 
+    dirty_urls = []
     for res in results:
-        url = res["url"]
-        if res["status"] == "ok":
-            # 状態更新
-            new_state[url] = {"in_stock": res["in_stock"], "hash": res["hash"], "name": res["name"], "ts": int(time.time())}
-            if res.get("cache_hdrs"):
-                new_hdrs[url] = {**new_hdrs.get(url, {}), **res["cache_hdrs"]}
-            # 変化があれば確定チェックへ
-            prev = prev_state.get(url, {})
-            prev_stock = prev.get("in_stock")
-            now_stock = res["in_stock"]
-            if res["changed"]:
-                # 既定：在庫あり化のみトリガ。両方トリガしたい場合は env TRIGGER_ON_BOTH=1
-                if (now_stock and not prev_stock) or TRIGGER_ON_BOTH:
-                    needs.append({"url": url, "name": res["name"]})
-        elif res["status"] == "not_modified":
-            # 変化無し → 何もしない
-            pass
-        else:
-            # errorはログだけ（必要なら後で通知）
-            print(f"[error] {res['name']}: {res.get('error')}")
+        dirty, new_needs = apply_result(res, prev_state, new_state, new_hdrs)
+        dirty_urls.extend(dirty)
+        needs.extend(new_needs)
 
-    # ファイル反映
-    save_json(F_STATE, new_state)
-    save_json(F_HDRS, new_hdrs)
+    # 変化した行だけ反映
+    persist(store, dirty_urls, new_state, new_hdrs)
+    store.close()
+    history_log.flush()
+    history_log.rollup_if_due()
     if needs:
-        # 既存needsに追記（重複は除外）
-        old = load_json(F_NEED, [])
-        before = {(x["url"], x.get("name")) for x in old}
-        for n in needs:
-            if (n["url"], n.get("name")) not in before:
-                old.append(n)
-        save_json(F_NEED, old)
-        print(f"[needs_confirm] {len(needs)} target(s) queued.")
-    else:
-        # 変化なし → 空ファイルは残してOK（サイズ0にしておく）
-        F_NEED.write_text("", encoding="utf-8")
+        queue_needs(needs)
 
 if __name__ == "__main__":
     asyncio.run(main())
@@ -0,0 +1,233 @@
+# check_stock_daemon.py
+# check_stock_aio を常駐プロセスとして回すデーモン。
+# start.sh のように毎回 python を起動し直すのではなく、
+#   - ClientSession（keep-alive プール / DNS キャッシュ）を1つだけ保持
+#   - state / headers_cache はメモリ上に保持
+#   - ターゲットごとにジッター付きタイマーで個別にポーリング（間隔は scheduler.py で適応的に調整）
+#   - 変化があったURLの行だけを state_store へ書き出し
+#   - 過去の再入荷から学習した時間帯（history_log.py）を HISTORY_LEARN_SEC ごとに取り直してスケジューラへ
+#   - targets.json は TARGETS_RELOAD_SEC ごとに見て、追加・削除・変更されたターゲットだけを反映する
+#     （target_registry.py。取得中のポーリングは止めず、変更・削除は次の周から効く）
+import asyncio, os, random, shlex, signal, sys
+
+import check_stock_aio as aio
+import egress
+import history_log
+import metrics
+from confirm_queue import ConfirmQueue
+from scheduler import AdaptiveScheduler, HostBudgets
+from state_store import open_store
+from target_registry import TARGETS_RELOAD_SEC, Diff, TargetRegistry
+
+POLL_MS = int(os.getenv("POLL_INTERVAL_MS", "500"))
+JITTER_MS = int(os.getenv("JITTER_MS", "200"))
+FLUSH_INTERVAL_MS = int(os.getenv("FLUSH_INTERVAL_MS", "1000"))  # 書き出しをまとめる間隔
+HISTORY_LEARN_SEC = int(os.getenv("HISTORY_LEARN_SEC", "3600"))  # 学習したウィンドウを取り直す間隔
+CONFIRM_CMD = os.getenv("CONFIRM_CMD", shlex.join([sys.executable, str(aio.ROOT / "check_stock_playwright.py")]))
+CONFIRM_RETRY_SEC = float(os.getenv("CONFIRM_RETRY_SEC", "30"))  # 失敗して戻った分だけが残っているときの再実行の間隔
+CONFIRM_RETRY_MAX_SEC = float(os.getenv("CONFIRM_RETRY_MAX_SEC", "300"))  # 続けて失敗したら倍々にする上限
+
+
+class Daemon:
+    def __init__(self, targets: list, registry: TargetRegistry = None):
+        self.registry = registry
+        self.by_url = {t["url"]: t for t in targets}
+        self.pollers = {}
+        self.store = open_store(aio.F_STATE, aio.F_HDRS)
+        self.state = self.store.load()
+        self.hdrs = self.store.load_headers()
+        self.dirty_urls = set()
+        self.needs = []
+        self.confirm_task = None
+        self.confirm_pending = False
+        self.confirm_wake = asyncio.Event()
+        self.stopping = asyncio.Event()
+        self.scheduler = AdaptiveScheduler()
+        self.budgets = HostBudgets(scale=egress.exit_count())
+
+    @property
+    def targets(self) -> list:
+        return list(self.by_url.values())
+
+    async def poll_target(self, session, url: str):
+        # 起動直後の一斉アクセスを避けるため初回もずらす
+        await asyncio.sleep(random.uniform(0, POLL_MS / 1000))
+        while not self.stopping.is_set():
+            # targets.json で変更されていれば次の周から新しい設定、削除されていれば終わる
+            target = self.by_url.get(url)
+            if target is None:
+                return
+            try:
+                await self.budgets.acquire(target["url"])
+                res = await aio.fetch_one(session, target, self.hdrs, self.state)
+                dirty, needs = aio.apply_result(res, self.state, self.state, self.hdrs)
+                self.dirty_urls.update(dirty)
+                if needs:
+                    await self.escalate(needs)
+            except Exception as e:
+                # 想定外の例外でもこのターゲットのポーリングは止めない（エラーとして間隔を伸ばす）
+                print(f"[error] poll {target.get('name', url)}: {e!r}")
+                metrics.inc("errors_total", stage="poll")
+                res = {"url": url, "name": target.get("name", url), "status": "error", "error": str(e)}
+            self.scheduler.observe(target, res)
+            await asyncio.sleep(self.scheduler.next_delay(target))
+
+    def start_poller(self, session, url: str):
+        # 削除直後に同じ URL が戻ってきた場合は、まだ回っているポーラーがそのまま拾う
+        task = self.pollers.get(url)
+        if task is None or task.done():
+            self.pollers[url] = asyncio.create_task(self.poll_target(session, url))
+
+    def apply_targets(self, session, diff: Diff):
+        self.pollers = {u: t for u, t in self.pollers.items() if not t.done()}
+        for url in diff.removed:
+            self.by_url.pop(url, None)
+            self.scheduler.forget(url)
+        for t in diff.changed:
+            self.by_url[t["url"]] = t
+            self.scheduler.forget(t["url"])  # poll_ms / drop_windows 等を読み直す
+        for t in diff.added:
+            self.by_url[t["url"]] = t
+            self.start_poller(session, t["url"])
+        print(f"[targets] reloaded: {diff} ({len(self.by_url)} target(s))")
+        metrics.set_gauge("targets", len(self.by_url))
+
+    async def watcher(self, session):
+        while self.registry is not None and TARGETS_RELOAD_SEC > 0 and not self.stopping.is_set():
+            try:
+                await asyncio.wait_for(self.stopping.wait(), TARGETS_RELOAD_SEC)
+            except asyncio.TimeoutError:
+                pass
+            if not self.stopping.is_set() and (diff := self.registry.poll()):
+                self.apply_targets(session, diff)
+
+    async def escalate(self, needs: list):
+        # 確定チェックへ回す。デーモンは flush でファイルのキューに積み、確定ステージを別プロセスで起動する
+        self.needs.extend(needs)
+
+    def flush(self):
+        if self.dirty_urls:
+            # 変化したURLの行だけを書く（確定ステージの通知時刻は上書きしない）
+            urls, self.dirty_urls = self.dirty_urls, set()
+            aio.persist(self.store, urls, self.state, self.hdrs)
+        if self.needs:
+            aio.queue_needs(self.needs)
+            self.needs = []
+            self.kick_confirm()
+
+    def kick_confirm(self):
+        # 確定ステージは同時に1つだけ。実行中なら終了後にもう一度回す
+        if self.confirm_task and not self.confirm_task.done():
+            self.confirm_pending = True
+            self.confirm_wake.set()
+            return
+        self.confirm_task = asyncio.create_task(self.run_confirm())
+
+    async def wait_retry(self, delay: float):
+        # 再実行まで待つ。新しく積まれた（kick_confirm）か止めるときは待たない
+        self.confirm_wake.clear()
+        waits = [asyncio.create_task(self.confirm_wake.wait()), asyncio.create_task(self.stopping.wait())]
+        try:
+            await asyncio.wait(waits, timeout=delay, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for w in waits:
+                w.cancel()
+
+    async def run_confirm(self):
+        retries = 0
+        while True:
+            self.confirm_pending = False
+            print("[trigger] running heavy confirm...")
+            try:
+                with metrics.timer("confirm"):
+                    # シェルは通さずに実行する（CONFIRM_CMD は shlex の規則で分割）
+                    proc = await asyncio.create_subprocess_exec(*shlex.split(CONFIRM_CMD), cwd=str(aio.ROOT))
+                    await proc.wait()
+                metrics.inc("confirm_runs_total", exit=proc.returncode)
+            except Exception as e:
+                print(f"[error] heavy confirm: {e}")
+            if self.stopping.is_set():
+                return
+            if self.confirm_pending:
+                # 実行中に新しく積まれた → すぐにもう一周
+                continue
+            if not ConfirmQueue(aio.F_NEED).pending():
+                return
+            # 失敗して戻された分（nack）だけが残っている → 間を空けてからもう一周
+            # （すぐに回すと CONFIRM_MAX_ATTEMPTS を数秒で使い切り、そのたびに Chromium を起動してしまう）
+            retries += 1
+            delay = min(CONFIRM_RETRY_MAX_SEC, CONFIRM_RETRY_SEC * 2 ** (retries - 1))
+            print(f"[trigger] {delay:.0f}s until retrying failed confirm(s)")
+            await self.wait_retry(delay)
+            if self.stopping.is_set():
+                return
+
+    async def learner(self):
+        # 過去の再入荷が多い曜日・時間帯は最短間隔で回す（学習はファイルを読むのでスレッドで）。
+        # 古い取得結果の集計もここで（ファイル全体を書き直すので、イベントループを止めないようにスレッドで）
+        while history_log.HISTORY and not self.stopping.is_set():
+            if rolled := await asyncio.to_thread(history_log.rollup_if_due):
+                print(f"[history] rolled up {rolled} poll record(s)")
+            try:
+                learned = await asyncio.to_thread(history_log.learned_windows, self.targets, dict(self.state))
+                self.scheduler.learn(learned)
+                if learned:
+                    print(f"[history] learned drop windows for {len(learned)} target(s)")
+            except Exception as e:
+                print(f"[history] learn error: {e}")
+            try:
+                await asyncio.wait_for(self.stopping.wait(), HISTORY_LEARN_SEC)
+            except asyncio.TimeoutError:
+                pass
+
+    async def flusher(self):
+        while not self.stopping.is_set():
+            try:
+                await asyncio.wait_for(self.stopping.wait(), FLUSH_INTERVAL_MS / 1000)
+            except asyncio.TimeoutError:
+                pass
+            await asyncio.to_thread(history_log.flush)
+            self.flush()
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, self.stopping.set)
+            except NotImplementedError:
+                pass
+
+        print(f"[daemon] {len(self.targets)} target(s), {POLL_MS}ms ± {JITTER_MS}ms")
+        metrics.serve()
+        metrics.set_gauge("targets", len(self.targets))
+        async with aio.build_session() as session:
+            for url in self.by_url:
+                self.start_poller(session, url)
+            flusher = asyncio.create_task(self.flusher())
+            learner = asyncio.create_task(self.learner())
+            watcher = asyncio.create_task(self.watcher(session))
+            await self.stopping.wait()
+            pollers = list(self.pollers.values())
+            for p in pollers:
+                p.cancel()
+            await asyncio.gather(*pollers, return_exceptions=True)
+            await flusher
+            await learner
+            await watcher
+        if self.confirm_task:
+            await self.confirm_task
+        self.store.close()
+        print("[daemon] stopped")
+
+
+async def main():
+    registry = TargetRegistry(aio.F_TARGETS)
+    targets = registry.load()
+    if not targets:
+        print("no targets.json entries")
+        return
+    await Daemon(targets, registry).run()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
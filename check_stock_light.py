@@ -1,29 +1,28 @@
 #!/usr/bin/env python3
-import os, json, time, hashlib, random
-from typing import List, Optional, Dict, Any
-from dataclasses import dataclass
-
-import requests
-from bs4 import BeautifulSoup
-
-HEADERS_PATH = os.getenv("HEADERS_PATH", "headers_cache.json")
-STATE_PATH = os.getenv("STATE_PATH", "state.json")
+import os, json, time, random
+from typing import List, Dict, Any
+
+import metrics
+from confirm_queue import ConfirmQueue
+import egress
+import history_log
+from sharding import shard_path, shard_targets
+from state_store import open_store
+from stock_rules import Target, decide_stock_html
+from subscriptions import dedupe_targets
+import validators
+import worker_pool
+
+HEADERS_PATH = shard_path(os.getenv("HEADERS_PATH", "headers_cache.json"))
+STATE_PATH = shard_path(os.getenv("STATE_PATH", "state.json"))
 TARGETS_PATH = os.getenv("TARGETS_PATH", "targets.json")
 TIMEOUT = int(os.getenv("TIMEOUT", "20"))
 TRIGGER_PATH = os.getenv("TRIGGER_PATH", "needs_confirm.json")
 USER_AGENT = os.getenv("USER_AGENT", "Mozilla/5.0 (compatible)")
+START_JITTER_SEC = int(os.getenv("START_JITTER_SEC", "20"))  # 起動時のランダム待ち（上限秒）
 
 BASE_HEADERS = {"User-Agent": USER_AGENT, "Accept": "text/html,application/xhtml+xml"}
 
-@dataclass
-class Target:
-    name: str
-    url: str
-    in_stock_css: str
-    in_stock_text_contains: Optional[List[str]] = None
-    out_of_stock_css: Optional[str] = None
-    out_of_stock_text_contains: Optional[List[str]] = None
-
 def load_json(path: str, default):
     if not os.path.exists(path):
         return default
@@ -33,101 +32,117 @@ def load_json(path: str, default):
     except Exception:
         return default
 
-def save_json(path: str, data):
-    with open(path, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
-
 def load_targets() -> List[Target]:
-    data = load_json(TARGETS_PATH, [])
-    return [Target(**x) for x in data]
-
-def decide_stock_html(html: str, t: Target) -> Optional[bool]:
-    from bs4 import BeautifulSoup
-    soup = BeautifulSoup(html, "html.parser")
-
-    def contains_any(text, needles: Optional[List[str]]):
-        if not needles: return False
-        tx = (text or "").strip()
-        return any((s in tx) for s in needles if s)
-
-    # Try in-stock selectors first
-    if t.in_stock_css:
-        for node in soup.select(t.in_stock_css):
-            txt = node.get_text(separator=" ", strip=True)
-            if t.in_stock_text_contains is None or contains_any(txt, t.in_stock_text_contains):
-                return True
-
-    if t.out_of_stock_css:
-        for node in soup.select(t.out_of_stock_css):
-            txt = node.get_text(separator=" ", strip=True)
-            if t.out_of_stock_text_contains is None or contains_any(txt, t.out_of_stock_text_contains):
-                return False
-
-    return None
-
-def conditional_get(url: str, headers_cache: Dict[str, Dict[str, str]]) -> Dict[str, Any]:
+    data = shard_targets(dedupe_targets(load_json(TARGETS_PATH, [])))
+    # JSON/埋め込みデータのプローブ型は aio 段階専用
+    return [Target.from_dict(x) for x in data if x.get("type", "html") == "html"]
+
+def probe_validators(url: str, h: Dict[str, str], kind: str, meta: Dict[str, Any]) -> Dict[str, Any]:
+    # HEAD（または1バイトの Range GET）で検証子だけを見て、前回と同じなら本文を取らない
+    try:
+        if kind == "head":
+            resp = egress.request("HEAD", url, headers=h, timeout=TIMEOUT, allow_redirects=True)
+            ok = resp.status_code == 200
+        else:
+            resp = egress.request("GET", url, headers={**h, "Range": "bytes=0-0"}, timeout=TIMEOUT, stream=True)
+            ok = resp.status_code == 206
+            resp.close()
+    except Exception:
+        ok = False
+    if not ok:
+        return {"probe": kind, "probe_result": "failed"}
+    same = validators.same_validators(meta, validators.response_meta(resp.headers))
+    return {"probe": kind, "probe_result": "same" if same else "changed"}
+
+def conditional_get(url: str, headers_cache: Dict[str, Dict[str, Any]]) -> Dict[str, Any]:
     h = dict(BASE_HEADERS)
     meta = headers_cache.get(url, {})
-    if "etag" in meta:
-        h["If-None-Match"] = meta["etag"]
-    if "last_modified" in meta:
-        h["If-Modified-Since"] = meta["last_modified"]
+    # 検証子は 304 が返ってくる URL にだけ付ける（プロファイルは validators.py）
+    cond = validators.conditional_headers(meta)
+    h.update(cond)
+    obs = {"sent": bool(cond)}
     try:
-        resp = requests.get(url, headers=h, timeout=TIMEOUT)
+        if kind := validators.probe_kind(meta):
+            obs.update(probe_validators(url, h, kind, meta))
+            metrics.inc("probe_total", result=obs["probe_result"])
+            if obs["probe_result"] == "same":
+                return {"status": 304, "html": None, "validator": obs}
+        # 出口（EGRESS）ごとの requests.Session で送る（未設定なら直接出る1本のセッション）
+        resp = egress.request("GET", url, headers=h, timeout=TIMEOUT)
         if resp.status_code == 304:
-            return {"status": 304, "html": None, "etag": meta.get("etag"), "last_modified": meta.get("last_modified")}
-        etag = resp.headers.get("ETag")
-        last_modified = resp.headers.get("Last-Modified")
-        return {"status": resp.status_code, "html": resp.text if resp.status_code == 200 else None, "etag": etag, "last_modified": last_modified}
+            return {"status": 304, "html": None, "validator": obs}
+        obs["meta"] = validators.response_meta(resp.headers)
+        return {"status": resp.status_code, "html": resp.text if resp.status_code == 200 else None, "validator": obs}
     except Exception as e:
         print(f"ERROR GET {url}: {e}")
-        return {"status": 0, "html": None, "etag": meta.get("etag"), "last_modified": meta.get("last_modified")}
+        return {"status": 0, "html": None, "validator": obs}
 
 def main():
     # Light jitter to avoid synchronized hits
-    time.sleep(random.randint(0, 20))
+    time.sleep(random.randint(0, START_JITTER_SEC))
 
     targets = load_targets()
-    state = load_json(STATE_PATH, {})
-    headers_cache = load_json(HEADERS_PATH, {})
+    store = open_store(STATE_PATH, HEADERS_PATH)
+    state = store.load()
+    headers_cache = store.load_headers()
     needs_confirm = []
+    updates, header_updates = {}, {}
 
+    # 取得は逐次。判定は DECIDE_WORKERS>0 ならワーカープロセスへ投げて、次の取得と並行させる
+    fetched = []
     for t in targets:
-        res = conditional_get(t.url, headers_cache)
+        with metrics.timer("fetch", t.url):
+            res = conditional_get(t.url, headers_cache)
         print(f"GET {t.url} -> {res['status']}")
-        if res["status"] == 304:
-            # No content change; keep previous decision
-            decision = state.get(t.url, {}).get("in_stock")
-        elif res["status"] == 200 and res["html"]:
-            decision = decide_stock_html(res["html"], t)
-            # Update header cache
-            headers_cache[t.url] = {
-                "etag": res.get("etag"),
-                "last_modified": res.get("last_modified")
-            }
+        metrics.inc("fetch_total", status={304: "not_modified", 0: "error"}.get(res["status"], "ok"),
+                    **metrics.target_label(t.url))
+        pending = None
+        if res["status"] == 200 and res["html"]:
+            pending = worker_pool.submit(decide_stock_html, res["html"], t)
+            res["html"] = None  # 本文はワーカーに渡したので手放す
+        # 検証子プロファイル（light は本文ハッシュを持たないので、プローブの学習は aio 側に任せる）
+        status = {200: "ok", 304: "not_modified"}.get(res["status"], "error")
+        history_log.poll(t.url, status)
+        profile, save = validators.observe(headers_cache.get(t.url, {}), {**res, "status": status}, None)
+        if save:
+            header_updates[t.url] = profile
+        fetched.append((t, res, pending))
+
+    for t, res, pending in fetched:
+        if pending is not None:
+            with metrics.timer("decide", t.url):
+                decision = pending.result()
         else:
+            # 304 (no content change) or error: keep previous decision
             decision = state.get(t.url, {}).get("in_stock")
 
         prev = state.get(t.url, {}).get("in_stock")
         print(f"[light] {t.name}: prev={prev} now={decision}")
+        if t.url in state:
+            history_log.transition(t.url, prev, decision)
 
         # If potential in-stock (True) and previously not True -> trigger heavy confirm
+        # 確定ステージより先に in_stock を書き換えるので、検知前の値を prev として持たせる
         if decision is True and prev is not True:
-            needs_confirm.append({"name": t.name, "url": t.url})
+            needs_confirm.append({"name": t.name, "url": t.url, "prev": prev})
 
-        state[t.url] = {
-            "in_stock": decision,
-            "ts": int(time.time()),
-            # keep last_notify_ts if exists (playwright will maintain it)
-            **({"last_notify_ts": state[t.url]["last_notify_ts"]} if t.url in state and "last_notify_ts" in state[t.url] else {})
-        }
+        # Field-level merge: last_notify_ts (owned by the confirm stage) is left untouched
+        # 判定が変わった行（と初めての行）だけ書く。ts だけの更新で毎回全行を書き直さない
+        if t.url not in state or decision != prev:
+            updates[t.url] = {"in_stock": decision, "ts": int(time.time())}
 
     if needs_confirm:
-        with open(TRIGGER_PATH, "w", encoding="utf-8") as f:
-            json.dump(needs_confirm, f, ensure_ascii=False, indent=2)
-
-    save_json(STATE_PATH, state)
-    save_json(HEADERS_PATH, headers_cache)
+        metrics.inc("escalations_total", len(needs_confirm))
+        ConfirmQueue(TRIGGER_PATH).enqueue(needs_confirm)
+
+    with metrics.timer("state_write"):
+        store.update(updates)
+        store.update_headers(header_updates)
+    store.close()
+    history_log.flush()
+    history_log.rollup_if_due()
+    if egress.configured():
+        egress.get_pool().print_report()
 
 if __name__ == "__main__":
     main()
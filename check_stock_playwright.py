@@ -1,15 +1,23 @@
 #!/usr/bin/env python3
 import os
+import sys
 import json
 import time
-from dataclasses import dataclass
+import asyncio
 from typing import List, Optional, Dict, Any
 
-from dotenv import load_dotenv
-from messaging_api import push_text
-from bs4 import BeautifulSoup
+from restock import load_env
+from notifier import notify, shutdown as shutdown_notifier
+import history_log
+import metrics
+from collection import fetch_items_sync, is_collection
+from confirm_queue import ConfirmQueue
+from stock_rules import Target, compile_target
+from json_probe import is_probe, probe_sync
+from state_store import open_store
+from subscriptions import dedupe_targets, load_subscriptions
 
-load_dotenv()
+load_env()
 
 COOLDOWN_MINUTES = int(os.getenv("COOLDOWN_MINUTES", "5"))
 def can_notify(entry):
@@ -19,79 +27,39 @@ def can_notify(entry):
     return (int(time.time()) - int(last_ts)) >= COOLDOWN_MINUTES * 60
 
 
-LINE_CHANNEL_ACCESS_TOKEN = os.getenv("LINE_CHANNEL_ACCESS_TOKEN")
-LINE_TO_USER_ID = os.getenv("LINE_TO_USER_ID")
 NOTIFY_PREFIX = os.getenv("NOTIFY_PREFIX", "🔔 再入荷")
 USER_AGENT = os.getenv("USER_AGENT", "Mozilla/5.0")
 TARGETS_PATH = os.getenv("TARGETS_PATH", "targets.json")
 STATE_PATH = os.getenv("STATE_PATH", "state.json")
+HEADERS_PATH = os.getenv("HEADERS_PATH", "headers_cache.json")
+TRIGGER_PATH = os.getenv("TRIGGER_PATH", "needs_confirm.json")
+CONFIRM_BATCH = int(os.getenv("CONFIRM_BATCH", "0"))  # 1回で claim する件数（0 は全件）
 TIMEOUT = int(os.getenv("TIMEOUT", "30"))
+CONFIRM_MODE = os.getenv("CONFIRM_MODE", "pool")  # pool: 常駐ブラウザで並列描画 / sync: 従来の1件ずつ起動
 
-def send_line_notify(message: str):
-    # Backward name kept. Uses Messaging API push.
-    if not LINE_CHANNEL_ACCESS_TOKEN or not LINE_TO_USER_ID:
-        print('WARN: LINE_CHANNEL_ACCESS_TOKEN or LINE_TO_USER_ID not set; skip notify')
-        return
-    try:
-        status, body = push_text(LINE_TO_USER_ID, message, LINE_CHANNEL_ACCESS_TOKEN)
-        print(f'LINE Messaging API push: {status} {body}')
-    except Exception as e:
-        print(f'LINE push error: {e}')
-    return
-    import requests
-    url = "https://notify-api.line.me/api/notify"
-    headers = {"Authorization": f"Bearer {LINE_NOTIFY_TOKEN}"}
-    data = {"message": message}
-    try:
-        resp = requests.post(url, headers=headers, data=data, timeout=TIMEOUT)
-        print(f"LINE Notify status: {resp.status_code} {resp.text[:200]}")
-    except Exception as e:
-        print(f"LINE Notify error: {e}")
-
-@dataclass
-class Target:
-    name: str
-    url: str
-    in_stock_css: str
-    in_stock_text_contains: Optional[List[str]] = None
-    out_of_stock_css: Optional[str] = None
-    out_of_stock_text_contains: Optional[List[str]] = None
+def send_line_notify(message: str, to=None):
+    # Backward name kept. 送信は notifier の裏スレッドに任せ、判定ループは待たない
+    notify(message, to)
 
-def load_targets(path: str) -> List[Target]:
+def load_target_dicts(path: str) -> List[Dict[str, Any]]:
     with open(path, "r", encoding="utf-8") as f:
-        data = json.load(f)
-    return [Target(**item) for item in data]
+        return dedupe_targets(json.load(f))
 
-def load_state(path: str) -> Dict[str, Any]:
-    if not os.path.exists(path):
-        return {}
-    with open(path, "r", encoding="utf-8") as f:
-        return json.load(f)
+_subs = None
+def get_subscriptions():
+    global _subs
+    if _subs is None:
+        _subs = load_subscriptions(load_target_dicts(TARGETS_PATH))
+    return _subs
+
+def needs_render(d: Dict[str, Any]) -> bool:
+    return not is_probe(d) and not is_collection(d)
 
-def save_state(path: str, state: Dict[str, Any]):
-    with open(path, "w", encoding="utf-8") as f:
-        json.dump(state, f, ensure_ascii=False, indent=2)
+def load_targets(path: str) -> List[Target]:
+    return [Target.from_dict(item) for item in load_target_dicts(path) if needs_render(item)]
 
 def decide_stock(html: str, t: Target) -> Optional[bool]:
-    soup = BeautifulSoup(html, "html.parser")
-    def text_contains_any(text, needles):
-        if not needles: return False
-        t = (text or "").strip()
-        return any(s for s in needles if s and s in t)
-    try:
-        if t.in_stock_css:
-            for node in soup.select(t.in_stock_css):
-                txt = node.get_text(separator=" ", strip=True)
-                if (t.in_stock_text_contains and text_contains_any(txt, t.in_stock_text_contains)) or (t.in_stock_text_contains is None):
-                    return True
-        if t.out_of_stock_css:
-            for node in soup.select(t.out_of_stock_css):
-                txt = node.get_text(separator=" ", strip=True)
-                if (t.out_of_stock_text_contains and text_contains_any(txt, t.out_of_stock_text_contains)) or (t.out_of_stock_text_contains is None):
-                    return False
-    except Exception as e:
-        print(f"parse error: {e}")
-    return None
+    return compile_target(t).decide(html)
 
 def render_with_playwright(url: str) -> str:
     from playwright.sync_api import sync_playwright
@@ -105,31 +73,198 @@ def render_with_playwright(url: str) -> str:
         browser.close()
         return html
 
-def main():
-    targets = load_targets(TARGETS_PATH)
-    state = load_state(STATE_PATH)
+def apply_decision(t: Target, decision: Optional[bool], state: Dict[str, Any],
+                   updates: Dict[str, Any], link: Optional[str] = None, collection: Optional[str] = None):
+    # 変更したフィールドだけを updates に積む（hash 等、他ステージのフィールドは触らない）
+    key = t.url
+    prev = state.get(key, {}).get("in_stock")
+    now = decision
+    print(f"[{t.name}] decision={now} prev={prev} url={t.url}")
+    metrics.inc("confirm_total", decision=now)
+    if key in state:
+        history_log.transition(key, prev, now, confirmed=True)
+
+    if now is True and prev is not True and can_notify(state.get(key, {})):
+        msg = f"{NOTIFY_PREFIX}\n{t.name}\n在庫が復活したかもしれません！\n{link or t.url}"
+        send_line_notify(msg, get_subscriptions().recipients(key, collection))
+        updates.setdefault(key, {})["last_notify_ts"] = int(time.time())
+
+    updates.setdefault(key, {}).update({"in_stock": now, "ts": int(time.time())})
+    state[key] = {**state.get(key, {}), **updates[key]}
 
-    for t in targets:
+def confirm_probes(probes: List[Dict[str, Any]], state: Dict[str, Any], updates: Dict[str, Any]):
+    # JSON/埋め込みデータ型はブラウザを使わず、もう一度取得し直して確定する
+    done, failed = [], []
+    headers = {"User-Agent": USER_AGENT}
+    for d in probes:
         try:
-            html = render_with_playwright(t.url)
+            with metrics.timer("refetch", d["url"]):
+                decision = probe_sync(d, headers, TIMEOUT)
         except Exception as e:
-            print(f"Playwright fetch error: {e}")
+            print(f"probe error: {e}")
+            failed.append(d["url"])
+            continue
+        apply_decision(Target.from_dict(d), decision, state, updates, link=d.get("link"))
+        done.append(d["url"])
+    return done, failed
+
+def confirm_collections(collections: Dict[str, Any], state: Dict[str, Any], updates: Dict[str, Any]):
+    # 一覧ページ由来の商品は一覧ページを1回だけ取り直し、該当する商品カードで確定する
+    done, failed = [], []
+    headers = {"User-Agent": USER_AGENT}
+    for parent, entries in collections.values():
+        try:
+            with metrics.timer("refetch", parent["url"]):
+                items = fetch_items_sync(parent, headers, TIMEOUT)
+        except Exception as err:
+            print(f"collection error: {err}")
+            failed.extend(e["url"] for e in entries or [])
             continue
+        if entries is None:  # --all
+            entries = [{"url": u, "name": it["name"]} for u, it in items.items()]
+        for e in entries:
+            it = items.get(e["url"])
+            # 一覧から消えた商品は不明扱い
+            apply_decision(Target(name=it["name"] if it else e["name"], url=e["url"]),
+                           it["in_stock"] if it else None, state, updates, collection=parent["url"])
+            done.append(e["url"])
+    return done, failed
 
-        decision = decide_stock(html, t)
-        key = t.url
-        prev = state.get(key, {}).get("in_stock")
-        now = decision
-        print(f"[{t.name}] decision={now} prev={prev} url={t.url}")
+def claim_targets(queue: ConfirmQueue, render_all: bool):
+    # 確定待ちキューから claim したエントリに対応するターゲットだけを返す
+    # 戻り値: (描画が必要な Target, プローブ型ターゲットの dict, {一覧URL: (一覧の dict, 商品エントリ)}, claim したエントリ)
+    items = load_target_dicts(TARGETS_PATH)
+    if render_all:
+        return ([Target.from_dict(d) for d in items if needs_render(d)],
+                [d for d in items if is_probe(d)],
+                {d["url"]: (d, None) for d in items if is_collection(d)}, [])
+    claimed = queue.claim(CONFIRM_BATCH or None)
+    by_url = {d["url"]: d for d in items}
+    picked, probes, collections, unknown = [], [], {}, []
+    for e in claimed:
+        d = by_url.get(e.get("collection") or e["url"])
+        if d is not None and is_collection(d):
+            collections.setdefault(d["url"], (d, []))[1].append(e)
+        elif d is None:
+            print(f"[confirm] not in targets.json, dropping: {e['url']}")
+            unknown.append(e["url"])
+        elif is_probe(d):
+            probes.append(d)
+        else:
+            picked.append(Target.from_dict(d))
+    queue.ack(unknown, claim_id(claimed))
+    return picked, probes, collections, claimed
 
-        if now is True and prev is not True and can_notify(state.get(key, {})):
-            msg = f"{NOTIFY_PREFIX}\n{t.name}\n在庫が復活したかもしれません！\n{t.url}"
-            send_line_notify(msg)
-            state[key] = {**state.get(key, {}), "last_notify_ts": int(time.time())}
+def claim_id(claimed: List[Dict[str, Any]]) -> Optional[str]:
+    return claimed[0]["claim_id"] if claimed else None
 
-        state[key] = {"in_stock": now, "ts": int(time.time())}
+def with_prev(state: Dict[str, Any], claimed: List[Dict[str, Any]]) -> Dict[str, Any]:
+    # 取得側はもう state の in_stock を書き換えているので、エントリに検知前の値（prev）があればそれと比べて通知を決める
+    # （prev の無い旧形式のエントリは state のまま）
+    for e in claimed:
+        if "prev" in e:
+            state[e["url"]] = {**state.get(e["url"], {}), "in_stock": e["prev"]}
+    return state
 
-    save_state(STATE_PATH, state)
+def finish(queue: ConfirmQueue, store, updates: Dict[str, Any], done: List[str], failed: List[str],
+           claimed: List[Dict[str, Any]]):
+    # 途中で失敗しても、通知済みの分の state（last_notify_ts / in_stock）と ack / nack は必ず書く
+    try:
+        with metrics.timer("state_write"):
+            store.update(updates)
+        store.close()
+    finally:
+        if claimed:  # --all は claim していない
+            queue.ack(done, claim_id(claimed))
+            queue.nack(failed, claim_id(claimed))
+
+def main(render_all: bool = False):
+    queue = ConfirmQueue(TRIGGER_PATH)
+    targets, probes, collections, claimed = claim_targets(queue, render_all)
+    if not targets and not probes and not collections:
+        print("[confirm] nothing to confirm")
+        return
+    store = open_store(STATE_PATH, HEADERS_PATH)
+    state = with_prev(store.load(), claimed)
+    updates = {}
+    done, failed = [], []
+
+    try:
+        p_done, p_failed = confirm_probes(probes, state, updates)
+        c_done, c_failed = confirm_collections(collections, state, updates)
+        done += p_done + c_done
+        failed += p_failed + c_failed
+        for t in targets:
+            try:
+                with metrics.timer("render", t.url):
+                    html = render_with_playwright(t.url)
+            except Exception as e:
+                print(f"Playwright fetch error: {e}")
+                failed.append(t.url)
+                continue
+            apply_decision(t, decide_stock(html, t), state, updates)
+            done.append(t.url)
+    finally:
+        finish(queue, store, updates, done, failed, claimed)
+
+async def confirm_one(pool, t: Target) -> Optional[bool]:
+    with metrics.timer("render", t.url):
+        if pool.lean and (t.in_stock_css or t.out_of_stock_css):
+            res = await pool.render_lean(t.url, t.in_stock_css, t.in_stock_text_contains,
+                                         t.out_of_stock_css, t.out_of_stock_text_contains)
+            return compile_target(t).decide_texts(res["in_texts"], res["out_texts"])
+        return decide_stock(await pool.render(t.url), t)
+
+async def main_pool(render_all: bool = False):
+    from browser_pool import BrowserPool
+    queue = ConfirmQueue(TRIGGER_PATH)
+    targets, probes, collections, claimed = claim_targets(queue, render_all)
+    if not targets and not probes and not collections:
+        print("[confirm] nothing to confirm")
+        return
+    store = open_store(STATE_PATH, HEADERS_PATH)
+    state = with_prev(store.load(), claimed)
+    updates = {}
+    done, failed = [], []
+
+    try:
+        p_done, p_failed = await asyncio.to_thread(confirm_probes, probes, state, updates)
+        c_done, c_failed = await asyncio.to_thread(confirm_collections, collections, state, updates)
+        done += p_done + c_done
+        failed += p_failed + c_failed
+        decisions = []
+        if targets:
+            # プローブ型だけならブラウザは起動しない
+            try:
+                async with BrowserPool(user_agent=USER_AGENT, timeout_ms=TIMEOUT * 1000) as pool:
+                    decisions = await asyncio.gather(*(confirm_one(pool, t) for t in targets),
+                                                     return_exceptions=True)
+            except Exception as e:
+                # ブラウザが起動できない → 描画するターゲットは全部失敗（終了時のエラーなら結果はそのまま使う）
+                print(f"[confirm] browser pool error: {e}")
+                decisions = decisions or [e] * len(targets)
+
+        for t, decision in zip(targets, decisions):
+            if isinstance(decision, Exception):
+                print(f"Playwright fetch error: {decision}")
+                failed.append(t.url)
+                continue
+            apply_decision(t, decision, state, updates)
+            done.append(t.url)
+    finally:
+        finish(queue, store, updates, done, failed, claimed)
+
+def run(argv: List[str]):
+    # --all: キューを無視して targets.json 全件を描画（手動確認用）
+    render_all = "--all" in argv
+    try:
+        if CONFIRM_MODE == "sync" or "--sync" in argv:
+            main(render_all)
+        else:
+            asyncio.run(main_pool(render_all))
+    finally:
+        # 裏で送信中の通知を送り切ってから終わる
+        shutdown_notifier()
 
 if __name__ == "__main__":
-    main()
+    run(sys.argv[1:])
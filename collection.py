@@ -0,0 +1,139 @@
+# collection.py
+# 一覧・検索・シリーズページを1回取得して、商品カードごとの在庫を取り出す（type: "collection"）。
+# 1リクエストで数十SKUを見られるので、シリーズ全体を監視するときに商品ページを個別に叩かなくて済む。
+#
+# targets.json の例:
+#   {"type": "collection", "name": "THE MONSTERS シリーズ", "url": "https://example.com/collections/monsters",
+#    "extractor": "css", "item_css": ".product-card", "link_css": "a", "title_css": ".product-title",
+#    "in_stock_css": "button.add-to-cart", "in_stock_text_contains": ["カートに入れる"],
+#    "out_of_stock_css": ".sold-out", "out_of_stock_text_contains": null}
+#   {"type": "collection", "name": "...", "url": "https://example.com/collections/monsters",
+#    "extractor": "embedded", "script": "__NEXT_DATA__", "items_path": "props.pageProps.products[*]",
+#    "id_path": "id", "title_path": "title", "link_template": "https://example.com/products/{id}",
+#    "availability_path": "skus[*].stock", "in_stock_when": ">0"}
+#
+#   extractor:  "css"（既定）| "embedded"（__NEXT_DATA__ / JSON-LD 等）| "json"（一覧APIのJSON）
+#               サイト固有の抽出は register_extractor() で追加できる
+#   css:        item_css でカードを列挙し、カード内で in_stock_css / out_of_stock_css を判定（ルールは Target と同じ）
+#   embedded/json: items_path で商品を列挙し、各商品の availability_path を json_probe と同じ規則で判定
+#
+# 商品ごとの状態は商品URLをキーに state に入る（"collection" に一覧ページのURL）。
+import hashlib, json
+from typing import Any, Callable, Dict, List, Optional
+from urllib.parse import urljoin
+
+from json_probe import evaluate, extract_embedded, loads, parse_path, select, values_digest
+from stock_rules import Target, compile_target, get_backend
+
+COLLECTION_TYPE = "collection"
+
+Item = Dict[str, Any]  # {"url", "name", "in_stock", "hash"}
+EXTRACTORS: Dict[str, Callable[[Any, dict], List[Item]]] = {}
+
+
+def is_collection(target: dict) -> bool:
+    return target.get("type") == COLLECTION_TYPE
+
+
+def register_extractor(name: str):
+    def deco(fn):
+        EXTRACTORS[name] = fn
+        return fn
+    return deco
+
+
+def _digest(s: str) -> str:
+    return hashlib.blake2s(s.encode("utf-8", errors="ignore")).hexdigest()
+
+
+def _as_text(body) -> str:
+    return body.decode("utf-8", errors="ignore") if isinstance(body, (bytes, bytearray)) else body
+
+
+@register_extractor("css")
+def extract_css(body, target: dict) -> List[Item]:
+    b = get_backend()
+    doc = b.parse(_as_text(body))
+    rule = compile_target(Target.from_dict({**target, "name": target.get("name", ""), "url": target["url"]}), b)
+    link_sel = b.compile(target.get("link_css") or "a")
+    title_sel = b.compile(target["title_css"]) if target.get("title_css") else None
+    items = []
+    for card in b.select_nodes(doc, b.compile(target["item_css"])):
+        links = list(b.select_nodes(card, link_sel))
+        href = b.node_attrs(links[0]).get("href") if links else b.node_attrs(card).get("href")
+        if not href:
+            continue
+        titles = list(b.select_nodes(card, title_sel)) if title_sel is not None else links
+        name = b.node_text(titles[0]) if titles else href
+        items.append({
+            "url": urljoin(target["url"], href),
+            "name": name,
+            "in_stock": rule.decide_doc(card),
+            "hash": _digest(b.node_text(card)),
+        })
+    return items
+
+
+def _first(obj: Any, path: Optional[str]) -> Any:
+    if not path:
+        return None
+    return next(iter(select(obj, parse_path(path))), None)
+
+
+def _json_items(docs: List[Any], target: dict) -> List[Item]:
+    tokens = parse_path(target.get("items_path", ""))
+    avail = parse_path(target.get("availability_path", ""))
+    items = []
+    for doc in docs:
+        for obj in select(doc, tokens):
+            ident = _first(obj, target.get("id_path", "id"))
+            link = _first(obj, target.get("link_path"))
+            if link is None and target.get("link_template") and ident is not None:
+                link = target["link_template"].format(id=ident)
+            if link is None:
+                continue
+            values = list(select(obj, avail))
+            items.append({
+                "url": urljoin(target["url"], str(link)),
+                "name": str(_first(obj, target.get("title_path", "title")) or link),
+                "in_stock": evaluate(values, target),
+                "hash": values_digest(values),
+            })
+    return items
+
+
+@register_extractor("embedded")
+def extract_embedded_items(body, target: dict) -> List[Item]:
+    return _json_items(extract_embedded(_as_text(body), target), target)
+
+
+@register_extractor("json")
+def extract_json_items(body, target: dict) -> List[Item]:
+    return _json_items([loads(body)], target)
+
+
+def extract_items(body, target: dict) -> List[Item]:
+    name = target.get("extractor", "css")
+    fn = EXTRACTORS.get(name)
+    if fn is None:
+        raise ValueError(f"unknown collection extractor: {name}")
+    # 同じ商品がカードとして2回出る（おすすめ枠など）場合は最初の1つだけ
+    seen, items = set(), []
+    for it in fn(body, target):
+        if it["url"] not in seen:
+            seen.add(it["url"])
+            items.append(it)
+    return items
+
+
+def items_digest(items: List[Item]) -> str:
+    raw = json.dumps([(it["url"], it["in_stock"], it["hash"]) for it in items], ensure_ascii=False)
+    return _digest(raw)
+
+
+def fetch_items_sync(target: dict, headers: dict, timeout: int) -> Dict[str, Item]:
+    # requests を使う同期版（確定ステージからの再確認用）
+    import requests
+    resp = requests.get(target["url"], headers=headers, timeout=timeout)
+    resp.raise_for_status()
+    return {it["url"]: it for it in extract_items(resp.content, target)}
@@ -0,0 +1,158 @@
+# confirm_queue.py
+# needs_confirm.json を「確定待ち」ワークキューとして扱う。
+#   - enqueue: URL で重複排除して追加（検知前の在庫状態 prev があれば一緒に持つ。
+#              取り出す側の check_stock_playwright.py / pipeline.py は state の代わりにこれと比べて通知を決める）
+#   - claim:   未処理（またはリース切れ）のエントリを取り出して処理中にする
+#   - ack:     確定できたエントリを削除
+#   - nack:    失敗したエントリを戻し、試行回数を加算（上限を超えたら破棄）
+#   ack / nack に claim の claim_id を渡すと、今もその claim が持っているエントリだけを変更する
+# 古いエントリは CONFIRM_TTL_SEC で自動的に捨てる。
+# 空になったらファイルはサイズ0にする（start.sh / workflow の `[ -s needs_confirm.json ]` 用）。
+import json, os, time
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional
+
+from state_store import file_lock
+
+CONFIRM_TTL_SEC = int(os.getenv("CONFIRM_TTL_SEC", "900"))
+CONFIRM_MAX_ATTEMPTS = int(os.getenv("CONFIRM_MAX_ATTEMPTS", "3"))
+CONFIRM_LEASE_SEC = int(os.getenv("CONFIRM_LEASE_SEC", "300"))  # claim したまま落ちたプロセス対策
+
+
+class ConfirmQueue:
+    def __init__(self, path):
+        self.path = Path(path)
+        self.lock_path = self.path.with_name(self.path.name + ".lock")
+
+    def _load(self) -> List[Dict]:
+        try:
+            raw = self.path.read_text(encoding="utf-8")
+        except FileNotFoundError:
+            return []
+        if not raw.strip():
+            return []
+        try:
+            items = json.loads(raw)
+        except ValueError:
+            return []
+        now = int(time.time())
+        entries = []
+        for x in items:
+            if not isinstance(x, dict) or not x.get("url"):
+                continue
+            # 旧形式 {"url", "name"} も受け付ける
+            entries.append({
+                "url": x["url"],
+                "name": x.get("name") or x["url"],
+                "enqueued_ts": int(x.get("enqueued_ts") or now),
+                "attempts": int(x.get("attempts") or 0),
+                "claimed_ts": x.get("claimed_ts"),
+                "claim_id": x.get("claim_id"),
+            })
+            if x.get("collection"):
+                # 一覧ページ由来の商品は一覧ページを取り直して確定する
+                entries[-1]["collection"] = x["collection"]
+            if "prev" in x:
+                # 検知前の在庫状態（None は不明）。確定時に state の代わりにこれと比べる
+                entries[-1]["prev"] = x["prev"]
+        return entries
+
+    def _save(self, entries: List[Dict]):
+        if not entries:
+            self.path.write_text("", encoding="utf-8")
+            return
+        tmp = self.path.with_suffix(".tmp")
+        tmp.write_text(json.dumps(entries, ensure_ascii=False, indent=2), encoding="utf-8")
+        tmp.replace(self.path)
+
+    def _expire(self, entries: List[Dict]) -> List[Dict]:
+        now = int(time.time())
+        alive = []
+        for e in entries:
+            if now - e["enqueued_ts"] > CONFIRM_TTL_SEC:
+                print(f"[confirm_queue] expired: {e['name']}")
+                continue
+            alive.append(e)
+        return alive
+
+    def enqueue(self, items: Iterable[Dict]) -> int:
+        added = 0
+        with file_lock(self.lock_path):
+            entries = self._expire(self._load())
+            by_url = {e["url"]: e for e in entries}
+            now = int(time.time())
+            for it in items:
+                e = by_url.get(it["url"])
+                if e is not None:
+                    # 既に待ち行列にある → 名前だけ更新して TTL を延長
+                    e["name"] = it.get("name") or e["name"]
+                    e["enqueued_ts"] = now
+                    if "prev" in it and "prev" not in e:
+                        e["prev"] = it["prev"]  # 最初に検知したときの値を残す
+                    continue
+                e = {"url": it["url"], "name": it.get("name") or it["url"], "enqueued_ts": now,
+                     "attempts": 0, "claimed_ts": None, "claim_id": None}
+                if it.get("collection"):
+                    e["collection"] = it["collection"]
+                if "prev" in it:
+                    e["prev"] = it["prev"]
+                entries.append(e)
+                by_url[e["url"]] = e
+                added += 1
+            self._save(entries)
+        return added
+
+    def claim(self, limit: Optional[int] = None) -> List[Dict]:
+        import uuid
+        claim_id = uuid.uuid4().hex
+        now = int(time.time())
+        claimed = []
+        with file_lock(self.lock_path):
+            entries = self._expire(self._load())
+            for e in entries:
+                if limit is not None and len(claimed) >= limit:
+                    break
+                if e["claimed_ts"] and now - int(e["claimed_ts"]) < CONFIRM_LEASE_SEC:
+                    continue
+                e["claimed_ts"] = now
+                e["claim_id"] = claim_id
+                claimed.append(dict(e))
+            self._save(entries)
+        return claimed
+
+    @staticmethod
+    def _mine(e: Dict, urls: set, claim_id: Optional[str]) -> bool:
+        # claim_id を渡したときは、その claim のエントリだけ（リース切れで他のワーカーが取り直した分には触らない）
+        return e["url"] in urls and (claim_id is None or e["claim_id"] == claim_id)
+
+    def ack(self, urls: Iterable[str], claim_id: Optional[str] = None):
+        done = set(urls)
+        if not done:
+            return
+        with file_lock(self.lock_path):
+            entries = [e for e in self._load() if not self._mine(e, done, claim_id)]
+            self._save(entries)
+
+    def nack(self, urls: Iterable[str], claim_id: Optional[str] = None):
+        failed = set(urls)
+        if not failed:
+            return
+        with file_lock(self.lock_path):
+            entries = []
+            for e in self._load():
+                if self._mine(e, failed, claim_id):
+                    e["attempts"] += 1
+                    e["claimed_ts"] = None
+                    e["claim_id"] = None
+                    if e["attempts"] >= CONFIRM_MAX_ATTEMPTS:
+                        print(f"[confirm_queue] giving up after {e['attempts']} attempt(s): {e['name']}")
+                        continue
+                entries.append(e)
+            self._save(entries)
+
+    def pending(self) -> int:
+        # 今 claim できる（未処理 or リース切れの）件数
+        now = int(time.time())
+        with file_lock(self.lock_path):
+            return sum(1 for e in self._expire(self._load())
+                       if not e["claimed_ts"] or now - int(e["claimed_ts"]) >= CONFIRM_LEASE_SEC)
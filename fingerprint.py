@@ -0,0 +1,58 @@
+# fingerprint.py
+# ページ全体ではなく「在庫を表す部分」だけのハッシュ（指紋）を作る。
+# CSRF トークン・タイムスタンプ・おすすめ枠などの揺らぎで changed にならないようにするため。
+#
+# targets.json の例:
+#   "fingerprint": {"css": ".product-actions", "jsonld": "offers.availability"}
+#   "fingerprint": {"css": "button.buy", "attrs": ["class", "disabled"], "strip_digits": true}
+#
+#   css:          指紋に含める要素のセレクタ（テキストと安定な属性だけを使う）
+#   jsonld:       <script type="application/ld+json"> 内のドット区切りパス（リストは全要素を辿る）
+#   attrs:        含める属性の許可リスト（省略時は揮発性の属性を除いた全属性）
+#   strip_digits: テキスト中の数字列を落とす（残り時間や閲覧数など）
+import hashlib, json, os, re
+from typing import Any, List, Optional
+
+from json_probe import jsonld_docs, parse_path, select
+from stock_rules import get_backend
+
+VOLATILE_ATTRS = re.compile(os.getenv(
+    "FINGERPRINT_VOLATILE_ATTRS",
+    r"^(id|style|nonce|integrity|srcset|data-(react|v-|reactid|testid|ts|time|track|gtm).*|.*(csrf|token|session|timestamp).*)$",
+), re.IGNORECASE)
+
+_WS = re.compile(r"\s+")
+_DIGITS = re.compile(r"\d+")
+
+
+def _norm_text(s: str, strip_digits: bool) -> str:
+    s = _WS.sub(" ", s or "").strip()
+    return _DIGITS.sub("#", s) if strip_digits else s
+
+
+def jsonld_values(html: str, path: str) -> List[Any]:
+    tokens = parse_path(path)
+    return [v for doc in jsonld_docs(html) for v in select(doc, tokens)]
+
+
+def css_parts(html: str, css: str, attrs: Optional[List[str]], strip_digits: bool, backend=None) -> List[str]:
+    b = backend or get_backend()
+    doc = b.parse(html)
+    parts = []
+    for node in b.select_nodes(doc, b.compile(css)):
+        kept = {k: v for k, v in b.node_attrs(node).items()
+                if (k in attrs if attrs is not None else not VOLATILE_ATTRS.match(k))}
+        attr_s = " ".join(f"{k}={_norm_text(v or '', strip_digits)}" for k, v in sorted(kept.items()))
+        parts.append(f"[{attr_s}]{_norm_text(b.node_text(node), strip_digits)}")
+    return parts
+
+
+def compute_fingerprint(html: str, spec: dict, backend=None) -> str:
+    strip_digits = bool(spec.get("strip_digits"))
+    parts = []
+    if spec.get("css"):
+        parts.append("css:" + "|".join(css_parts(html, spec["css"], spec.get("attrs"), strip_digits, backend)))
+    if spec.get("jsonld"):
+        values = jsonld_values(html, spec["jsonld"])
+        parts.append("jsonld:" + json.dumps(values, ensure_ascii=False, sort_keys=True, default=str))
+    return hashlib.blake2s("\n".join(parts).encode("utf-8", errors="ignore")).hexdigest()
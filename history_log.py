@@ -0,0 +1,339 @@
+# history_log.py
+# 在庫の遷移と取得結果を、追記だけの固定長バイナリログに残す（state は最新の1行しか持たないため）。
+#
+#   history.bin          在庫の遷移（少ないので全部残す）      <IIBbb  ts, url_id, event, prev, new  11バイト
+#   history.polls.bin    取得1回ごとの結果（ok / 304 / error） <IIBbb  同上（prev / new は 0）
+#   history.rollup.bin   HISTORY_RAW_HOURS より古い取得結果を1時間ごとに集計したもの
+#                                                         <IIHHH  hour_ts, url_id, ok, not_modified, error
+#   history.urls         URL と url_id の対応（1行1URL、行番号が id。追記のみ）
+#
+# 在庫の値は 1: あり / 0: なし / -1: 不明。event は detected（取得側の判定）と confirmed（確定ステージ）。
+# 書き込みはプロセス内でバッファし、flush() でまとめて追記する（ロックを取るので複数プロセスから書いてよい）。
+# 古い取得結果の集計（rollup_if_due）は flush とは別。cron の段階は終わりに、常駐プロセスは学習と一緒にスレッドで回す。
+#
+# 再入荷 = なし → あり の遷移。確定ステージの記録がある商品はそれを、無ければ取得側の記録を使う。
+# 再入荷の多い曜日・時間帯を「よくある販売開始ウィンドウ」として scheduler.py に渡し、その時間は最短間隔で回す。
+#
+#   python history_log.py restocks [--url URL] [--days 30]   # 再入荷の時刻
+#   python history_log.py windows [--url URL]                # 曜日×時間の再入荷回数と、学習したウィンドウ
+#   python history_log.py stats [--url URL] [--days 7]       # 取得結果の件数（集計済みの分を含む）
+#   python history_log.py rollup                             # 古い取得結果を集計に畳む
+import atexit, os, struct, threading, time
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from state_store import file_lock
+
+HISTORY = os.getenv("HISTORY", "1") == "1"
+HISTORY_POLLS = os.getenv("HISTORY_POLLS", "1") == "1"  # 取得1回ごとの結果も残す
+HISTORY_PATH = Path(os.getenv("HISTORY_PATH", str(Path(__file__).resolve().parent / "history.bin")))
+HISTORY_RAW_HOURS = int(os.getenv("HISTORY_RAW_HOURS", "6"))  # これより古い取得結果は1時間ごとの集計に畳む
+HISTORY_LEARN_DAYS = int(os.getenv("HISTORY_LEARN_DAYS", "90"))  # ウィンドウの学習に使う期間
+HISTORY_MIN_RESTOCKS = int(os.getenv("HISTORY_MIN_RESTOCKS", "3"))  # この回数以上再入荷した時間帯をウィンドウにする
+HISTORY_WINDOW_PAD_MIN = int(os.getenv("HISTORY_WINDOW_PAD_MIN", "10"))  # ウィンドウを前に広げる分数
+
+EVENT = struct.Struct("<IIBbb")
+ROLLUP = struct.Struct("<IIHHH")
+
+EV_OK, EV_NOT_MODIFIED, EV_ERROR, EV_DETECTED, EV_CONFIRMED = range(5)
+POLL_EVENTS = {"ok": EV_OK, "not_modified": EV_NOT_MODIFIED, "error": EV_ERROR}
+EVENT_NAMES = {EV_OK: "ok", EV_NOT_MODIFIED: "not_modified", EV_ERROR: "error",
+               EV_DETECTED: "detected", EV_CONFIRMED: "confirmed"}
+WEEKDAYS = ["Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun"]
+
+
+def _tri(v: Optional[bool]) -> int:
+    return -1 if v is None else int(bool(v))
+
+
+def _paths(path: Path):
+    return path, path.with_suffix(".polls.bin"), path.with_suffix(".rollup.bin"), path.with_suffix(".urls")
+
+
+class HistoryLog:
+    def __init__(self, path=HISTORY_PATH):
+        self.path, self.polls_path, self.rollup_path, self.urls_path = _paths(Path(path))
+        self.lock_path = self.path.with_name(self.path.name + ".lock")
+        self.ids: Dict[str, int] = {}
+        self.urls: List[str] = []
+        self.pending: List[Tuple[bool, str, int, int, int, int]] = []  # (取得結果か, url, ts, event, prev, new)
+        self._lock = threading.Lock()  # to_thread の中（確定ステージ）からも書かれる
+
+    # ---- URL id ----------------------------------------------------------------------
+
+    def _load_urls(self):
+        try:
+            self.urls = self.urls_path.read_text(encoding="utf-8").splitlines()
+        except FileNotFoundError:
+            self.urls = []
+        self.ids = {u: i for i, u in enumerate(self.urls)}
+
+    def _assign(self, new: List[str]):
+        # 他のプロセスが足した分を読み直してから、まだ無いものだけを追記する（ロック内で呼ぶ）
+        self._load_urls()
+        add = [u for u in dict.fromkeys(new) if u not in self.ids]
+        if add:
+            with open(self.urls_path, "a", encoding="utf-8") as f:
+                f.write("".join(u + "\n" for u in add))
+            for u in add:
+                self.ids[u] = len(self.urls)
+                self.urls.append(u)
+
+    # ---- 書き込み --------------------------------------------------------------------
+
+    def _append(self, polls: bool, url: str, event: int, prev: int, new: int, ts: Optional[float]):
+        # url_id は flush 時に振るので、それまでは URL のまま持つ
+        with self._lock:
+            self.pending.append((polls, url, int(ts or time.time()), event, prev, new))
+
+    def poll(self, url: str, status: str, ts: Optional[float] = None):
+        if HISTORY_POLLS and status in POLL_EVENTS:
+            self._append(True, url, POLL_EVENTS[status], 0, 0, ts)
+
+    def transition(self, url: str, prev: Optional[bool], new: Optional[bool], confirmed: bool = False,
+                   ts: Optional[float] = None):
+        if _tri(prev) != _tri(new):
+            self._append(False, url, EV_CONFIRMED if confirmed else EV_DETECTED, _tri(prev), _tri(new), ts)
+
+    def flush(self):
+        with self._lock:
+            pending, self.pending = self.pending, []
+        if not pending:
+            return
+        with file_lock(self.lock_path):
+            missing = [url for _, url, *_ in pending if url not in self.ids]
+            if missing:
+                self._assign(missing)
+            out = {True: bytearray(), False: bytearray()}
+            for polls, url, ts, event, prev, new in pending:
+                out[polls] += EVENT.pack(ts, self.ids[url], event, prev, new)
+            for polls, p in ((False, self.path), (True, self.polls_path)):
+                if out[polls]:
+                    with open(p, "ab") as f:
+                        f.write(out[polls])
+
+    def rollup_due(self) -> bool:
+        return self._oldest_poll() < time.time() - (HISTORY_RAW_HOURS + 1) * 3600
+
+    # ---- 読み出し --------------------------------------------------------------------
+
+    def _oldest_poll(self) -> float:
+        try:
+            with open(self.polls_path, "rb") as f:
+                head = f.read(EVENT.size)
+        except FileNotFoundError:
+            return time.time()
+        return EVENT.unpack(head)[0] if len(head) == EVENT.size else time.time()
+
+    def _read(self, p: Path) -> bytes:
+        try:
+            return p.read_bytes()
+        except FileNotFoundError:
+            return b""
+
+    def _url_ids(self, urls) -> Optional[set]:
+        # 他のプロセスが足した URL も読めるように、読み出しのたびに対応表を読み直す
+        self._load_urls()
+        return None if urls is None else {self.ids[u] for u in urls if u in self.ids}
+
+    def read_events(self, urls=None, since: float = 0, polls: bool = False) -> Iterator[Tuple[int, str, int, int, int]]:
+        # (ts, url, event, prev, new)
+        data = self._read(self.polls_path if polls else self.path)
+        data = data[:len(data) - len(data) % EVENT.size]  # 書きかけの末尾は読まない
+        wanted = self._url_ids(urls)
+        for ts, uid, ev, prev, new in EVENT.iter_unpack(data):
+            if ts >= since and (wanted is None or uid in wanted) and uid < len(self.urls):
+                yield ts, self.urls[uid], ev, prev, new
+
+    def restocks(self, urls=None, since: float = 0) -> Dict[str, List[int]]:
+        # URL ごとの再入荷（なし → あり）時刻。確定ステージの記録がある URL はそれだけを使う
+        found: Dict[str, Dict[int, List[int]]] = {}
+        for ts, url, ev, prev, new in self.read_events(urls, since):
+            if prev == 0 and new == 1:
+                found.setdefault(url, {}).setdefault(ev, []).append(ts)
+        return {u: by_ev.get(EV_CONFIRMED) or by_ev.get(EV_DETECTED, []) for u, by_ev in found.items()}
+
+    def poll_stats(self, urls=None, since: float = 0) -> Dict[str, Dict[str, int]]:
+        # URL ごとの ok / not_modified / error の件数（集計済みの分 + 生の分）
+        out: Dict[str, Dict[str, int]] = {}
+        wanted = self._url_ids(urls)
+        data = self._read(self.rollup_path)
+        for hour, uid, ok, nm, err in ROLLUP.iter_unpack(data[:len(data) - len(data) % ROLLUP.size]):
+            if hour + 3600 > since and (wanted is None or uid in wanted) and uid < len(self.urls):
+                c = out.setdefault(self.urls[uid], {"ok": 0, "not_modified": 0, "error": 0})
+                c["ok"] += ok
+                c["not_modified"] += nm
+                c["error"] += err
+        for _, url, ev, _, _ in self.read_events(urls, since, polls=True):
+            c = out.setdefault(url, {"ok": 0, "not_modified": 0, "error": 0})
+            c[EVENT_NAMES[ev]] += 1
+        return out
+
+    # ---- 集計 ------------------------------------------------------------------------
+
+    def rollup(self, raw_hours: int = HISTORY_RAW_HOURS) -> int:
+        # 古い取得結果を (1時間, URL) ごとの件数に畳み、生のログは新しい分だけに書き換える
+        self.flush()
+        cutoff = (int(time.time()) - raw_hours * 3600) // 3600 * 3600
+        with file_lock(self.lock_path):
+            data = self._read(self.polls_path)
+            data = data[:len(data) - len(data) % EVENT.size]
+            counts: Dict[Tuple[int, int], List[int]] = {}
+            keep = bytearray()
+            for rec in range(0, len(data), EVENT.size):
+                ts, uid, ev, _, _ = EVENT.unpack_from(data, rec)
+                if ts >= cutoff:
+                    keep += data[rec:rec + EVENT.size]
+                    continue
+                c = counts.setdefault((ts // 3600 * 3600, uid), [0, 0, 0])
+                c[ev] = min(0xFFFF, c[ev] + 1)
+            if not counts:
+                return 0
+            with open(self.rollup_path, "ab") as f:
+                f.write(b"".join(ROLLUP.pack(hour, uid, *c) for (hour, uid), c in sorted(counts.items())))
+            tmp = self.polls_path.with_suffix(".tmp")
+            tmp.write_bytes(bytes(keep))
+            tmp.replace(self.polls_path)
+        return sum(sum(c) for c in counts.values())
+
+
+# ---- 再入荷の時間帯 --------------------------------------------------------------------
+
+def histogram(times: List[int]) -> List[List[int]]:
+    # [曜日][時] ごとの再入荷回数（ローカル時刻。scheduler.in_windows と同じ）
+    grid = [[0] * 24 for _ in range(7)]
+    for ts in times:
+        d = datetime.fromtimestamp(ts)
+        grid[d.weekday()][d.hour] += 1
+    return grid
+
+
+def _window(day: Optional[int], hour: int, pad: int) -> str:
+    start = hour * 60 - pad
+    if start < 0:
+        # 0時台の窓は前日の夜から（scheduler の日付またぎの窓は開始側の曜日で数える）
+        start += 24 * 60
+        day = None if day is None else (day - 1) % 7
+    end = (hour + 1) % 24 * 60
+    prefix = "" if day is None else WEEKDAYS[day] + " "
+    return f"{prefix}{start // 60:02d}:{start % 60:02d}-{end // 60:02d}:{end % 60:02d}"
+
+
+def typical_windows(times: List[int], min_restocks: int = HISTORY_MIN_RESTOCKS,
+                    pad: int = HISTORY_WINDOW_PAD_MIN) -> List[str]:
+    # 曜日を問わず同じ時間に何度も来ていれば毎日のウィンドウ、そうでなければ曜日つきのウィンドウ。
+    # 戻り値は scheduler.parse_drop_windows が読める "Fri 19:50-21:00" 形式
+    grid = histogram(times)
+    out = []
+    for hour in range(24):
+        days = [d for d in range(7) if grid[d][hour]]
+        if len(days) >= 3 and sum(grid[d][hour] for d in days) >= min_restocks:
+            out.append(_window(None, hour, pad))
+            continue
+        out.extend(_window(d, hour, pad) for d in days if grid[d][hour] >= min_restocks)
+    return out
+
+
+def learned_windows(targets: List[dict], state: Optional[dict] = None, log: Optional["HistoryLog"] = None,
+                    days: int = HISTORY_LEARN_DAYS) -> Dict[str, List[str]]:
+    # ターゲット URL ごとの学習済みウィンドウ。一覧ページは配下の商品（state の collection）の再入荷をまとめて使う
+    if not HISTORY:
+        return {}
+    log = log or get()
+    members: Dict[str, List[str]] = {t["url"]: [t["url"]] for t in targets if t.get("learn_windows", True)}
+    for url, row in (state or {}).items():
+        if row.get("collection") in members:
+            members[row["collection"]].append(url)
+    restocks = log.restocks(since=time.time() - days * 86400)
+    out = {}
+    for url, urls in members.items():
+        times = [ts for u in urls for ts in restocks.get(u, [])]
+        if times and (windows := typical_windows(times)):
+            out[url] = windows
+    return out
+
+
+# ---- プロセス共通のログ ------------------------------------------------------------------
+
+_default: Optional[HistoryLog] = None
+
+
+def get() -> HistoryLog:
+    global _default
+    if _default is None:
+        _default = HistoryLog()
+    return _default
+
+
+def poll(url: str, status: str):
+    if HISTORY:
+        get().poll(url, status)
+
+
+def transition(url: str, prev: Optional[bool], new: Optional[bool], confirmed: bool = False):
+    if HISTORY:
+        get().transition(url, prev, new, confirmed)
+
+
+def flush():
+    if _default is not None:
+        try:
+            _default.flush()
+        except Exception as e:
+            print(f"[history] flush error: {e}")
+
+
+def rollup_if_due() -> int:
+    # 生の取得結果が HISTORY_RAW_HOURS を過ぎていれば集計に畳む。
+    # ファイル全体を読み書きするので、常駐プロセスではイベントループの外（to_thread）から呼ぶ
+    if not HISTORY:
+        return 0
+    log = get()
+    try:
+        return log.rollup() if log.rollup_due() else 0
+    except Exception as e:
+        print(f"[history] rollup error: {e}")
+        return 0
+
+
+atexit.register(flush)
+
+
+def main():
+    import argparse
+    ap = argparse.ArgumentParser()
+    ap.add_argument("cmd", choices=["restocks", "windows", "stats", "rollup"])
+    ap.add_argument("--url", action="append", help="複数指定可（省略時は全URL）")
+    ap.add_argument("--days", type=float, default=None)
+    ap.add_argument("--path", default=str(HISTORY_PATH))
+    args = ap.parse_args()
+    log = HistoryLog(args.path)
+
+    if args.cmd == "rollup":
+        print(f"[history] rolled up {log.rollup()} poll record(s)")
+        return
+    if args.cmd == "stats":
+        since = time.time() - (args.days or 7) * 86400
+        print(f"{'ok':>8} {'304':>8} {'error':>8}  url")
+        for url, c in sorted(log.poll_stats(args.url, since).items()):
+            print(f"{c['ok']:>8} {c['not_modified']:>8} {c['error']:>8}  {url}")
+        return
+    since = time.time() - (args.days or HISTORY_LEARN_DAYS) * 86400
+    restocks = log.restocks(args.url, since)
+    if args.cmd == "restocks":
+        for url, times in sorted(restocks.items()):
+            print(url)
+            for ts in times:
+                print(f"  {datetime.fromtimestamp(ts):%Y-%m-%d %a %H:%M:%S}")
+        return
+    times = [ts for ts_list in restocks.values() for ts in ts_list]
+    grid = histogram(times)
+    print("     " + "".join(f"{h:>3}" for h in range(24)))
+    for d in range(7):
+        print(f"{WEEKDAYS[d]:>4} " + "".join(f"{n or '.':>3}" for n in grid[d]))
+    print(f"{len(times)} restock(s); windows: {'; '.join(typical_windows(times)) or '-'}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,169 @@
+# http_transport.py
+# aio 段階 / デーモンの HTTP クライアントを選ぶ。
+#
+#   HTTP_TRANSPORT=aiohttp (既定) HTTP/1.1。ホストごとに MAX_PER_HOST 本の keep-alive 接続
+#   HTTP_TRANSPORT=httpx          httpx[http2] で HTTP/2。同じホストへのポーリングは1本の接続に多重化される
+#
+# どちらも fetch_one() からは aiohttp と同じ形（session.get() / session.head() の async with / r.status / r.headers /
+# r.read() / r.text() / r.charset / r.content.iter_chunked() / r.close()）で使える。
+# SSL コンテキストはプロセスで1つだけ作って共有し、セッション（= DNS キャッシュと接続）は
+# デーモンでは起動から終了まで使い回す。
+# proxy / local_addr を渡すと、そのプロキシ経由・その送信元アドレスから出るセッションになる（出口のプールは egress.py）。
+import os, ssl
+from typing import Optional
+
+import metrics
+
+HTTP_TRANSPORT = os.getenv("HTTP_TRANSPORT", "aiohttp")  # aiohttp | httpx
+DNS_CACHE_SEC = int(os.getenv("DNS_CACHE_SEC", "300"))
+
+
+def _has_brotli() -> bool:
+    for mod in ("brotli", "brotlicffi"):
+        try:
+            __import__(mod)
+            return True
+        except ImportError:
+            continue
+    return False
+
+
+# 展開できる形式だけを申告する（br は brotli がある場合のみ）
+ACCEPT_ENCODING = "gzip, deflate, br" if _has_brotli() else "gzip, deflate"
+
+_ssl_ctx: Optional[ssl.SSLContext] = None
+
+
+def ssl_context() -> ssl.SSLContext:
+    global _ssl_ctx
+    if _ssl_ctx is None:
+        _ssl_ctx = ssl.create_default_context()
+    return _ssl_ctx
+
+
+# ---- httpx (HTTP/2) を aiohttp 風に見せるアダプタ ------------------------------
+
+class _HttpxContent:
+    def __init__(self, resp):
+        self._resp = resp
+        self._eof = False
+
+    async def iter_chunked(self, n: int):
+        async for chunk in self._resp.aiter_bytes(n):
+            yield chunk
+        self._eof = True
+
+    def at_eof(self) -> bool:
+        return self._eof
+
+
+class _HttpxResponse:
+    def __init__(self, resp):
+        self._resp = resp
+        self.status = resp.status_code
+        self.headers = resp.headers
+        self.charset = resp.charset_encoding
+        self.content = _HttpxContent(resp)
+
+    async def read(self) -> bytes:
+        return await self._resp.aread()
+
+    async def text(self, errors: str = "strict") -> str:
+        raw = await self._resp.aread()
+        try:
+            return raw.decode(self.charset or "utf-8", errors=errors)
+        except LookupError:
+            return raw.decode("utf-8", errors=errors)
+
+    def close(self):
+        # 実際のクローズは async with を抜けるときに行う（HTTP/2 ではストリームだけ閉じ、接続は残る）
+        pass
+
+
+class _HttpxRequest:
+    def __init__(self, client, url: str, headers: Optional[dict], timeout, method: str = "GET"):
+        self._client = client
+        self._req = client.build_request(method, url, headers=headers, timeout=timeout)
+        self._resp = None
+
+    async def __aenter__(self) -> _HttpxResponse:
+        self._resp = await self._client.send(self._req, stream=True)
+        return _HttpxResponse(self._resp)
+
+    async def __aexit__(self, *exc):
+        await self._resp.aclose()
+
+
+class HttpxSession:
+    def __init__(self, max_conc: int, timeout: float, keepalive_sec: int,
+                 proxy: Optional[str] = None, local_addr: Optional[str] = None):
+        import httpx
+        limits = httpx.Limits(max_connections=max_conc, max_keepalive_connections=max_conc,
+                              keepalive_expiry=keepalive_sec)
+        transport = None
+        if proxy or local_addr:
+            transport = httpx.AsyncHTTPTransport(http2=True, verify=ssl_context(), limits=limits,
+                                                 proxy=proxy, local_address=local_addr)
+        self.client = httpx.AsyncClient(
+            http2=True,
+            verify=ssl_context(),
+            follow_redirects=True,
+            timeout=timeout,
+            limits=limits,
+            transport=transport,
+        )
+
+    def get(self, url: str, headers: Optional[dict] = None, timeout=None) -> _HttpxRequest:
+        return _HttpxRequest(self.client, url, headers, timeout)
+
+    def head(self, url: str, headers: Optional[dict] = None, timeout=None, allow_redirects: bool = True) -> _HttpxRequest:
+        # リダイレクトはクライアント側で常に追う（follow_redirects=True）
+        return _HttpxRequest(self.client, url, headers, timeout, method="HEAD")
+
+    async def close(self):
+        await self.client.aclose()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+
+class _ProxiedSession:
+    # aiohttp はプロキシをリクエストごとに渡すので、セッション側で毎回付ける
+    def __init__(self, session, proxy: str):
+        self.session = session
+        self.proxy = proxy
+
+    def get(self, url: str, **kwargs):
+        return self.session.get(url, proxy=self.proxy, **kwargs)
+
+    def head(self, url: str, **kwargs):
+        return self.session.head(url, proxy=self.proxy, **kwargs)
+
+    async def close(self):
+        await self.session.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+
+def build_session(max_conc: int, max_per_host: int, timeout: float, keepalive_sec: int,
+                  transport: Optional[str] = None, proxy: Optional[str] = None, local_addr: Optional[str] = None):
+    transport = transport or HTTP_TRANSPORT
+    if transport == "httpx":
+        return HttpxSession(max_conc, timeout, keepalive_sec, proxy, local_addr)
+    if transport != "aiohttp":
+        raise ValueError(f"unknown HTTP_TRANSPORT: {transport}")
+    import aiohttp
+    conn = aiohttp.TCPConnector(limit_per_host=max_per_host, limit=max_conc, ttl_dns_cache=DNS_CACHE_SEC,
+                                keepalive_timeout=keepalive_sec, ssl=ssl_context(),
+                                local_addr=(local_addr, 0) if local_addr else None)
+    traces = [metrics.aiohttp_trace_config()] if metrics.enabled() else []
+    session = aiohttp.ClientSession(connector=conn, timeout=aiohttp.ClientTimeout(total=timeout),
+                                    trace_configs=traces)
+    return _ProxiedSession(session, proxy) if proxy else session
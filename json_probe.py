@@ -0,0 +1,201 @@
+# json_probe.py
+# ブラウザ描画なしで在庫を読むためのプローブ。
+# POP MART のように在庫をクライアント側で描画するページでも、データ自体は
+# XHR の JSON API や埋め込みの __NEXT_DATA__ / JSON-LD に入っていることが多い。
+#
+# targets.json の例:
+#   {"type": "json", "name": "...", "url": "https://.../api/product?id=6936",
+#    "availability_path": "data.skus[*].stock", "in_stock_when": ">0",
+#    "link": "https://www.popmart.com/jp/products/6936"}
+#   {"type": "embedded", "name": "...", "url": "https://.../products/6936",
+#    "script": "__NEXT_DATA__", "availability_path": "props.pageProps.product.skus[*].stock"}
+#
+#   script:             "__NEXT_DATA__" | "jsonld" | <script id>（既定 __NEXT_DATA__）
+#   script_regex:       任意の正規表現（グループ1がJSON）。例 "window.__INITIAL_STATE__=(.*?);</script>"
+#   availability_path:  ドット区切り。[*] で配列全要素、[0] で添字
+#   in_stock_values / out_of_stock_values: 値の一致で判定（文字列は大文字小文字無視）
+#   in_stock_when:      数値比較（">0", ">=1", "==1" など）
+#   いずれも無い場合: true / 0以外の数値 / "...InStock" を在庫あり、false / 0 / "...OutOfStock" 等を在庫なしとみなす
+#   link:               通知に載せるURL（省略時は url）
+import hashlib, json, operator, re
+from typing import Any, Iterable, List, Optional, Tuple
+
+try:
+    import orjson
+
+    def loads(data):
+        return orjson.loads(data)
+except ImportError:
+    def loads(data):
+        if isinstance(data, (bytes, bytearray)):
+            data = data.decode("utf-8", errors="ignore")
+        return json.loads(data)
+
+PROBE_TYPES = ("json", "embedded")
+
+_TOKEN = re.compile(r"\[\*\]|\[-?\d+\]|[^.\[\]]+")
+_CMP = re.compile(r"^\s*(>=|<=|==|!=|>|<)\s*(-?\d+(?:\.\d+)?)\s*$")
+_OPS = {">": operator.gt, ">=": operator.ge, "<": operator.lt, "<=": operator.le,
+        "==": operator.eq, "!=": operator.ne}
+_LD_JSON = re.compile(
+    r"<script[^>]+type=[\"']application/ld\+json[\"'][^>]*>(.*?)</script>", re.IGNORECASE | re.DOTALL)
+_OUT_WORDS = ("outofstock", "soldout", "discontinued", "unavailable")
+
+
+def is_probe(target: dict) -> bool:
+    return target.get("type") in PROBE_TYPES
+
+
+def parse_path(path: str) -> List[str]:
+    return _TOKEN.findall(path or "")
+
+
+def select(obj: Any, tokens: List[str]) -> Iterable[Any]:
+    if not tokens:
+        yield obj
+        return
+    tok, rest = tokens[0], tokens[1:]
+    if tok == "[*]":
+        items = obj.values() if isinstance(obj, dict) else obj if isinstance(obj, list) else []
+        for x in items:
+            yield from select(x, rest)
+    elif tok.startswith("["):
+        if isinstance(obj, list):
+            i = int(tok[1:-1])
+            if -len(obj) <= i < len(obj):
+                yield from select(obj[i], rest)
+    elif isinstance(obj, dict):
+        if tok in obj:
+            yield from select(obj[tok], rest)
+        elif "@graph" in obj:
+            yield from select(obj["@graph"], tokens)
+    elif isinstance(obj, list):
+        # JSON-LD のように配列が挟まる場合は暗黙に展開する
+        for x in obj:
+            yield from select(x, tokens)
+
+
+def _script_by_id(html: str, script_id: str) -> Optional[str]:
+    m = re.search(r"<script[^>]+id=[\"']%s[\"'][^>]*>(.*?)</script>" % re.escape(script_id),
+                  html, re.IGNORECASE | re.DOTALL)
+    return m.group(1) if m else None
+
+
+def jsonld_docs(html: str) -> List[Any]:
+    docs = []
+    for m in _LD_JSON.finditer(html):
+        try:
+            docs.append(loads(m.group(1).strip()))
+        except ValueError:
+            continue
+    return docs
+
+
+def extract_embedded(html: str, target: dict) -> List[Any]:
+    # ページ内の埋め込みJSONを取り出す（JSON-LD は複数ブロックありうるのでリスト）
+    if target.get("script", "__NEXT_DATA__") == "jsonld" and not target.get("script_regex"):
+        return jsonld_docs(html)
+    docs = []
+    if target.get("script_regex"):
+        for m in re.finditer(target["script_regex"], html, re.DOTALL):
+            docs.append(m.group(1))
+    else:
+        raw = _script_by_id(html, target.get("script", "__NEXT_DATA__"))
+        if raw is not None:
+            docs.append(raw)
+    parsed = []
+    for d in docs:
+        try:
+            parsed.append(loads(d.strip()))
+        except ValueError:
+            continue
+    return parsed
+
+
+def _eq(a: Any, b: Any) -> bool:
+    if isinstance(a, str) and isinstance(b, str):
+        return a.lower() == b.lower()
+    return a == b
+
+
+def _default_truth(v: Any) -> Optional[bool]:
+    if isinstance(v, bool):
+        return v
+    if isinstance(v, (int, float)):
+        return v > 0
+    if isinstance(v, str):
+        low = v.lower().replace("_", "").replace(" ", "")
+        if "schema.org/" in low:
+            low = low.rsplit("/", 1)[-1]  # https://schema.org/LimitedAvailability → limitedavailability
+        if any(w in low for w in _OUT_WORDS):
+            return False
+        if low.endswith("instock") or low in ("true", "available", "onsale", "limitedavailability"):
+            return True
+        if low in ("false", "0"):
+            return False
+    return None
+
+
+def evaluate(values: List[Any], target: dict) -> Optional[bool]:
+    # True: どれか1つでも在庫あり, False: 判定できた値がすべて在庫なし, None: 不明
+    if not values:
+        return None
+    in_vals = target.get("in_stock_values")
+    out_vals = target.get("out_of_stock_values")
+    cond = target.get("in_stock_when")
+    cmp = None
+    if cond:
+        m = _CMP.match(str(cond))
+        if not m:
+            raise ValueError(f"bad in_stock_when: {cond!r}")
+        cmp = (_OPS[m.group(1)], float(m.group(2)))
+
+    decided = None
+    for v in values:
+        if in_vals is not None and any(_eq(v, x) for x in in_vals):
+            return True
+        if out_vals is not None and any(_eq(v, x) for x in out_vals):
+            decided = False
+            continue
+        if cmp is not None:
+            try:
+                if cmp[0](float(v), cmp[1]):
+                    return True
+                decided = False
+            except (TypeError, ValueError):
+                pass
+            continue
+        if in_vals is None and out_vals is None:
+            t = _default_truth(v)
+            if t is True:
+                return True
+            if t is False:
+                decided = False
+    return decided
+
+
+def probe_document(body, target: dict) -> Tuple[Optional[bool], List[Any]]:
+    # body は JSON API のレスポンス本文（type=json）か HTML（type=embedded）
+    if target.get("type") == "json":
+        docs = [loads(body)]
+    else:
+        html = body.decode("utf-8", errors="ignore") if isinstance(body, (bytes, bytearray)) else body
+        docs = extract_embedded(html, target)
+    tokens = parse_path(target.get("availability_path", ""))
+    values = [v for d in docs for v in select(d, tokens)]
+    return evaluate(values, target), values
+
+
+def values_digest(values: List[Any]) -> str:
+    # 変化検知用。判定に使った値だけをハッシュするので、ページの他の揺らぎには反応しない
+    raw = json.dumps(values, ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.blake2s(raw.encode("utf-8")).hexdigest()
+
+
+def probe_sync(target: dict, headers: dict, timeout: int) -> Optional[bool]:
+    # requests を使う同期版（確定ステージからの再確認用）
+    import requests
+    resp = requests.get(target["url"], headers=headers, timeout=timeout)
+    resp.raise_for_status()
+    decision, _ = probe_document(resp.content, target)
+    return decision
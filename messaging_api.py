@@ -1,17 +1,58 @@
 #!/usr/bin/env python3
 import os, json
-import requests
+from typing import List, Optional
 
 LINE_MESSAGING_PUSH_URL = "https://api.line.me/v2/bot/message/push"
+LINE_MESSAGING_MULTICAST_URL = "https://api.line.me/v2/bot/message/multicast"
+LINE_MESSAGING_BROADCAST_URL = "https://api.line.me/v2/bot/message/broadcast"
+LINE_MAX_MESSAGES = 5  # 1リクエストに載せられるメッセージ数の上限
+LINE_MAX_MULTICAST = 500  # multicast 1回の宛先数の上限
+LINE_MAX_TEXT = 5000  # テキストメッセージ1件の文字数上限
+LINE_TIMEOUT = int(os.getenv("LINE_TIMEOUT", "10"))
 
-def push_text(to_user_id: str, text: str, channel_access_token: str):
+# 同期版もコネクションを使い回す（毎回 TLS ハンドシェイクしない）
+# requests は実際に送るときまで読み込まない（通知しない周回の起動を軽くする）
+_session = None
+
+def _http():
+    global _session
+    if _session is None:
+        import requests
+        _session = requests.Session()
+    return _session
+
+def auth_headers(channel_access_token: str, retry_key: Optional[str] = None):
     headers = {
         "Authorization": f"Bearer {channel_access_token}",
         "Content-Type": "application/json"
     }
-    body = {
-        "to": to_user_id,
-        "messages": [ { "type": "text", "text": text } ]
-    }
-    resp = requests.post(LINE_MESSAGING_PUSH_URL, headers=headers, data=json.dumps(body), timeout=20)
+    if retry_key:
+        # 同じキーでの再送は LINE 側で重複配信されない（409 が返る）
+        headers["X-Line-Retry-Key"] = retry_key
+    return headers
+
+def text_messages(texts: List[str]):
+    return [{"type": "text", "text": t[:LINE_MAX_TEXT]} for t in texts[:LINE_MAX_MESSAGES]]
+
+def build_request(to: List[str], texts: List[str]):
+    # 宛先なし→broadcast、1人→push、複数→multicast
+    messages = text_messages(texts)
+    if not to:
+        return LINE_MESSAGING_BROADCAST_URL, {"messages": messages}
+    if len(to) == 1:
+        return LINE_MESSAGING_PUSH_URL, {"to": to[0], "messages": messages}
+    return LINE_MESSAGING_MULTICAST_URL, {"to": list(to), "messages": messages}
+
+def push_text(to_user_id: str, text: str, channel_access_token: str):
+    url, body = build_request([to_user_id], [text])
+    resp = _http().post(url, headers=auth_headers(channel_access_token), data=json.dumps(body), timeout=LINE_TIMEOUT)
     return resp.status_code, resp.text[:500]
+
+def multicast_text(to_user_ids: List[str], texts: List[str], channel_access_token: str):
+    # 宛先が多いときは上限ごとに分けて送る
+    results = []
+    for i in range(0, max(len(to_user_ids), 1), LINE_MAX_MULTICAST):
+        url, body = build_request(to_user_ids[i:i + LINE_MAX_MULTICAST], texts)
+        resp = _http().post(url, headers=auth_headers(channel_access_token), data=json.dumps(body), timeout=LINE_TIMEOUT)
+        results.append((resp.status_code, resp.text[:500]))
+    return results
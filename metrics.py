@@ -0,0 +1,212 @@
+# metrics.py
+# 段階ごとの所要時間とカウンタ。外部ライブラリなしで Prometheus のテキスト形式を出す。
+#
+#   METRICS_PORT=9464      /metrics を HTTP で公開（0 / 未設定なら公開しない）
+#   METRICS_PER_TARGET=1   ラベルをホスト単位ではなくターゲット（URL）単位にする（件数が多いと重い）
+#   LOG_FORMAT=json        log() を1行1イベントの JSON で出す（既定 text）
+#
+# 計測する段階（stage_seconds{stage=...}）:
+#   dns / connect（aiohttp のトレース）, probe（検証子だけの HEAD / Range）, ttfb, transfer, decode, decide, hash, fingerprint,
+#   fetch（light の requests 1回分）, state_write, confirm（デーモンから見た確定ステージ1回分）,
+#   render（Playwright）, refetch（確定ステージのプローブ/一覧の再取得）,
+#   notify（LINE 送信1回）, notify_lag（submit → 送信完了）
+# カウンタ: fetch_total{status=ok|not_modified|error}, errors_total{stage}, escalations_total, notify_total{result},
+#           probe_total{result=same|changed|failed}, egress_total{exit, result=ok|blocked|error}
+import json, os, threading, time
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Dict, Optional, Tuple
+from urllib.parse import urlsplit
+
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+METRICS_PER_TARGET = os.getenv("METRICS_PER_TARGET", "0") == "1"
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text")  # text | json
+PREFIX = "restock_"
+
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+class _Histogram:
+    __slots__ = ("counts", "total", "n")
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.total = 0.0
+        self.n = 0
+
+    def observe(self, v: float):
+        self.counts[bisect_left(BUCKETS, v)] += 1
+        self.total += v
+        self.n += 1
+
+
+class Registry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters: Dict[Tuple[str, Labels], float] = {}
+        self.histograms: Dict[Tuple[str, Labels], _Histogram] = {}
+        self.gauges: Dict[Tuple[str, Labels], float] = {}
+
+    @staticmethod
+    def _key(name: str, labels: dict) -> Tuple[str, Labels]:
+        return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+    def inc(self, name: str, n: float = 1, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + n
+
+    def set(self, name: str, v: float, **labels):
+        with self._lock:
+            self.gauges[self._key(name, labels)] = v
+
+    def observe(self, name: str, seconds: float, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            h = self.histograms.get(key)
+            if h is None:
+                h = self.histograms[key] = _Histogram()
+            h.observe(seconds)
+
+    def render(self) -> str:
+        def fmt(labels: Labels, extra: Tuple = ()) -> str:
+            items = list(labels) + list(extra)
+            if not items:
+                return ""
+            return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in items) + "}"
+
+        out = []
+        with self._lock:
+            for kind, table in (("counter", self.counters), ("gauge", self.gauges)):
+                for name in sorted({n for n, _ in table}):
+                    out.append(f"# TYPE {PREFIX}{name} {kind}")
+                    for (n, labels), v in table.items():
+                        if n == name:
+                            out.append(f"{PREFIX}{name}{fmt(labels)} {v}")
+            for name in sorted({n for n, _ in self.histograms}):
+                out.append(f"# TYPE {PREFIX}{name} histogram")
+                for (n, labels), h in self.histograms.items():
+                    if n != name:
+                        continue
+                    acc = 0
+                    for le, c in zip(BUCKETS + ("+Inf",), h.counts):
+                        acc += c
+                        out.append(f"{PREFIX}{name}_bucket{fmt(labels, (('le', str(le)),))} {acc}")
+                    out.append(f"{PREFIX}{name}_sum{fmt(labels)} {h.total}")
+                    out.append(f"{PREFIX}{name}_count{fmt(labels)} {h.n}")
+        return "\n".join(out) + "\n"
+
+
+def _escape(v: str) -> str:
+    return v.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+REGISTRY = Registry()
+inc = REGISTRY.inc
+observe = REGISTRY.observe
+set_gauge = REGISTRY.set
+
+
+def enabled() -> bool:
+    # 計測結果を出す先があるときだけ、トレース等の余計な処理を入れる
+    return METRICS_PORT > 0 or LOG_FORMAT == "json"
+
+
+def target_label(url: str) -> Dict[str, str]:
+    return {"target": url} if METRICS_PER_TARGET else {"host": (urlsplit(url).hostname or "").lower()}
+
+
+def stage(name: str, seconds: float, url: Optional[str] = None):
+    observe("stage_seconds", seconds, stage=name, **(target_label(url) if url else {}))
+
+
+@contextmanager
+def timer(name: str, url: Optional[str] = None, into: Optional[dict] = None):
+    # with timer("decide", url, into=timings): ...  into に秒数を足し込む（1件分のログ用）
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        dt = time.perf_counter() - t0
+        stage(name, dt, url)
+        if into is not None:
+            into[name] = into.get(name, 0.0) + dt
+
+
+def log(event: str, **fields):
+    if LOG_FORMAT == "json":
+        print(json.dumps({"ts": round(time.time(), 3), "event": event, **fields},
+                         ensure_ascii=False, default=str), flush=True)
+    else:
+        print(f"[{event}] " + " ".join(f"{k}={v}" for k, v in fields.items()))
+
+
+# ---- /metrics --------------------------------------------------------------------
+
+def _handler():
+    # http.server は公開するときだけ読み込む（1周で終わる cron 実行の起動を軽くする）
+    from http.server import BaseHTTPRequestHandler
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = REGISTRY.render().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
+
+
+_server = None
+
+
+def serve(port: int = METRICS_PORT, host: str = "0.0.0.0"):
+    # 裏スレッドで /metrics を返す。port が 0 なら何もしない
+    global _server
+    if not port or _server is not None:
+        return _server
+    from http.server import ThreadingHTTPServer
+    try:
+        _server = ThreadingHTTPServer((host, port), _handler())
+    except OSError as e:
+        print(f"[metrics] cannot listen on {port}: {e}")
+        return None
+    threading.Thread(target=_server.serve_forever, name="metrics", daemon=True).start()
+    print(f"[metrics] http://{host}:{port}/metrics")
+    return _server
+
+
+# ---- aiohttp のトレース（DNS / 接続確立） -------------------------------------------
+
+def aiohttp_trace_config():
+    import aiohttp
+
+    async def dns_start(session, ctx, params):
+        ctx.dns_t0 = time.perf_counter()
+
+    async def dns_end(session, ctx, params):
+        observe("stage_seconds", time.perf_counter() - ctx.dns_t0, stage="dns", host=params.host)
+
+    async def conn_start(session, ctx, params):
+        ctx.conn_t0 = time.perf_counter()
+
+    async def conn_end(session, ctx, params):
+        observe("stage_seconds", time.perf_counter() - ctx.conn_t0, stage="connect")
+        inc("connections_total")
+
+    tc = aiohttp.TraceConfig()
+    tc.on_dns_resolvehost_start.append(dns_start)
+    tc.on_dns_resolvehost_end.append(dns_end)
+    tc.on_connection_create_start.append(conn_start)
+    tc.on_connection_create_end.append(conn_end)
+    return tc
@@ -0,0 +1,295 @@
+# notifier.py
+# LINE 通知の送信係。判定ループからは submit() で積むだけにして、送信は別タスクで行う。
+#
+#   - aiohttp のセッションを使い回す（接続プール）
+#   - NOTIFY_BATCH_MS の間に積まれた通知は宛先ごとにまとめ、1リクエスト最大5件で送る
+#   - 宛先が複数なら multicast（500人ごとに分割）、LINE_BROADCAST=1 なら broadcast
+#   - 429 / 5xx / 通信エラーは Retry-After（無ければ指数バックオフ）を見て再送。
+#     待ちが長い・終了間際のものは notify_retry.json に退避し、次回起動時にも再送する
+#   - 再送には同じ X-Line-Retry-Key を付けるので、二重配信にはならない
+#
+# 同期版のチェッカーからは notify() / shutdown() を使う（裏のスレッドで同じ Dispatcher を動かす）。
+import asyncio, atexit, json, os, random, threading, time, uuid
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import metrics
+from messaging_api import LINE_MAX_MESSAGES, LINE_MAX_MULTICAST, LINE_TIMEOUT, auth_headers, build_request
+from state_store import file_lock
+
+LINE_CHANNEL_ACCESS_TOKEN = os.getenv("LINE_CHANNEL_ACCESS_TOKEN")
+LINE_TO_USER_ID = os.getenv("LINE_TO_USER_ID", "")  # カンマ区切りで複数可
+LINE_BROADCAST = os.getenv("LINE_BROADCAST", "0") == "1"
+NOTIFY_BATCH_MS = int(os.getenv("NOTIFY_BATCH_MS", "500"))  # 同時の再入荷をまとめる待ち時間
+NOTIFY_MAX_ATTEMPTS = int(os.getenv("NOTIFY_MAX_ATTEMPTS", "8"))
+NOTIFY_MAX_INLINE_WAIT_SEC = float(os.getenv("NOTIFY_MAX_INLINE_WAIT_SEC", "30"))  # これより長い待ちはファイルに退避
+NOTIFY_RETRY_PATH = Path(os.getenv("NOTIFY_RETRY_PATH", "notify_retry.json"))
+NOTIFY_RETRY_POLL_SEC = float(os.getenv("NOTIFY_RETRY_POLL_SEC", "10"))
+NOTIFY_CONNECTIONS = int(os.getenv("NOTIFY_CONNECTIONS", "4"))
+
+Recipients = Tuple[str, ...]  # 空タプルは broadcast
+
+
+def default_recipients() -> Optional[Recipients]:
+    if LINE_BROADCAST:
+        return ()
+    ids = tuple(x.strip() for x in LINE_TO_USER_ID.split(",") if x.strip())
+    return ids or None
+
+
+def _backoff(attempt: int) -> float:
+    return min(300.0, 2 ** attempt) + random.uniform(0, 1)
+
+
+def _retry_after(headers) -> Optional[float]:
+    v = headers.get("Retry-After")
+    if not v:
+        return None
+    try:
+        return max(0.0, float(v))
+    except ValueError:
+        return None
+
+
+# ---- 退避ファイル -------------------------------------------------------------
+
+def _read_retry(path: Path) -> List[Dict]:
+    try:
+        return json.loads(path.read_text(encoding="utf-8")) or []
+    except Exception:
+        return []
+
+
+def _write_retry(path: Path, entries: List[Dict]):
+    tmp = path.with_suffix(".tmp")
+    tmp.write_text(json.dumps(entries, ensure_ascii=False, indent=2), encoding="utf-8")
+    tmp.replace(path)
+
+
+def persist_retry(entry: Dict, path: Path = NOTIFY_RETRY_PATH):
+    with file_lock(path.with_name(path.name + ".lock")):
+        entries = _read_retry(path)
+        entries.append(entry)
+        _write_retry(path, entries)
+
+
+def take_due_retries(path: Path = NOTIFY_RETRY_PATH, now: Optional[float] = None) -> List[Dict]:
+    now = now or time.time()
+    if not path.exists():
+        return []
+    with file_lock(path.with_name(path.name + ".lock")):
+        entries = _read_retry(path)
+        due = [e for e in entries if e.get("due", 0) <= now]
+        if due:
+            _write_retry(path, [e for e in entries if e.get("due", 0) > now])
+    return due
+
+
+# ---- 非同期の送信係 -----------------------------------------------------------
+
+class Dispatcher:
+    def __init__(self, token: Optional[str] = LINE_CHANNEL_ACCESS_TOKEN,
+                 recipients: Optional[Recipients] = None, retry_path: Path = NOTIFY_RETRY_PATH):
+        self.token = token
+        self.recipients = default_recipients() if recipients is None else recipients
+        self.retry_path = Path(retry_path)
+        self.queue: Optional[asyncio.Queue] = None
+        self.session = None
+        self._tasks: List[asyncio.Task] = []
+        self._closing = False
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.token) and self.recipients is not None
+
+    def submit(self, text: str, to: Optional[Sequence[str]] = None):
+        # 判定側から呼ぶ。ブロックしない
+        if not self.enabled and to is None:
+            print("WARN: LINE_CHANNEL_ACCESS_TOKEN or LINE_TO_USER_ID not set; skip notify")
+            return
+        self.queue.put_nowait((tuple(to) if to is not None else self.recipients, text, time.time()))
+
+    async def start(self):
+        import aiohttp
+        self.queue = asyncio.Queue()
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=NOTIFY_CONNECTIONS, keepalive_timeout=60),
+            timeout=aiohttp.ClientTimeout(total=LINE_TIMEOUT))
+        self._tasks = [asyncio.create_task(self._run()), asyncio.create_task(self._retry_loop())]
+        return self
+
+    async def _collect(self) -> List[Tuple[Recipients, str]]:
+        batch = [await self.queue.get()]
+        deadline = asyncio.get_running_loop().time() + NOTIFY_BATCH_MS / 1000
+        while True:
+            remaining = deadline - asyncio.get_running_loop().time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self):
+        while True:
+            batch = await self._collect()
+            stop = None in batch
+            groups: Dict[Recipients, List[str]] = {}
+            submitted: Dict[Recipients, float] = {}
+            for item in batch:
+                if item is not None:
+                    groups.setdefault(item[0], []).append(item[1])
+                    submitted.setdefault(item[0], item[2])
+            await asyncio.gather(*(
+                self._send({"to": list(to[j:j + LINE_MAX_MULTICAST]), "texts": texts[i:i + LINE_MAX_MESSAGES],
+                            "submitted": submitted[to]})
+                for to, texts in groups.items()
+                for j in range(0, max(len(to), 1), LINE_MAX_MULTICAST)
+                for i in range(0, len(texts), LINE_MAX_MESSAGES)))
+            if stop:
+                return
+
+    async def _send(self, entry: Dict) -> bool:
+        # entry: {"to": [...], "texts": [...], "submitted": ts, "retry_key": str, "attempts": int}
+        entry.setdefault("retry_key", str(uuid.uuid4()))
+        entry.setdefault("attempts", 0)
+        url, body = build_request(entry["to"], entry["texts"])
+        headers = auth_headers(self.token, entry["retry_key"])
+        while entry["attempts"] < NOTIFY_MAX_ATTEMPTS:
+            entry["attempts"] += 1
+            wait = None
+            try:
+                with metrics.timer("notify"):
+                    async with self.session.post(url, headers=headers, data=json.dumps(body)) as r:
+                        text = (await r.text())[:300]
+                if r.status == 200 or r.status == 409:
+                    # 409: 同じ retry key で受理済み
+                    print(f"[notify] {r.status} to={len(entry['to']) or 'broadcast'} messages={len(entry['texts'])}")
+                    metrics.inc("notify_total", result="ok")
+                    if entry.get("submitted"):
+                        metrics.stage("notify_lag", time.time() - entry["submitted"])
+                    return True
+                if r.status != 429 and r.status < 500:
+                    print(f"[notify] dropped {r.status} {text}")
+                    metrics.inc("notify_total", result="dropped")
+                    return False
+                metrics.inc("notify_total", result=f"retry_{r.status}")
+                wait = _retry_after(r.headers)
+                print(f"[notify] {r.status} retry-after={wait} attempt={entry['attempts']}")
+            except Exception as e:
+                metrics.inc("notify_total", result="error")
+                print(f"[notify] error: {e} attempt={entry['attempts']}")
+            wait = _backoff(entry["attempts"]) if wait is None else wait
+            if self._closing or wait > NOTIFY_MAX_INLINE_WAIT_SEC:
+                entry["due"] = time.time() + wait
+                persist_retry(entry, self.retry_path)
+                print(f"[notify] deferred to {self.retry_path} (in {wait:.0f}s)")
+                metrics.inc("notify_total", result="deferred")
+                return False
+            await asyncio.sleep(wait)
+        print(f"[notify] giving up after {entry['attempts']} attempts: {entry['texts'][:1]}")
+        metrics.inc("notify_total", result="gave_up")
+        return False
+
+    async def _retry_loop(self):
+        while True:
+            due = await asyncio.to_thread(take_due_retries, self.retry_path)
+            try:
+                while due:
+                    await self._send(due[0])
+                    due.pop(0)
+            except asyncio.CancelledError:
+                # 終了時に送りかけていた分はファイルに戻す
+                for entry in due:
+                    persist_retry(entry, self.retry_path)
+                raise
+            await asyncio.sleep(NOTIFY_RETRY_POLL_SEC)
+
+    async def stop(self):
+        # 積まれている分は送り切ってから閉じる（待ちが長いものはファイルに退避される）
+        if self.queue is None:
+            return
+        self._closing = True
+        self.queue.put_nowait(None)
+        runner, retry = self._tasks
+        await runner
+        retry.cancel()
+        await asyncio.gather(retry, return_exceptions=True)
+        await self.session.close()
+        self.queue = None
+
+    async def __aenter__(self):
+        return await self.start()
+
+    async def __aexit__(self, *exc):
+        await self.stop()
+
+
+# ---- 同期版のチェッカー向け（裏スレッドで Dispatcher を回す） -------------------
+
+class ThreadedDispatcher:
+    def __init__(self, **kwargs):
+        self.dispatcher = Dispatcher(**kwargs)
+        self.loop = asyncio.new_event_loop()
+        self._ready = threading.Event()
+        self.thread = threading.Thread(target=self._main, name="notifier", daemon=True)
+        self.thread.start()
+        self._ready.wait()
+
+    def _main(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_until_complete(self.dispatcher.start())
+        self._ready.set()
+        self.loop.run_forever()
+
+    def submit(self, text: str, to: Optional[Sequence[str]] = None):
+        self.loop.call_soon_threadsafe(self.dispatcher.submit, text, to)
+
+    def close(self, timeout: float = 60):
+        fut = asyncio.run_coroutine_threadsafe(self.dispatcher.stop(), self.loop)
+        try:
+            fut.result(timeout)
+        except Exception as e:
+            print(f"[notify] shutdown error: {e}")
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join(timeout)
+
+
+_default: Optional[ThreadedDispatcher] = None
+_default_lock = threading.Lock()
+_installed: Optional[Tuple[Dispatcher, asyncio.AbstractEventLoop]] = None
+
+
+def install(dispatcher: Optional[Dispatcher]):
+    # すでにイベントループで動いている Dispatcher を notify() の送り先にする（pipeline.py 用、None で解除）。
+    # 裏スレッドの Dispatcher は作らない
+    global _installed
+    _installed = (dispatcher, asyncio.get_running_loop()) if dispatcher is not None else None
+
+
+def notify(text: str, to: Optional[Sequence[str]] = None):
+    global _default
+    if not LINE_CHANNEL_ACCESS_TOKEN or (to is None and default_recipients() is None):
+        print("WARN: LINE_CHANNEL_ACCESS_TOKEN or LINE_TO_USER_ID not set; skip notify")
+        return
+    if _installed is not None:
+        # 別スレッド（to_thread の中）から呼ばれても安全なように、ループ経由で積む
+        dispatcher, loop = _installed
+        loop.call_soon_threadsafe(dispatcher.submit, text, to)
+        return
+    with _default_lock:
+        if _default is None:
+            _default = ThreadedDispatcher()
+    _default.submit(text, to)
+
+
+def shutdown():
+    global _default
+    with _default_lock:
+        d, _default = _default, None
+    if d is not None:
+        d.close()
+
+
+atexit.register(shutdown)
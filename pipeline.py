@@ -0,0 +1,205 @@
+# pipeline.py
+# 取得 → 判定 → 確定 → 通知 を1つのプロセス・1つのイベントループで回す常駐モード。
+# デーモン（check_stock_daemon.py）は needs_confirm.json に積んで確定ステージを別プロセスで起動するが、
+# こちらは在庫あり化を検知したその場で、起動済みのブラウザを持つ確定ワーカーへ直接渡す。
+#
+#   取得・判定   デーモンと同じターゲットごとのポーラー（判定は fetch_one の中、DECIDE_WORKERS でプロセスプール）
+#       ↓ 上限付きキュー（PIPELINE_QUEUE_SIZE）。満杯なら該当ターゲットのポーラーが空くまで待つ
+#   確定         PIPELINE_CONFIRM_WORKERS 個のワーカー。描画は常駐の BrowserPool、プローブ型・一覧は取り直し
+#       ↓ notifier.Dispatcher（同じループ上でまとめて送信）
+#   通知
+#
+# needs_confirm.json も PIPELINE_QUEUE_POLL_SEC ごとに見て、他の段階（cron の light 等）が積んだものや
+# 確定に失敗して戻したものを拾う。止めるときに確定待ちで残っていたものは needs_confirm.json に戻す。
+#
+#   python pipeline.py     （または python -m restock check --stage pipeline / start.sh で PIPELINE=1）
+import asyncio, os, signal, time
+from contextlib import AsyncExitStack
+from typing import Dict, Optional
+
+import check_stock_aio as aio
+import check_stock_playwright as pw
+import metrics
+import notifier
+from browser_pool import PW_MAX_PAGES, BrowserPool
+from check_stock_daemon import Daemon
+from collection import fetch_items_sync, is_collection
+from confirm_queue import ConfirmQueue
+from json_probe import is_probe, probe_sync
+from stock_rules import Target
+from target_registry import TargetRegistry
+
+PIPELINE_QUEUE_SIZE = int(os.getenv("PIPELINE_QUEUE_SIZE", "32"))  # 確定待ちの上限（超えたら取得側を待たせる）
+PIPELINE_CONFIRM_WORKERS = int(os.getenv("PIPELINE_CONFIRM_WORKERS", str(PW_MAX_PAGES)))
+PIPELINE_QUEUE_POLL_SEC = float(os.getenv("PIPELINE_QUEUE_POLL_SEC", "5"))
+PIPELINE_WARM_BROWSER = os.getenv("PIPELINE_WARM_BROWSER", "1") == "1"  # 起動時にブラウザを立ち上げておく
+
+
+class Pipeline(Daemon):
+    def __init__(self, targets: list, registry: TargetRegistry = None):
+        super().__init__(targets, registry)
+        self.confirm_q: Optional[asyncio.Queue] = None
+        self.pending: Dict[str, dict] = {}  # 確定待ち・確定中（URL で重複排除）
+        self.pool: Optional[BrowserPool] = None
+        self._pool_lock = asyncio.Lock()
+        self._stack: Optional[AsyncExitStack] = None
+        self.file_queue = ConfirmQueue(aio.F_NEED)
+        self.http_headers = {"User-Agent": pw.USER_AGENT}
+
+    # ---- 取得 → 確定 -------------------------------------------------------------
+
+    async def enqueue(self, entry: dict):
+        if entry["url"] in self.pending:
+            return
+        self.pending[entry["url"]] = entry
+        # 満杯なら空くまで待つ（= 取得側へのバックプレッシャ。ブラウザに描画を溜め込まない）
+        await self.confirm_q.put(entry)
+        metrics.set_gauge("confirm_queue", self.confirm_q.qsize())
+
+    async def escalate(self, needs: list):
+        # 取得側はもう state の in_stock を書き換えているので、needs には検知前の値（prev）が入っている
+        now = time.time()
+        for n in needs:
+            await self.enqueue({**n, "detected": now})
+
+    async def feeder(self):
+        # ファイルのキュー（他の段階が積んだもの・失敗して戻したもの）から空きの分だけ拾う
+        while not self.stopping.is_set():
+            free = self.confirm_q.maxsize - self.confirm_q.qsize()
+            if free > 0:
+                for e in self.file_queue.claim(free):
+                    if e["url"] in self.pending:
+                        self.file_queue.ack([e["url"]], e["claim_id"])
+                        continue
+                    await self.enqueue({**e, "claimed": True, "detected": e["enqueued_ts"]})
+            try:
+                await asyncio.wait_for(self.stopping.wait(), PIPELINE_QUEUE_POLL_SEC)
+            except asyncio.TimeoutError:
+                pass
+
+    def apply_targets(self, session, diff):
+        super().apply_targets(session, diff)
+        pw._subs = None  # 購読者の対応表（targets.json の subscribers）も次の通知で読み直す
+
+    # ---- 確定 ---------------------------------------------------------------------
+
+    async def browser(self) -> BrowserPool:
+        async with self._pool_lock:
+            if self.pool is None:
+                self.pool = await self._stack.enter_async_context(
+                    BrowserPool(user_agent=pw.USER_AGENT, timeout_ms=pw.TIMEOUT * 1000))
+            return self.pool
+
+    async def confirm(self, entry: dict):
+        d = self.by_url.get(entry.get("collection") or entry["url"])
+        if d is None:
+            print(f"[confirm] not in targets, dropping: {entry['url']}")
+            return
+        updates = {}
+        state = self.state
+        if "prev" in entry:
+            # 検知前の在庫状態と比べて通知するかを決める
+            state = {entry["url"]: {**self.state.get(entry["url"], {}), "in_stock": entry["prev"]}}
+        if is_collection(d):
+            with metrics.timer("refetch", d["url"]):
+                items = await asyncio.to_thread(fetch_items_sync, d, self.http_headers, pw.TIMEOUT)
+            it = items.get(entry["url"])
+            # 一覧から消えた商品は不明扱い
+            pw.apply_decision(Target(name=it["name"] if it else entry["name"], url=entry["url"]),
+                              it["in_stock"] if it else None, state, updates, collection=d["url"])
+        elif is_probe(d):
+            with metrics.timer("refetch", d["url"]):
+                decision = await asyncio.to_thread(probe_sync, d, self.http_headers, pw.TIMEOUT)
+            pw.apply_decision(Target.from_dict(d), decision, state, updates, link=d.get("link"))
+        else:
+            t = Target.from_dict(d)
+            pw.apply_decision(t, await pw.confirm_one(await self.browser(), t), state, updates)
+        for url, fields in updates.items():
+            self.state[url] = {**self.state.get(url, {}), **fields}
+        with metrics.timer("state_write"):
+            self.store.update(updates)
+
+    async def confirm_worker(self):
+        while True:
+            entry = await self.confirm_q.get()
+            metrics.set_gauge("confirm_queue", self.confirm_q.qsize())
+            try:
+                with metrics.timer("confirm", entry["url"]):
+                    await self.confirm(entry)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"[confirm] {entry['name']}: {e}")
+                metrics.inc("errors_total", stage="confirm")
+                # 失敗はファイルのキューへ（試行回数と上限は ConfirmQueue に任せる）
+                if entry.get("claimed"):
+                    self.file_queue.nack([entry["url"]], entry["claim_id"])
+                else:
+                    aio.queue_needs([entry])
+            else:
+                if entry.get("claimed"):
+                    self.file_queue.ack([entry["url"]], entry["claim_id"])
+                metrics.stage("detect_to_confirm", time.time() - entry["detected"], entry["url"])
+            self.pending.pop(entry["url"], None)
+            self.confirm_q.task_done()
+
+    def spill(self):
+        # 止めるときに残っていた確定待ちはファイルのキューに戻す（claim 済みのものはリース切れで戻る）
+        left = [e for e in self.pending.values() if not e.get("claimed")]
+        if left:
+            aio.queue_needs([{k: e[k] for k in ("url", "name", "collection", "prev") if k in e} for e in left])
+        self.pending.clear()
+
+    # ---- 起動 ---------------------------------------------------------------------
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, self.stopping.set)
+            except NotImplementedError:
+                pass
+
+        print(f"[pipeline] {len(self.targets)} target(s), {PIPELINE_CONFIRM_WORKERS} confirm worker(s)")
+        metrics.serve()
+        metrics.set_gauge("targets", len(self.targets))
+        self.confirm_q = asyncio.Queue(maxsize=max(1, PIPELINE_QUEUE_SIZE))
+        async with AsyncExitStack() as stack:
+            self._stack = stack
+            notifier.install(await stack.enter_async_context(notifier.Dispatcher()))
+            stack.callback(notifier.install, None)
+            if PIPELINE_WARM_BROWSER and any(pw.needs_render(t) for t in self.targets):
+                await self.browser()
+            session = await stack.enter_async_context(aio.build_session())
+
+            workers = [asyncio.create_task(self.confirm_worker()) for _ in range(max(1, PIPELINE_CONFIRM_WORKERS))]
+            feeder = asyncio.create_task(self.feeder())
+            for url in self.by_url:
+                self.start_poller(session, url)
+            flusher = asyncio.create_task(self.flusher())
+            learner = asyncio.create_task(self.learner())
+            watcher = asyncio.create_task(self.watcher(session))
+            await self.stopping.wait()
+            pollers = list(self.pollers.values())
+            for task in pollers + workers + [feeder]:
+                task.cancel()
+            await asyncio.gather(*pollers, *workers, feeder, return_exceptions=True)
+            await flusher
+            await learner
+            await watcher
+            self.spill()
+        self.store.close()
+        print("[pipeline] stopped")
+
+
+async def main():
+    registry = TargetRegistry(aio.F_TARGETS)
+    targets = registry.load()
+    if not targets:
+        print("no targets.json entries")
+        return
+    await Pipeline(targets, registry).run()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,15 @@
+# restock/__init__.py
+# 各段階（light / aio / confirm / daemon）をまとめて起動する入口。使い方は __main__.py。
+# ここでは重いモジュールを一切 import しない（check_stock*.py からも読み込まれるため）。
+import os
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def load_env() -> bool:
+    # .env があるときだけ python-dotenv を読み込む（無ければ import のコストごと省く）
+    for p in (os.path.join(os.getcwd(), ".env"), os.path.join(ROOT, ".env")):
+        if os.path.isfile(p):
+            from dotenv import load_dotenv
+            return load_dotenv(p)
+    return False
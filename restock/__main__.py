@@ -0,0 +1,133 @@
+# restock/__main__.py
+# 各段階の共通の起動口。指定した段階のモジュールだけを、その段階を実行する時点で読み込む。
+#
+#   python -m restock check --stage light      # 軽量チェック（requests + 条件付きGET）
+#   python -m restock check --stage aio        # 非同期チェック1周
+#   python -m restock check --stage confirm    # 確定待ちがあるときだけ Playwright で確定＋通知（-- --all / --sync も可）
+#   python -m restock check --stage daemon     # 常駐デーモン
+#   python -m restock check --stage pipeline   # 取得→確定→通知を1プロセスで回す常駐モード（pipeline.py）
+#   python -m restock check --stage classic    # 旧来の check_stock.py（取得→判定→通知を1本で）
+#   python -m restock importtime               # 段階ごとの import 時間を計測（python -X importtime）
+#
+# confirm は確定待ちが無ければ Playwright・通知まわりを読み込まずにすぐ終わる。
+# --timing を付けると、読み込みと実行にかかった時間を最後に出す。
+import os, sys, time
+
+from restock import ROOT, load_env
+
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+STAGE_MODULES = {
+    "light": "check_stock_light",
+    "aio": "check_stock_aio",
+    "confirm": "check_stock_playwright",
+    "daemon": "check_stock_daemon",
+    "pipeline": "pipeline",
+    "classic": "check_stock",
+}
+
+
+def run_stage(stage: str, extra) -> float:
+    # 戻り値: モジュールの読み込みにかかった秒数
+    if stage == "confirm":
+        from confirm_queue import ConfirmQueue
+        if "--all" not in extra and not ConfirmQueue(os.getenv("TRIGGER_PATH", "needs_confirm.json")).pending():
+            print("[restock] no pending confirmations")
+            return 0.0
+    t0 = time.perf_counter()
+    mod = __import__(STAGE_MODULES[stage])
+    loaded = time.perf_counter() - t0
+    if stage in ("aio", "daemon", "pipeline"):
+        import asyncio
+        asyncio.run(mod.main())
+    elif stage == "confirm":
+        mod.run(extra)
+    elif stage == "classic":
+        mod.run()
+    else:
+        mod.main()
+    return loaded
+
+
+# ---- import 時間の計測 ----------------------------------------------------------------
+
+def parse_importtime(stderr: str, module: str):
+    # "import time: self [us] | cumulative | imported package" の行から
+    # (モジュール全体の累積 µs, 直下の依存 [(累積 µs, 名前)]) を取り出す
+    total, children, pending = None, [], []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        parts = line[len("import time:"):].split("|")
+        if len(parts) != 3 or not parts[1].strip().isdigit():
+            continue
+        cum, name = int(parts[1]), parts[2].rstrip()
+        depth = (len(name) - len(name.lstrip())) // 2
+        name = name.strip()
+        if depth == 0 and name == module:
+            total = cum
+            children = pending
+            break
+        if depth == 1:
+            pending.append((cum, name))
+        elif depth == 0:
+            pending = []
+    return total, sorted(children, reverse=True)
+
+
+def importtime(stages, repeat: int, top: int):
+    import statistics, subprocess
+
+    def wall(code: str):
+        runs, err = [], ""
+        for _ in range(repeat):
+            t0 = time.perf_counter()
+            p = subprocess.run([sys.executable, "-X", "importtime", "-c", code], cwd=ROOT,
+                               capture_output=True, text=True)
+            runs.append(time.perf_counter() - t0)
+            err = p.stderr if p.returncode == 0 else (p.stderr.strip().splitlines() or ["failed"])[-1]
+            if p.returncode != 0:
+                return None, err
+        return statistics.median(runs), err
+
+    base, _ = wall("pass")
+    print(f"[importtime] interpreter start: {base * 1000:.1f} ms (median of {repeat})")
+    print(f"{'stage':>8} {'import_ms':>10} {'wall_ms':>8}  heaviest imports")
+    for stage in stages:
+        module = STAGE_MODULES[stage]
+        sec, err = wall(f"import {module}")
+        if sec is None:
+            print(f"{stage:>8}  error: {err}")
+            continue
+        total, children = parse_importtime(err, module)
+        heavy = ", ".join(f"{n} {c / 1000:.1f}" for c, n in children[:top])
+        print(f"{stage:>8} {(total or 0) / 1000:>10.1f} {sec * 1000:>8.1f}  {heavy}")
+
+
+def main():
+    import argparse
+    ap = argparse.ArgumentParser(prog="python -m restock")
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    c = sub.add_parser("check")
+    c.add_argument("--stage", choices=sorted(STAGE_MODULES), default="light")
+    c.add_argument("--timing", action="store_true")
+    it = sub.add_parser("importtime")
+    it.add_argument("--stages", default=",".join(STAGE_MODULES))
+    it.add_argument("--repeat", type=int, default=3)
+    it.add_argument("--top", type=int, default=5)
+    args, extra = ap.parse_known_args()
+    extra = [a for a in extra if a != "--"]
+
+    if args.cmd == "importtime":
+        importtime(args.stages.split(","), args.repeat, args.top)
+        return
+    t0 = time.perf_counter()
+    load_env()
+    loaded = run_stage(args.stage, extra)
+    if args.timing:
+        print(f"[restock] {args.stage}: import {loaded * 1000:.1f} ms, total {(time.perf_counter() - t0) * 1000:.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
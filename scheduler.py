@@ -0,0 +1,177 @@
+# scheduler.py
+# ターゲットごとの適応ポーリング間隔と、ホストごとのリクエスト予算（トークンバケット）。
+#
+# 間隔の決め方:
+#   - 既知の販売開始ウィンドウ（drop_windows）内 / ページ変化直後 → 最短間隔
+#     （history_log.py が過去の再入荷から学習したウィンドウも learn() で足せる）
+#   - 304 や「ハッシュ変化なし」が続く → BACKOFF_FACTOR 倍ずつ最長間隔まで伸ばす
+#   - エラー → 同様に伸ばす（相手に負荷をかけ続けない）
+# targets.json の各エントリで poll_ms / min_poll_ms / max_poll_ms / drop_windows を上書き可能
+# （learn_windows: false で学習したウィンドウを使わない）。
+import asyncio, os, random, time
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import urlsplit
+
+POLL_MS = int(os.getenv("POLL_INTERVAL_MS", "500"))
+JITTER_MS = int(os.getenv("JITTER_MS", "200"))
+MIN_POLL_MS = int(os.getenv("MIN_POLL_MS", str(POLL_MS)))
+MAX_POLL_MS = int(os.getenv("MAX_POLL_MS", "15000"))
+BACKOFF_FACTOR = float(os.getenv("BACKOFF_FACTOR", "1.5"))
+HOT_AFTER_CHANGE_SEC = int(os.getenv("HOT_AFTER_CHANGE_SEC", "120"))  # 変化後しばらくは最短間隔
+DROP_WINDOWS = os.getenv("DROP_WINDOWS", "")  # 例: "10:00-10:30;Fri 20:00-21:00"
+
+HOST_RATE_PER_SEC = float(os.getenv("HOST_RATE_PER_SEC", "4"))
+HOST_BURST = float(os.getenv("HOST_BURST", "8"))
+HOST_RATES = os.getenv("HOST_RATES", "")  # 例: "www.popmart.com=2,example.com=10"
+
+WEEKDAYS = ["mon", "tue", "wed", "thu", "fri", "sat", "sun"]
+
+
+def host_of(url: str) -> str:
+    return (urlsplit(url).hostname or "").lower()
+
+
+def _parse_hm(s: str) -> int:
+    h, m = s.split(":")
+    return int(h) * 60 + int(m)
+
+
+def parse_drop_windows(spec) -> List[Tuple[Optional[set], int, int]]:
+    # "[Mon,Fri ]HH:MM-HH:MM" を ; 区切り（またはリスト）で受け付ける
+    items = spec if isinstance(spec, list) else [x for x in (spec or "").split(";")]
+    windows = []
+    for raw in items:
+        raw = raw.strip()
+        if not raw:
+            continue
+        days = None
+        if " " in raw:
+            day_part, raw = raw.split(None, 1)
+            days = {WEEKDAYS.index(d.strip().lower()[:3]) for d in day_part.split(",")}
+        start, end = raw.split("-")
+        windows.append((days, _parse_hm(start), _parse_hm(end)))
+    return windows
+
+
+def in_windows(windows, now: Optional[datetime] = None) -> bool:
+    now = now or datetime.now()
+    minute = now.hour * 60 + now.minute
+    for days, start, end in windows:
+        if start <= end:
+            hit = start <= minute < end
+            day = now.weekday()
+        else:
+            # 日付をまたぐ窓（例 23:50-00:10）: 翌日側は前日の曜日として扱う
+            hit = minute >= start or minute < end
+            day = now.weekday() if minute >= start else (now.weekday() - 1) % 7
+        if hit and (days is None or day in days):
+            return True
+    return False
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = max(1.0, burst)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class HostBudgets:
+    def __init__(self, rate: float = HOST_RATE_PER_SEC, burst: float = HOST_BURST, overrides: str = HOST_RATES,
+                 scale: float = 1):
+        # scale: 出口（egress.py）の数。予算は出口1つあたりなので、まとめて scale 倍にする
+        self.rate = rate
+        self.burst = burst
+        self.scale = scale
+        self.overrides: Dict[str, float] = {}
+        for item in overrides.split(","):
+            if "=" in item:
+                host, r = item.split("=", 1)
+                self.overrides[host.strip().lower()] = float(r)
+        self.buckets: Dict[str, TokenBucket] = {}
+
+    def bucket(self, host: str) -> Optional[TokenBucket]:
+        # レート 0 以下のホストは無制限
+        if host not in self.buckets:
+            rate = self.overrides.get(host, self.rate) * self.scale
+            self.buckets[host] = TokenBucket(rate, max(self.burst * self.scale, rate)) if rate > 0 else None
+        return self.buckets[host]
+
+    async def acquire(self, url: str):
+        b = self.bucket(host_of(url))
+        if b is not None:
+            await b.acquire()
+
+
+class TargetSchedule:
+    __slots__ = ("base_ms", "min_ms", "max_ms", "configured", "windows", "interval_ms", "hot_until")
+
+    def __init__(self, target: dict, global_windows, learned=None):
+        self.base_ms = int(target.get("poll_ms", POLL_MS))
+        self.min_ms = int(target.get("min_poll_ms", min(MIN_POLL_MS, self.base_ms)))
+        self.max_ms = int(target.get("max_poll_ms", max(MAX_POLL_MS, self.base_ms)))
+        self.configured = global_windows + parse_drop_windows(target.get("drop_windows") or [])
+        self.windows = self.configured + parse_drop_windows(learned or [])
+        self.interval_ms = float(self.base_ms)
+        self.hot_until = 0.0
+
+
+class AdaptiveScheduler:
+    def __init__(self, drop_windows: str = DROP_WINDOWS):
+        self.global_windows = parse_drop_windows(drop_windows)
+        self.schedules: Dict[str, TargetSchedule] = {}
+        self.learned: Dict[str, List[str]] = {}
+
+    def schedule(self, target: dict) -> TargetSchedule:
+        url = target["url"]
+        s = self.schedules.get(url)
+        if s is None:
+            s = self.schedules[url] = TargetSchedule(target, self.global_windows, self.learned.get(url))
+        return s
+
+    def forget(self, url: str):
+        # ターゲットの設定が変わった・削除されたとき。次に使うときに作り直す
+        self.schedules.pop(url, None)
+
+    def learn(self, learned: Dict[str, List[str]]):
+        # 過去の再入荷から学習したウィンドウ（URL → "Fri 19:50-21:00" 形式のリスト）を差し替える。
+        # 設定済みのウィンドウはそのまま、間隔の学習状態も引き継ぐ
+        self.learned = learned
+        for url, s in self.schedules.items():
+            s.windows = s.configured + parse_drop_windows(learned.get(url) or [])
+
+    def observe(self, target: dict, res: dict):
+        s = self.schedule(target)
+        if res["status"] == "ok" and res.get("changed"):
+            s.hot_until = time.monotonic() + HOT_AFTER_CHANGE_SEC
+            s.interval_ms = s.min_ms
+        else:
+            # 304 / 変化なし / エラー → 徐々に間隔を伸ばす
+            s.interval_ms = min(s.max_ms, max(s.interval_ms, s.min_ms) * BACKOFF_FACTOR)
+
+    def next_delay(self, target: dict) -> float:
+        s = self.schedule(target)
+        if time.monotonic() < s.hot_until or in_windows(s.windows):
+            ms = s.min_ms
+        else:
+            ms = s.interval_ms
+        # ジッターは間隔に比例させつつ JITTER_MS を下限にする
+        jit = max(JITTER_MS, int(ms * 0.1))
+        return max(100, ms + random.randint(-jit, jit)) / 1000
@@ -0,0 +1,165 @@
+# sharding.py
+# targets.json を URL のコンシステントハッシュで N 個のシャードに分け、プロセス（またはマシン）ごとに受け持つ。
+# シャード数を変えても、動くターゲットは全体の 1/N 程度で済む（ヘッダキャッシュや適応間隔が無駄になりにくい）。
+#
+#   SHARD_COUNT=4 SHARD_INDEX=0 python check_stock_daemon.py   # 4分割のうち0番だけを監視
+#   SHARD_SEPARATE_STATE=1  state / headers_cache をシャードごとのファイル（state.shard0.json 等）に分ける。
+#                           別マシンの結果を1か所に集めて `merge` でまとめる用。
+#                           同じマシン上なら不要（state_store はロックしてフィールド単位でマージする）
+#
+# コーディネータ:
+#   python sharding.py run --shards 4 --stage daemon   # 子プロセスを4つ起動して待つ（Ctrl-C で全部止める）
+#   python sharding.py run --shards 4 --stage aio      # 1周だけ。SHARD_SEPARATE_STATE=1 なら最後に merge
+#   python sharding.py merge --shards 4                # シャードの state を本体へ（ts が新しい方を採用）
+#   python sharding.py show --shards 4                 # シャードごとの件数
+import hashlib, json, os, sys
+from bisect import bisect
+from pathlib import Path
+from typing import Dict, List
+
+SHARD_COUNT = int(os.getenv("SHARD_COUNT", "1"))
+SHARD_INDEX = int(os.getenv("SHARD_INDEX", "0"))
+SHARD_VNODES = int(os.getenv("SHARD_VNODES", "160"))  # 1シャードあたりのリング上の点の数（偏りを減らす）
+SHARD_SEPARATE_STATE = os.getenv("SHARD_SEPARATE_STATE", "0") == "1"
+
+ROOT = Path(__file__).resolve().parent
+STAGES = {
+    "aio": "check_stock_aio.py",
+    "daemon": "check_stock_daemon.py",
+    "light": "check_stock_light.py",
+    "pipeline": "pipeline.py",
+}
+
+
+def _point(key: str) -> int:
+    return int.from_bytes(hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest(), "big")
+
+
+class HashRing:
+    def __init__(self, count: int, vnodes: int = SHARD_VNODES):
+        ring = sorted((_point(f"shard-{i}#{v}"), i) for i in range(count) for v in range(vnodes))
+        self.points = [p for p, _ in ring]
+        self.owners = [i for _, i in ring]
+
+    def shard_of(self, url: str) -> int:
+        if not self.points:
+            return 0
+        i = bisect(self.points, _point(url.strip().lower())) % len(self.points)
+        return self.owners[i]
+
+
+_rings: Dict[int, HashRing] = {}
+
+
+def shard_of(url: str, count: int = SHARD_COUNT) -> int:
+    if count <= 1:
+        return 0
+    if count not in _rings:
+        _rings[count] = HashRing(count)
+    return _rings[count].shard_of(url)
+
+
+def shard_targets(targets: List[dict], index: int = SHARD_INDEX, count: int = SHARD_COUNT) -> List[dict]:
+    # 一覧ページ（collection）は一覧ページの URL で振り分ける（配下の商品は同じシャードの state に入る）
+    if count <= 1:
+        return targets
+    mine = [t for t in targets if shard_of(t["url"], count) == index]
+    print(f"[shard] {index}/{count}: {len(mine)} of {len(targets)} target(s)")
+    return mine
+
+
+def _suffixed(path, index: int):
+    p = Path(path)
+    out = p.with_name(f"{p.stem}.shard{index}{p.suffix}")
+    return out if isinstance(path, Path) else str(out)
+
+
+def shard_path(path):
+    # SHARD_SEPARATE_STATE=1 のときだけ state.json → state.shard{i}.json
+    if not SHARD_SEPARATE_STATE or SHARD_COUNT <= 1:
+        return path
+    return _suffixed(path, SHARD_INDEX)
+
+
+# ---- コーディネータ ------------------------------------------------------------------
+
+def merge(shards: int, state_path, headers_path) -> int:
+    # シャードの行を本体にフィールド単位でマージする。同じ URL なら ts が新しい方。
+    # 通知時刻（確定ステージの持ち物）は本体のものを残す
+    from state_store import open_store, without_owned
+    main = open_store(state_path, headers_path)
+    current = main.load()
+    merged = 0
+    for i in range(shards):
+        shard = open_store(_suffixed(state_path, i), _suffixed(headers_path, i))
+        rows = {u: without_owned(r) for u, r in shard.load().items()
+                if int(r.get("ts") or 0) >= int(current.get(u, {}).get("ts") or 0)}
+        if rows:
+            main.update(rows)
+            current.update(rows)
+        main.update_headers(shard.load_headers())
+        shard.close()
+        print(f"[shard] merged {len(rows)} row(s) from shard {i}")
+        merged += len(rows)
+    main.close()
+    return merged
+
+
+def run(shards: int, stage: str) -> int:
+    import signal, subprocess
+    procs = []
+    for i in range(shards):
+        env = dict(os.environ, SHARD_INDEX=str(i), SHARD_COUNT=str(shards))
+        procs.append(subprocess.Popen([sys.executable, str(ROOT / STAGES[stage])], cwd=str(ROOT), env=env))
+    print(f"[shard] started {shards} {stage} worker(s)")
+
+    def forward(sig, _frame):
+        for p in procs:
+            if p.poll() is None:
+                p.send_signal(sig)
+
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(sig, forward)
+    codes = [p.wait() for p in procs]
+    if codes.count(0) != len(codes):
+        print(f"[shard] exit codes: {codes}")
+    return max(codes, key=abs)
+
+
+def main():
+    import argparse
+    ap = argparse.ArgumentParser()
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    r = sub.add_parser("run")
+    r.add_argument("--shards", type=int, default=os.cpu_count() or 1)
+    r.add_argument("--stage", choices=sorted(STAGES), default="daemon")
+    m = sub.add_parser("merge")
+    m.add_argument("--shards", type=int, default=SHARD_COUNT)
+    s = sub.add_parser("show")
+    s.add_argument("--shards", type=int, default=SHARD_COUNT)
+    for p in (r, m, s):
+        p.add_argument("--state", default=os.getenv("STATE_PATH", "state.json"))
+        p.add_argument("--headers", default=os.getenv("HEADERS_PATH", "headers_cache.json"))
+        p.add_argument("--targets", default=os.getenv("TARGETS_PATH", "targets.json"))
+    args = ap.parse_args()
+
+    if args.cmd == "run":
+        code = run(args.shards, args.stage)
+        if SHARD_SEPARATE_STATE and args.stage != "daemon":
+            merge(args.shards, args.state, args.headers)
+        sys.exit(code)
+    if args.cmd == "merge":
+        merge(args.shards, args.state, args.headers)
+        return
+    # 実際の振り分けと同じく、URL を正規化して重複をまとめてから数える
+    from subscriptions import dedupe_targets
+    targets = dedupe_targets(json.loads(Path(args.targets).read_text(encoding="utf-8")))
+    counts = [0] * max(1, args.shards)
+    for t in targets:
+        counts[shard_of(t["url"], args.shards)] += 1
+    for i, n in enumerate(counts):
+        print(f"shard {i}: {n}")
+
+
+if __name__ == "__main__":
+    main()
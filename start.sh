@@ -5,6 +5,18 @@ set -euo pipefail
 POLL_MS="${POLL_INTERVAL_MS:-500}"
 JITTER_MS="${JITTER_MS:-200}"
 
+# 既定は常駐デーモン（セッション・状態を保持したまま各ターゲットを個別タイマーで監視）
+# 旧来の「毎回プロセス起動」ループに戻したい場合は LEGACY_LOOP=1
+# PIPELINE=1 なら確定ステージも同じプロセスで回す（検知からブラウザ確定まで待ち時間なし）
+if [ "${PIPELINE:-0}" = "1" ]; then
+  echo "[start] pipeline: ${POLL_MS}ms ± ${JITTER_MS}ms"
+  exec python pipeline.py
+fi
+if [ "${LEGACY_LOOP:-0}" != "1" ]; then
+  echo "[start] daemon: ${POLL_MS}ms ± ${JITTER_MS}ms"
+  exec python check_stock_daemon.py
+fi
+
 echo "[start] loop: ${POLL_MS}ms ± ${JITTER_MS}ms"
 
 while :; do
@@ -13,12 +25,8 @@ while :; do
     echo "[trigger] running heavy confirm..."
     python check_stock_playwright.py || true
   fi
-  # ジッター付きスリープ
-  sleep "$(python - <<'PY'
-import os,random
-base=int(os.environ.get('POLL_INTERVAL_MS','500'))
-jit=int(os.environ.get('JITTER_MS','200'))
-print(max(100, base + random.randint(-jit, jit))/1000)
-PY
-)"
+  # ジッター付きスリープ（bash の $RANDOM で計算し、python は起動しない）
+  delay_ms=$(( POLL_MS - JITTER_MS + RANDOM % (2 * JITTER_MS + 1) ))
+  [ "$delay_ms" -lt 100 ] && delay_ms=100
+  sleep "$(printf '%d.%03d' $((delay_ms / 1000)) $((delay_ms % 1000)))"
 done
@@ -0,0 +1,224 @@
+# state_store.py
+# 監視状態（在庫判定・ハッシュ・ETag/Last-Modified・通知時刻）の保存先。
+#
+#   STATE_BACKEND=json   (既定) state.json / headers_cache.json。更新はロックを取って
+#                        ファイル上の最新内容に「差分だけ」マージしてから原子的に書き換える
+#   STATE_BACKEND=sqlite state.db（WAL）。URLごとの行を更新し、在庫・ハッシュの変化は history に残す
+#
+# どちらも update() は行の置き換えではなくフィールド単位のマージなので、
+# 軽量ステージと確定ステージが同じURLを書いても last_notify_ts 等を消し合わない。
+# load() / load_headers() は正規化前の URL の行も正規化後のキーで読めるようにして返す（target_registry.adopt_aliases）。
+import json, os, time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+from target_registry import adopt_aliases
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+STATE_BACKEND = os.getenv("STATE_BACKEND", "json")
+STATE_DB = os.getenv("STATE_DB", "")  # 省略時は state.json と同じ場所の state.db
+
+Rows = Dict[str, Dict[str, Any]]
+
+# 確定ステージ（通知側）が管理するフィールド。軽量ステージは書き込まない
+CONFIRM_OWNED_FIELDS = ("last_notify_ts",)
+
+
+def without_owned(row: Dict[str, Any]) -> Dict[str, Any]:
+    return {k: v for k, v in row.items() if k not in CONFIRM_OWNED_FIELDS}
+
+
+@contextmanager
+def file_lock(path: Path):
+    with open(path, "a+") as lf:
+        if fcntl:
+            fcntl.flock(lf, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl:
+                fcntl.flock(lf, fcntl.LOCK_UN)
+
+
+def _merge(current: Rows, rows: Rows) -> Rows:
+    for url, fields in rows.items():
+        current[url] = {**current.get(url, {}), **fields}
+    return current
+
+
+class JsonStateStore:
+    def __init__(self, state_path, headers_path):
+        self.state_path = Path(state_path)
+        self.headers_path = Path(headers_path)
+
+    @staticmethod
+    def _read(p: Path) -> Rows:
+        try:
+            return json.loads(p.read_text(encoding="utf-8"))
+        except Exception:
+            return {}
+
+    @staticmethod
+    def _write(p: Path, data: Rows):
+        tmp = p.with_suffix(".tmp")
+        tmp.write_text(json.dumps(data, ensure_ascii=False, indent=2), encoding="utf-8")
+        tmp.replace(p)
+
+    def _update(self, p: Path, rows: Rows):
+        if not rows:
+            return
+        with file_lock(p.with_name(p.name + ".lock")):
+            self._write(p, _merge(self._read(p), rows))
+
+    def load(self) -> Rows:
+        return adopt_aliases(self._read(self.state_path))
+
+    def load_headers(self) -> Rows:
+        return adopt_aliases(self._read(self.headers_path))
+
+    def update(self, rows: Rows):
+        self._update(self.state_path, rows)
+
+    def update_headers(self, rows: Rows):
+        self._update(self.headers_path, rows)
+
+    def close(self):
+        pass
+
+
+class SqliteStateStore:
+    # state 表の既知カラム。それ以外のフィールドは extra / hdrs_extra (JSON) に入れる
+    STATE_COLS = ("name", "in_stock", "hash", "ts", "last_notify_ts")
+    HDR_COLS = ("etag", "last_modified")
+    HISTORY_FIELDS = ("in_stock", "hash")
+
+    def __init__(self, db_path):
+        import sqlite3  # json バックエンドでは読み込まない
+        self.db_path = str(db_path)
+        self.conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS state (
+                url TEXT PRIMARY KEY,
+                name TEXT,
+                in_stock INTEGER,
+                hash TEXT,
+                ts INTEGER,
+                last_notify_ts INTEGER,
+                etag TEXT,
+                last_modified TEXT,
+                extra TEXT,
+                hdrs_extra TEXT
+            );
+            CREATE TABLE IF NOT EXISTS history (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                url TEXT NOT NULL,
+                ts INTEGER NOT NULL,
+                field TEXT NOT NULL,
+                old TEXT,
+                new TEXT
+            );
+            CREATE INDEX IF NOT EXISTS history_url_ts ON history(url, ts);
+        """)
+
+    @staticmethod
+    def _to_db(col: str, v):
+        if col == "in_stock" and v is not None:
+            return int(bool(v))
+        return v
+
+    @staticmethod
+    def _from_db(col: str, v):
+        if col == "in_stock" and v is not None:
+            return bool(v)
+        return v
+
+    def _rows(self, cols, extra_col, where: str = "") -> Rows:
+        out: Rows = {}
+        q = f"SELECT url, {', '.join(cols)}, {extra_col} FROM state {where}"
+        for row in self.conn.execute(q):
+            url, vals, extra = row[0], row[1:-1], row[-1]
+            # in_stock は NULL（不明）も意味を持つので常にキーを持たせる
+            d = {c: self._from_db(c, v) for c, v in zip(cols, vals) if v is not None or c == "in_stock"}
+            if extra:
+                d.update(json.loads(extra))
+            if d:
+                out[url] = d
+        return out
+
+    def load(self) -> Rows:
+        # ヘッダだけが入っている行（まだ一度も判定していないURL）は除く
+        return adopt_aliases(self._rows(self.STATE_COLS, "extra", "WHERE ts IS NOT NULL"))
+
+    def load_headers(self) -> Rows:
+        return adopt_aliases(self._rows(self.HDR_COLS, "hdrs_extra",
+                             "WHERE etag IS NOT NULL OR last_modified IS NOT NULL OR hdrs_extra IS NOT NULL"))
+
+    def _upsert(self, rows: Rows, cols, extra_col, history: bool):
+        if not rows:
+            return
+        now = int(time.time())
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            for url, fields in rows.items():
+                cur = self.conn.execute(
+                    f"SELECT {', '.join(cols)}, {extra_col} FROM state WHERE url = ?", (url,)).fetchone()
+                old = dict(zip(cols, cur[:-1])) if cur else {}
+                extra = json.loads(cur[-1]) if cur and cur[-1] else {}
+                new = dict(old)
+                for k, v in fields.items():
+                    if k in cols:
+                        new[k] = self._to_db(k, v)
+                    else:
+                        extra[k] = v
+                if history and cur:
+                    for f in self.HISTORY_FIELDS:
+                        if f in fields and old.get(f) != new.get(f):
+                            self.conn.execute(
+                                "INSERT INTO history (url, ts, field, old, new) VALUES (?, ?, ?, ?, ?)",
+                                (url, now, f, None if old.get(f) is None else str(old.get(f)),
+                                 None if new.get(f) is None else str(new.get(f))))
+                assigns = list(cols) + [extra_col]
+                values = [new.get(c) for c in cols] + [json.dumps(extra, ensure_ascii=False) if extra else None]
+                self.conn.execute(
+                    f"INSERT INTO state (url, {', '.join(assigns)}) VALUES (?, {', '.join('?' for _ in assigns)}) "
+                    f"ON CONFLICT(url) DO UPDATE SET {', '.join(f'{c} = excluded.{c}' for c in assigns)}",
+                    [url] + values)
+            self.conn.execute("COMMIT")
+        except Exception:
+            self.conn.execute("ROLLBACK")
+            raise
+
+    def update(self, rows: Rows):
+        self._upsert(rows, self.STATE_COLS, "extra", history=True)
+
+    def update_headers(self, rows: Rows):
+        self._upsert(rows, self.HDR_COLS, "hdrs_extra", history=False)
+
+    def history(self, url: Optional[str] = None, limit: int = 100):
+        q = "SELECT url, ts, field, old, new FROM history"
+        args = []
+        if url:
+            q += " WHERE url = ?"
+            args.append(url)
+        q += " ORDER BY id DESC LIMIT ?"
+        args.append(limit)
+        return [dict(zip(("url", "ts", "field", "old", "new"), r)) for r in self.conn.execute(q, args)]
+
+    def close(self):
+        self.conn.close()
+
+
+def open_store(state_path, headers_path, backend: Optional[str] = None):
+    backend = backend or STATE_BACKEND
+    if backend == "sqlite":
+        return SqliteStateStore(STATE_DB or Path(state_path).with_suffix(".db"))
+    if backend == "json":
+        return JsonStateStore(state_path, headers_path)
+    raise ValueError(f"unknown STATE_BACKEND: {backend}")
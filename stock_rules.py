@@ -0,0 +1,265 @@
+# stock_rules.py
+# 在庫判定ルールの共通エンジン。各チェッカーで重複していた判定ロジックをここに集約する。
+#
+#   - Target は1回だけ compile_target() でコンパイルし、セレクタ（事前パース済み）と
+#     文言マッチャ（1本の正規表現）を保持する
+#   - HTML のパースは PARSER_BACKEND で選択（auto: selectolax > lxml > bs4 の順に使えるものを使う）
+#   - keyword_matcher() は aio 段階の「HTML全体から文言を探す」判定を1パスで行う
+import os, re
+from dataclasses import dataclass, fields
+from typing import Dict, List, Optional, Tuple
+
+PARSER_BACKEND = os.getenv("PARSER_BACKEND", "auto")  # auto | selectolax | lxml | bs4
+
+# aio 段階の文言判定で、ターゲットに文言の指定が無いときに使うもの
+DEFAULT_IN_WORDS = ["カートに追加する", "今すぐ購入", "Add to cart", "Buy now"]
+DEFAULT_OUT_WORDS = ["在庫切れ", "売り切れ", "SOLD OUT", "在庫なし", "再入荷を通知"]
+
+
+@dataclass
+class Target:
+    name: str
+    url: str
+    in_stock_css: str = ""
+    in_stock_text_contains: Optional[List[str]] = None
+    out_of_stock_css: Optional[str] = None
+    out_of_stock_text_contains: Optional[List[str]] = None
+
+    @classmethod
+    def from_dict(cls, d: dict) -> "Target":
+        # targets.json に拡張フィールドがあっても落ちないよう、知っている項目だけ拾う
+        known = {f.name for f in fields(cls)}
+        return cls(**{k: v for k, v in d.items() if k in known})
+
+
+def _words_regex(words: List[str], flags: int = 0):
+    words = [w for w in words if w]
+    if not words:
+        return None
+    # 長い語を先に並べて、同じ位置から始まる短い語に食われないようにする
+    return re.compile("|".join(re.escape(w) for w in sorted(words, key=len, reverse=True)), flags)
+
+
+# ---- パーサのバックエンド ----------------------------------------------------
+# 各バックエンドは parse(html) / compile(css) / select_nodes(doc, compiled) / node_text(node) を持つ
+
+def _text_of_parts(parts) -> str:
+    return " ".join(p.strip() for p in parts if p and p.strip())
+
+
+class _SelectolaxBackend:
+    name = "selectolax"
+
+    def __init__(self):
+        from selectolax.parser import HTMLParser
+        self._parser = HTMLParser
+
+    def parse(self, html: str):
+        return self._parser(html)
+
+    def compile(self, css: str):
+        return css
+
+    def select_nodes(self, doc, compiled):
+        return doc.css(compiled)
+
+    def node_text(self, node) -> str:
+        return node.text(separator=" ", strip=True)
+
+    def node_attrs(self, node) -> Dict[str, str]:
+        return dict(node.attributes)
+
+
+class _LxmlBackend:
+    name = "lxml"
+
+    def __init__(self):
+        import lxml.html
+        from lxml.cssselect import CSSSelector
+        self._html = lxml.html
+        self._selector = CSSSelector
+        self._parser = lxml.html.HTMLParser(encoding="utf-8")
+
+    def parse(self, html: str):
+        return self._html.document_fromstring(html.encode("utf-8", errors="ignore"), parser=self._parser)
+
+    def compile(self, css: str):
+        return self._selector(css, translator="html")
+
+    def select_nodes(self, doc, compiled):
+        return compiled(doc)
+
+    def node_text(self, node) -> str:
+        return _text_of_parts(node.itertext())
+
+    def node_attrs(self, node) -> Dict[str, str]:
+        return dict(node.attrib)
+
+
+class _Bs4Backend:
+    name = "bs4"
+
+    def __init__(self):
+        from bs4 import BeautifulSoup
+        import soupsieve
+        self._soup = BeautifulSoup
+        self._sv = soupsieve
+        try:
+            import lxml  # noqa: F401
+            self._features = "lxml"
+        except ImportError:
+            self._features = "html.parser"
+
+    def parse(self, html: str):
+        return self._soup(html, self._features)
+
+    def compile(self, css: str):
+        return self._sv.compile(css)
+
+    def select_nodes(self, doc, compiled):
+        return compiled.select(doc)
+
+    def node_text(self, node) -> str:
+        return node.get_text(separator=" ", strip=True)
+
+    def node_attrs(self, node) -> Dict[str, str]:
+        return {k: " ".join(v) if isinstance(v, list) else v for k, v in node.attrs.items()}
+
+
+_BACKENDS = {"selectolax": _SelectolaxBackend, "lxml": _LxmlBackend, "bs4": _Bs4Backend}
+_backend_cache: Dict[str, object] = {}
+
+
+def get_backend(name: str = PARSER_BACKEND):
+    if name in _backend_cache:
+        return _backend_cache[name]
+    order = ["selectolax", "lxml", "bs4"] if name == "auto" else [name]
+    last_err = None
+    for candidate in order:
+        try:
+            backend = _BACKENDS[candidate]()
+        except ImportError as e:
+            last_err = e
+            continue
+        _backend_cache[name] = backend
+        return backend
+    raise ImportError(f"no HTML parser backend available ({name}): {last_err}")
+
+
+# ---- コンパイル済みルール ----------------------------------------------------
+
+class CompiledRule:
+    __slots__ = ("backend", "in_sel", "in_any", "in_re", "out_sel", "out_any", "out_re")
+
+    def __init__(self, t: Target, backend=None):
+        self.backend = backend or get_backend()
+        self.in_sel = self.backend.compile(t.in_stock_css) if t.in_stock_css else None
+        self.out_sel = self.backend.compile(t.out_of_stock_css) if t.out_of_stock_css else None
+        # text_contains が None のときはセレクタ一致だけで決まる。空リストは「一致しない」
+        self.in_any = t.in_stock_text_contains is None
+        self.out_any = t.out_of_stock_text_contains is None
+        self.in_re = _words_regex(t.in_stock_text_contains or [])
+        self.out_re = _words_regex(t.out_of_stock_text_contains or [])
+
+    def _hit(self, text: str, any_ok: bool, rx) -> bool:
+        return any_ok or (rx is not None and rx.search(text) is not None)
+
+    def decide_texts(self, in_texts: List[str], out_texts: List[str]) -> Optional[bool]:
+        # True: 在庫あり, False: 在庫なし, None: 不明
+        for txt in in_texts:
+            if self._hit(txt, self.in_any, self.in_re):
+                return True
+        for txt in out_texts:
+            if self._hit(txt, self.out_any, self.out_re):
+                return False
+        return None
+
+    def decide_doc(self, doc) -> Optional[bool]:
+        b = self.backend
+        if self.in_sel is not None:
+            for node in b.select_nodes(doc, self.in_sel):
+                if self._hit(b.node_text(node), self.in_any, self.in_re):
+                    return True
+        if self.out_sel is not None:
+            for node in b.select_nodes(doc, self.out_sel):
+                if self._hit(b.node_text(node), self.out_any, self.out_re):
+                    return False
+        return None
+
+    def decide(self, html: str) -> Optional[bool]:
+        try:
+            return self.decide_doc(self.backend.parse(html))
+        except Exception as e:
+            print(f"parse error: {e}")
+            return None
+
+
+_rule_cache: Dict[Tuple, CompiledRule] = {}
+
+
+def _rule_key(t: Target, backend) -> Tuple:
+    return (backend.name, t.in_stock_css, tuple(t.in_stock_text_contains) if t.in_stock_text_contains is not None else None,
+            t.out_of_stock_css, tuple(t.out_of_stock_text_contains) if t.out_of_stock_text_contains is not None else None)
+
+
+def compile_target(t: Target, backend=None) -> CompiledRule:
+    backend = backend or get_backend()
+    key = _rule_key(t, backend)
+    rule = _rule_cache.get(key)
+    if rule is None:
+        rule = _rule_cache[key] = CompiledRule(t, backend)
+    return rule
+
+
+def decide_stock_html(html: str, t: Target) -> Optional[bool]:
+    return compile_target(t).decide(html)
+
+
+# ---- 文言マッチャ（aio 段階） -------------------------------------------------
+
+class KeywordMatcher:
+    # 在庫あり/なしの文言をまとめた1本の正規表現で HTML を1回だけ走査する。
+    # 先読み (?=...) にしておくと、重なり合う語も位置ごとに漏れなく拾える。
+    __slots__ = ("rx", "has_in", "max_len")
+
+    def __init__(self, words_in: List[str], words_out: List[str]):
+        ins = [re.escape(w) for w in sorted({w for w in words_in if w}, key=len, reverse=True)]
+        outs = [re.escape(w) for w in sorted({w for w in words_out if w}, key=len, reverse=True)]
+        parts = []
+        if ins:
+            parts.append(f"(?P<i>{'|'.join(ins)})")
+        if outs:
+            parts.append(f"(?P<o>{'|'.join(outs)})")
+        self.rx = re.compile(f"(?=(?:{'|'.join(parts)}))", re.IGNORECASE) if parts else None
+        self.has_in = bool(ins)
+        self.max_len = max([len(w) for w in list(words_in) + list(words_out) if w] or [0])
+
+    def scan(self, text: str) -> Tuple[bool, bool]:
+        # (在庫あり語を見つけたか, 在庫なし語を見つけたか)。在庫あり語が出た時点で打ち切る
+        if self.rx is None:
+            return False, False
+        seen_out = False
+        for m in self.rx.finditer(text):
+            if self.has_in and m.group("i") is not None:
+                return True, seen_out
+            seen_out = True
+        return False, seen_out
+
+    def decide(self, text: str) -> Optional[bool]:
+        found_in, found_out = self.scan(text)
+        if found_in:
+            return True
+        if found_out:
+            return False
+        return None
+
+
+_matcher_cache: Dict[Tuple, KeywordMatcher] = {}
+
+
+def keyword_matcher(words_in: List[str], words_out: List[str]) -> KeywordMatcher:
+    key = (tuple(words_in), tuple(words_out))
+    m = _matcher_cache.get(key)
+    if m is None:
+        m = _matcher_cache[key] = KeywordMatcher(words_in, words_out)
+    return m
@@ -0,0 +1,85 @@
+# subscriptions.py
+# 「誰がどの商品を見ているか」の対応表。URL は1回だけ監視し、通知のときに購読者へ配る。
+#
+# subscriptions.json の例（ユーザーID → 監視したい URL か name のリスト、"*" は全件）:
+#   {
+#     "Uaaaaaaaa": ["https://www.popmart.com/jp/products/6936/...", "らぶぶ（例）"],
+#     "Ubbbbbbbb": ["*"]
+#   }
+# targets.json の各エントリに "subscribers": ["Uccc", ...] と書いてもよい（両方の和集合）。
+# LINE_TO_USER_ID（カンマ区切り）は従来どおり全件の通知先として常に含める。
+import json, os
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+from target_registry import canonical_url, target_key
+
+SUBSCRIPTIONS_PATH = os.getenv("SUBSCRIPTIONS_PATH", "subscriptions.json")
+
+
+def dedupe_targets(items: Iterable[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    # 同じ URL は1回だけ監視する。後から出てきた重複の subscribers は先頭のエントリにまとめる
+    # URL は正規化したもの（トラッキング用クエリの除去・クエリの並べ替え等、target_registry.canonical_url）にそろえる
+    by_url: Dict[str, Dict[str, Any]] = {}
+    for d in items:
+        if not d.get("url"):
+            continue
+        url = target_key(d)
+        first = by_url.get(url)
+        if first is None:
+            by_url[url] = {**d, "url": url}
+            continue
+        print(f"[targets] duplicate url merged: {d.get('name')} -> {first.get('name')}")
+        if d.get("subscribers"):
+            first["subscribers"] = sorted(set(first.get("subscribers") or []) | set(d["subscribers"]))
+    return list(by_url.values())
+
+
+class Subscriptions:
+    def __init__(self, by_url: Dict[str, Set[str]], everyone: Set[str]):
+        self.by_url = by_url
+        self.everyone = everyone
+
+    def recipients(self, url: str, collection: Optional[str] = None) -> Optional[Tuple[str, ...]]:
+        # None は「既定の通知先（LINE_TO_USER_ID / broadcast）に送る」
+        # collection: 一覧ページ由来の商品なら一覧ページの購読者にも送る
+        # notifier（asyncio / requests を読み込む）は通知するときまで読み込まない
+        from notifier import default_recipients
+        base = default_recipients()
+        if base == ():
+            return None  # broadcast なら全員に届くので個別に送らない
+        ids = self.by_url.get(url, set()) | self.by_url.get(collection, set()) | self.everyone
+        if not ids:
+            return None
+        return tuple(sorted(ids | set(base or ())))
+
+    def __len__(self):
+        return len({u for ids in self.by_url.values() for u in ids} | self.everyone)
+
+
+def load_subscriptions(targets: Iterable[Dict[str, Any]], path: str = SUBSCRIPTIONS_PATH) -> Subscriptions:
+    targets = list(targets)
+    by_url: Dict[str, Set[str]] = {}
+    for d in targets:
+        for uid in d.get("subscribers") or []:
+            by_url.setdefault(d["url"], set()).add(uid)
+
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            table = json.load(f)
+    except FileNotFoundError:
+        table = {}
+    except Exception as e:
+        print(f"[subscriptions] cannot read {path}: {e}")
+        table = {}
+
+    by_name = {d.get("name"): d["url"] for d in targets if d.get("name")}
+    everyone: Set[str] = set()
+    for uid, keys in table.items():
+        for key in keys:
+            if key == "*":
+                everyone.add(uid)
+            elif key in by_name:
+                by_url.setdefault(by_name[key], set()).add(uid)
+            else:
+                by_url.setdefault(canonical_url(key), set()).add(uid)
+    return Subscriptions(by_url, everyone)
@@ -0,0 +1,173 @@
+# target_registry.py
+# targets.json をコンパイル済みのターゲットとして持ち、ファイルが変わったら差分だけを反映する。
+#
+#   - URL は正規化したものをキーにする（canonical_url）。スキーム・ホストの小文字化、既定ポート・#以降の除去、
+#     トラッキング用のクエリ（utm_* / gclid / fbclid 等、TARGET_DROP_PARAMS で追加）の除去、残りのクエリの並べ替え。
+#     同じ商品を別のクエリで書いても1回だけ監視する（dedupe_targets が使う。"canonical": false で正規化しない）
+#   - 各ターゲットは __slots__ の CompiledTarget。文言マッチャは読み込み時にコンパイル済み、
+#     HTML 判定ルール（パーサが要る）は最初に使うときにコンパイルする。dict と同じように読める
+#   - TargetRegistry.poll() は targets.json の mtime / サイズを見て、変わっていれば読み直して
+#     追加・削除・変更の差分を返す（デーモン・パイプラインが TARGETS_RELOAD_SEC ごとに呼ぶ）。
+#     書きかけ等で読めなければ前の内容のまま
+#   - state / headers_cache の行は、旧来の（正規化前の）URL のものも正規化後のキーで読めるようにする（adopt_aliases）
+import hashlib, json, os
+from collections.abc import Mapping
+from pathlib import Path
+from typing import Dict, List, NamedTuple, Optional
+from urllib.parse import unquote_plus, urlsplit, urlunsplit
+
+from stock_rules import DEFAULT_IN_WORDS, DEFAULT_OUT_WORDS, Target, compile_target, keyword_matcher
+
+TARGETS_RELOAD_SEC = float(os.getenv("TARGETS_RELOAD_SEC", "2"))  # 0 で監視しない
+TARGET_DROP_PARAMS = os.getenv("TARGET_DROP_PARAMS", "")  # 追加で捨てるクエリ名（カンマ区切り、末尾 * で前方一致）
+
+_DROP = ["utm_*", "gclid", "dclid", "fbclid", "msclkid", "yclid", "igshid", "mc_cid", "mc_eid",
+         "_ga", "_gl", "srsltid", "spm"] + [p.strip() for p in TARGET_DROP_PARAMS.split(",") if p.strip()]
+_DROP_EXACT = {p.lower() for p in _DROP if not p.endswith("*")}
+_DROP_PREFIX = tuple(p[:-1].lower() for p in _DROP if p.endswith("*"))
+_DEFAULT_PORTS = {"http": 80, "https": 443}
+
+
+def _dropped(param: str) -> bool:
+    name = unquote_plus(param.split("=", 1)[0]).lower()
+    return name in _DROP_EXACT or name.startswith(_DROP_PREFIX)
+
+
+def canonical_url(url: str) -> str:
+    # クエリの値のエンコードはそのまま（サーバによって %20 と + の扱いが違うため）、順番だけ揃える
+    url = url.strip()
+    try:
+        p = urlsplit(url)
+        port = p.port
+    except ValueError:
+        return url
+    if not p.scheme or not p.hostname:
+        return url
+    scheme = p.scheme.lower()
+    host = p.hostname.lower()
+    if ":" in host:
+        host = f"[{host}]"
+    if port and port != _DEFAULT_PORTS.get(scheme):
+        host = f"{host}:{port}"
+    if p.username or p.password:
+        host = f"{p.netloc.rsplit('@', 1)[0]}@{host}"
+    params = [q for q in p.query.split("&") if q and not _dropped(q)]
+    params.sort(key=lambda q: (unquote_plus(q.split("=", 1)[0]), q))
+    return urlunsplit((scheme, host, p.path or "/", "&".join(params), ""))
+
+
+def target_key(d: dict) -> str:
+    return d["url"].strip() if d.get("canonical") is False else canonical_url(d["url"])
+
+
+def adopt_aliases(rows: Dict[str, dict]) -> Dict[str, dict]:
+    # 正規化前の URL で保存された行を、正規化後のキーでも読めるようにする（正規化後の行があればそちらが優先）
+    for url in list(rows):
+        key = canonical_url(url)
+        if key != url and key not in rows:
+            rows[key] = rows[url]
+    return rows
+
+
+class CompiledTarget(Mapping):
+    __slots__ = ("key", "spec", "digest", "matcher", "_rule")
+
+    def __init__(self, spec: dict):
+        self.spec = spec
+        self.key = spec["url"]
+        self.digest = hashlib.blake2s(json.dumps(spec, sort_keys=True, ensure_ascii=False).encode("utf-8"),
+                                      digest_size=8).digest()
+        self.matcher = keyword_matcher(spec.get("in_stock_text_contains") or DEFAULT_IN_WORDS,
+                                       spec.get("out_of_stock_text_contains") or DEFAULT_OUT_WORDS)
+        self._rule = None
+
+    @property
+    def rule(self):
+        # HTML 判定ルール（light / 確定ステージと同じもの）。パーサの読み込みは使うときまで遅らせる
+        if self._rule is None:
+            self._rule = compile_target(Target.from_dict(self.spec))
+        return self._rule
+
+    def __getitem__(self, k):
+        return self.spec[k]
+
+    def __iter__(self):
+        return iter(self.spec)
+
+    def __len__(self):
+        return len(self.spec)
+
+    def __reduce__(self):
+        # ワーカープロセス（worker_pool）へは元の dict だけ送って向こうでコンパイルし直す
+        return CompiledTarget, (self.spec,)
+
+    def __repr__(self):
+        return f"CompiledTarget({self.spec.get('name')!r}, {self.key!r})"
+
+
+class Diff(NamedTuple):
+    added: List[CompiledTarget]
+    removed: List[str]
+    changed: List[CompiledTarget]
+
+    def __bool__(self):
+        return bool(self.added or self.removed or self.changed)
+
+    def __str__(self):
+        return f"+{len(self.added)} -{len(self.removed)} ~{len(self.changed)}"
+
+
+class TargetRegistry:
+    def __init__(self, path, shard: bool = True):
+        self.path = Path(path)
+        self.shard = shard
+        self.targets: Dict[str, CompiledTarget] = {}
+        self._stamp = None
+
+    def _stat(self):
+        try:
+            st = self.path.stat()
+        except FileNotFoundError:
+            return None
+        return st.st_mtime_ns, st.st_size
+
+    def _read(self) -> Optional[List[CompiledTarget]]:
+        from sharding import shard_targets
+        from subscriptions import dedupe_targets
+        try:
+            items = json.loads(self.path.read_text(encoding="utf-8")) if self.path.exists() else []
+        except Exception as e:
+            print(f"[targets] cannot read {self.path}: {e}")
+            return None
+        items = dedupe_targets(items)
+        if self.shard:
+            items = shard_targets(items)
+        return [CompiledTarget(d) for d in items]
+
+    def load(self) -> List[CompiledTarget]:
+        self._stamp = self._stat()
+        self.targets = {t.key: t for t in self._read() or []}
+        return list(self.targets.values())
+
+    def poll(self) -> Diff:
+        stamp = self._stat()
+        if stamp == self._stamp:
+            return Diff([], [], [])
+        self._stamp = stamp
+        fresh = self._read()
+        if fresh is None:
+            return Diff([], [], [])
+        new = {t.key: t for t in fresh}
+        old = self.targets
+        # 変わっていないエントリは前のオブジェクト（コンパイル済みのルール）をそのまま使う
+        diff = Diff([t for k, t in new.items() if k not in old],
+                    [k for k in old if k not in new],
+                    [t for k, t in new.items() if k in old and old[k].digest != t.digest])
+        self.targets = {k: (t if k not in old or old[k].digest != t.digest else old[k]) for k, t in new.items()}
+        return diff
+
+    def __len__(self):
+        return len(self.targets)
+
+    def __iter__(self):
+        return iter(self.targets.values())
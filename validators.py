@@ -0,0 +1,188 @@
+# validators.py
+# headers_cache の各行を「URLごとの検証子プロファイル」として扱い、取得方法を URL ごとに変える。
+#
+# 行のフィールド（etag / last_modified 以外は統計。古い行はそのまま読める）:
+#   etag / last_modified   直近の検証子
+#   sent / hits            検証子を付けて送った回数 / そのうち 304 が返った回数
+#   skip                   304 がほぼ返らない（無視されている）→ 検証子を送らない
+#   skipped                skip 中の取得回数（VALIDATOR_RETEST_EVERY 回に1回は送り直して確かめる）
+#   full                   本文を丸ごと取った回数
+#   sig_n / sig_same / sig_miss / churn
+#                          本文を取るたびに「検証子が前回と同じか」と「本文ハッシュが同じか」を突き合わせた結果。
+#                          sig_miss = 検証子は同じなのに本文が変わった（= 検証子は当てにならない）、
+#                          churn = 本文は同じなのに検証子が変わった（毎回変わる ETag 等）
+#   probe_kind             head | range | none  変化検知に使う安価なプローブ
+#   probe_since            プローブで「変化なし」とした回数（VALIDATOR_VERIFY_EVERY 回で本文を取って答え合わせ）
+#   cache_control / age / cdn   直近レスポンスの Cache-Control / Age / CDN の種別
+#
+# 取得方法:
+#   304 が効く       → これまでどおり条件付き GET
+#   304 が効かないが、検証子が本文の変化と一致している
+#                    → HEAD（拒否されたら Range: bytes=0-0 の GET）で検証子だけ見て、同じなら本文を取らない
+#   どちらもだめ     → 検証子を付けずに普通の GET
+import os, time
+from typing import Dict, Optional, Tuple
+
+VALIDATOR_MIN_SAMPLES = int(os.getenv("VALIDATOR_MIN_SAMPLES", "8"))  # 判断に必要な回数
+VALIDATOR_MIN_HIT_RATE = float(os.getenv("VALIDATOR_MIN_HIT_RATE", "0.05"))  # これ未満の 304 率なら送らない
+VALIDATOR_RETEST_EVERY = int(os.getenv("VALIDATOR_RETEST_EVERY", "50"))
+VALIDATOR_VERIFY_EVERY = int(os.getenv("VALIDATOR_VERIFY_EVERY", "20"))
+VALIDATOR_WINDOW = int(os.getenv("VALIDATOR_WINDOW", "200"))  # これを超えたら回数を半分にして最近の傾向を重視
+VALIDATOR_SAVE_SEC = int(os.getenv("VALIDATOR_SAVE_SEC", "60"))  # 統計だけの更新はこの間隔でしか書き出さない
+VALIDATOR_PROBE = os.getenv("VALIDATOR_PROBE", "auto")  # auto | off
+
+# 変わったらすぐ書き出すフィールド（それ以外の統計は VALIDATOR_SAVE_SEC ごと）
+_SIGNIFICANT = ("etag", "last_modified", "skip", "probe_kind", "cache_control", "cdn")
+
+
+def cdn_of(headers) -> str:
+    h = {k.lower(): v for k, v in headers.items()}
+    if "cf-cache-status" in h or "cf-ray" in h:
+        return "cloudflare"
+    if "x-amz-cf-id" in h:
+        return "cloudfront"
+    if "akamai-grn" in h or "x-akamai-transformed" in h:
+        return "akamai"
+    if "x-fastly-request-id" in h or "fastly" in h.get("x-served-by", "").lower():
+        return "fastly"
+    if "varnish" in h.get("via", "").lower() or "x-varnish" in h:
+        return "varnish"
+    return ""
+
+
+def response_meta(headers) -> Dict[str, str]:
+    # レスポンスヘッダから検証子とキャッシュ関連だけを抜き出す（無いものはキーごと入れない）
+    meta = {}
+    if v := headers.get("ETag") or headers.get("etag"):
+        meta["etag"] = v
+    if v := headers.get("Last-Modified") or headers.get("last-modified"):
+        meta["last_modified"] = v
+    if v := headers.get("Cache-Control") or headers.get("cache-control"):
+        meta["cache_control"] = v
+    age = headers.get("Age") or headers.get("age")
+    if age and age.strip().isdigit():
+        meta["age"] = int(age)
+    if cdn := cdn_of(headers):
+        meta["cdn"] = cdn
+    return meta
+
+
+def _sig(d: dict) -> Tuple:
+    return (d.get("etag") or "", d.get("last_modified") or "") if d.get("etag") or d.get("last_modified") else ()
+
+
+def same_validators(profile: dict, meta: dict) -> bool:
+    sig = _sig(profile)
+    return bool(sig) and sig == _sig(meta)
+
+
+def conditional_headers(profile: dict) -> Dict[str, str]:
+    if not profile.get("etag") and not profile.get("last_modified"):
+        return {}
+    if profile.get("skip") and (profile.get("skipped", 0) + 1) % VALIDATOR_RETEST_EVERY:
+        return {}
+    h = {}
+    if et := profile.get("etag"):
+        h["If-None-Match"] = et
+    if lm := profile.get("last_modified"):
+        h["If-Modified-Since"] = lm
+    return h
+
+
+def probe_kind(profile: dict) -> Optional[str]:
+    # 304 は効かないが、検証子が本文の変化を言い当てている URL だけプローブする
+    if VALIDATOR_PROBE == "off" or not profile.get("skip"):
+        return None
+    kind = profile.get("probe_kind") or "head"
+    if kind == "none":
+        return None
+    if profile.get("sig_n", 0) < VALIDATOR_MIN_SAMPLES or profile.get("sig_miss", 0) or not profile.get("sig_same"):
+        return None
+    if profile.get("probe_since", 0) >= VALIDATOR_VERIFY_EVERY:
+        return None  # 答え合わせに本文を取る
+    return kind
+
+
+def _count(p: dict, key: str, n: int = 1):
+    p[key] = p.get(key, 0) + n
+
+
+def observe(profile: dict, res: dict, hash_changed: Optional[bool], now: Optional[float] = None) -> Tuple[dict, bool]:
+    # 1回の取得結果でプロファイルを更新する。戻り値: (新しいプロファイル, 今書き出すべきか)
+    # res["validator"] = {"sent": 検証子を送ったか, "probe": head|range, "probe_result": same|changed|failed,
+    #                     "meta": response_meta()}
+    obs = res.get("validator") or {}
+    p = dict(profile)
+    if obs.get("sent") and res["status"] != "error":
+        _count(p, "sent")
+    if profile.get("skip"):
+        _count(p, "skipped")
+
+    result = obs.get("probe_result")
+    if result == "same":
+        _count(p, "probe_since")
+    elif result == "failed":
+        # HEAD を拒否するサイトは Range で、Range も効かなければプローブしない
+        p["probe_kind"] = "range" if obs.get("probe") == "head" else "none"
+
+    if res["status"] == "not_modified" and result != "same" and obs.get("sent"):
+        _count(p, "hits")
+    elif res["status"] == "ok":
+        meta = obs.get("meta") or {}
+        _count(p, "full")
+        p["probe_since"] = 0
+        old_sig, new_sig = _sig(profile), _sig(meta)
+        if hash_changed is not None and old_sig and new_sig:
+            _count(p, "sig_n")
+            if old_sig == new_sig:
+                _count(p, "sig_miss" if hash_changed else "sig_same")
+            elif not hash_changed:
+                _count(p, "churn")
+        for k in ("etag", "last_modified"):
+            if meta.get(k):
+                p[k] = meta[k]
+            elif p.get(k):
+                p[k] = None  # 送られなくなった検証子は消す（無いものを新たに None で書くことはしない）
+        for k in ("cache_control", "age", "cdn"):
+            if k in meta:
+                p[k] = meta[k]
+
+    if p.get("sent", 0) > VALIDATOR_WINDOW:
+        p["sent"], p["hits"] = p["sent"] // 2, p.get("hits", 0) // 2
+    if p.get("sig_n", 0) > VALIDATOR_WINDOW:
+        for k in ("sig_n", "sig_same", "sig_miss", "churn"):
+            if k in p:
+                p[k] //= 2
+    sent = p.get("sent", 0)
+    p["skip"] = sent >= VALIDATOR_MIN_SAMPLES and p.get("hits", 0) / sent < VALIDATOR_MIN_HIT_RATE
+
+    now = now or time.time()
+    save = any(p.get(k) != profile.get(k) for k in _SIGNIFICANT) or now - profile.get("saved_ts", 0) >= VALIDATOR_SAVE_SEC
+    if save:
+        p["saved_ts"] = int(now)
+    return p, save
+
+
+def describe(profile: dict) -> str:
+    if kind := probe_kind(profile):
+        return f"probe:{kind}"
+    return "conditional" if conditional_headers(profile) else "plain"
+
+
+if __name__ == "__main__":
+    # URL ごとの 304 率・検証子の揺らぎ・現在の取得方法を一覧する
+    import argparse
+    from state_store import open_store
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--state", default=os.getenv("STATE_PATH", "state.json"))
+    ap.add_argument("--headers", default=os.getenv("HEADERS_PATH", "headers_cache.json"))
+    args = ap.parse_args()
+    store = open_store(args.state, args.headers)
+    rows = store.load_headers()
+    store.close()
+    print(f"{'policy':>12} {'304 rate':>9} {'churn':>6} {'miss':>5} {'cdn':>10}  url")
+    for url, p in sorted(rows.items()):
+        sent = p.get("sent", 0)
+        rate = f"{p.get('hits', 0) / sent:.0%}" if sent else "-"
+        print(f"{describe(p):>12} {rate:>9} {p.get('churn', 0):>6} {p.get('sig_miss', 0):>5} "
+              f"{p.get('cdn') or '-':>10}  {url}")
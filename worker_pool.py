@@ -0,0 +1,59 @@
+# worker_pool.py
+# 判定・ハッシュ・指紋など CPU を食う処理をプロセスプールへ逃がす。
+# HTML のパースや巨大ページの走査がイベントループ（取得側）を止めないようにするため。
+#
+#   DECIDE_WORKERS=0  (既定) これまでどおり同じプロセスで実行
+#   DECIDE_WORKERS=N  N 個のワーカープロセスで実行（N はコア数程度が目安）
+#
+# 渡す関数・引数・戻り値は pickle できるもの（モジュール直下の関数、dict / str / bytes）に限る。
+import atexit, os
+
+DECIDE_WORKERS = int(os.getenv("DECIDE_WORKERS", "0"))
+
+_pool = None
+
+
+def enabled() -> bool:
+    return DECIDE_WORKERS > 0
+
+
+def get_pool():
+    global _pool
+    if _pool is None and enabled():
+        # multiprocessing は使うときだけ読み込む
+        from concurrent.futures import ProcessPoolExecutor
+        _pool = ProcessPoolExecutor(max_workers=DECIDE_WORKERS)
+    return _pool
+
+
+async def offload(fn, *args):
+    # 非同期側から: プールがあればワーカーで、無ければその場で実行
+    import asyncio  # 呼び出し側で読み込み済み（light では読み込まない）
+    pool = get_pool()
+    if pool is None:
+        return fn(*args)
+    return await asyncio.get_running_loop().run_in_executor(pool, fn, *args)
+
+
+def submit(fn, *args):
+    # 同期側から: 結果は future.result() で受け取る（プールが無ければ実行済みの future）
+    pool = get_pool()
+    if pool is not None:
+        return pool.submit(fn, *args)
+    from concurrent.futures import Future
+    fut = Future()
+    try:
+        fut.set_result(fn(*args))
+    except Exception as e:
+        fut.set_exception(e)
+    return fut
+
+
+def shutdown():
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=True, cancel_futures=True)
+        _pool = None
+
+
+atexit.register(shutdown)